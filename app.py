@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, session, send_file, url_for, flash
+from flask import Flask, render_template, stream_template, request, redirect, session, send_file, url_for, flash, Response, stream_with_context, abort
 from werkzeug.utils import secure_filename
 from flask_socketio import SocketIO, emit, join_room
 from functools import wraps
@@ -6,6 +6,17 @@ from datetime import date, datetime, timedelta, time
 import io
 import os
 import calendar
+import json
+import hashlib
+import uuid
+import atexit
+from collections import Counter, OrderedDict, defaultdict, deque
+from bisect import bisect_left, bisect_right
+import multiprocessing
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+import click
 
 # ✅ QRCode: protege o app caso o pacote não esteja instalado (evita crash/502)
 try:
@@ -13,17 +24,24 @@ try:
 except Exception:
     qrcode = None
 
-from models import db, Funcionario, Mensagem, EscalaMes, EscalaItem, TrocaPlantao  # <-- garanta que existem no models.py
+from models import db, Funcionario, Mensagem, ConversaResumo, PresencaSocket, VersaoCache, EscalaMes, EscalaItem, EscalaRegra, TrocaPlantao, Comunicado, Curso, ConclusaoCurso, Setor, PedidoMaterial  # <-- garanta que existem no models.py
+import escala_grid
+import pdf_layout
+import planilhas
+import fila_socketio
+import imagens_chat
+import numpy as np
 
 # PDF
-from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.lib.units import cm
 
 # SQLite (anti lock)
-from sqlalchemy import event
+from sqlalchemy import event, bindparam
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 import sqlite3
 
 # ==================================================
@@ -49,14 +67,54 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 db.init_app(app)
 
+# ==================================================
+# SOCKET.IO - VÁRIOS WORKERS / SERVIDORES
+# ==================================================
+# Com 1 worker (padrão) tudo fica no processo. Para usar mais núcleos
+# (gunicorn -w N / WEB_CONCURRENCY) ou mais servidores, os emits para as
+# salas precisam passar por uma fila compartilhada:
+#   SOCKETIO_MESSAGE_QUEUE=sqlite:///instance/socketio_fila.db  (mesma máquina, sem serviço extra)
+#   SOCKETIO_MESSAGE_QUEUE=redis://host:6379/0                  (vários servidores; pip install redis)
+#   também amqp:// (kombu) e kafka:// (kafka-python), como no Flask-SocketIO
+#
+# Sessão "grudada" no worker: com fila ligada o Socket.IO roda só em
+# WebSocket (sem long-polling). Um WebSocket é 1 conexão TCP e fica no
+# worker que aceitou o handshake, então não precisa de sticky session no
+# gunicorn; atrás de vários servidores, o balanceador só precisa repassar
+# o Upgrade. (Long-polling abre vários requests e cada um pode cair num
+# worker diferente — por isso fica desligado.)
+#
+# O resto do estado compartilhado já está no banco (sessão do Flask é
+# cookie); os caches em memória conferem EscalaMes.versao.
+
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", "").strip()
+SOCKETIO_SO_WEBSOCKET = os.getenv("SOCKETIO_SO_WEBSOCKET", "1" if SOCKETIO_MESSAGE_QUEUE else "0") == "1"
+
+_socketio_opcoes = {}
+if SOCKETIO_MESSAGE_QUEUE.startswith("sqlite:"):
+    _socketio_opcoes["client_manager"] = fila_socketio.SqliteFilaManager(
+        SOCKETIO_MESSAGE_QUEUE,
+        intervalo=int(os.getenv("SOCKETIO_FILA_INTERVALO_MS", "50")) / 1000,
+    )
+elif SOCKETIO_MESSAGE_QUEUE:
+    _socketio_opcoes["message_queue"] = SOCKETIO_MESSAGE_QUEUE
+if SOCKETIO_SO_WEBSOCKET:
+    _socketio_opcoes["transports"] = ["websocket"]
+
 socketio = SocketIO(
     app,
     cors_allowed_origins=os.getenv("SOCKETIO_CORS", "*"),
     async_mode="eventlet",
     ping_interval=25,
     ping_timeout=60,
+    **_socketio_opcoes,
 )
 
+@app.context_processor
+def inject_socketio():
+    # o cliente (socket.io.js) precisa usar os mesmos transportes do servidor
+    return dict(socketio_transportes=["websocket"] if SOCKETIO_SO_WEBSOCKET else ["polling", "websocket"])
+
 # ==================================================
 # SQLITE - PRAGMAS ANTI LOCK (WAL + timeout)
 # ==================================================
@@ -112,16 +170,6 @@ def inject_user():
         user = Funcionario.query.get(session["user_id"])
     return dict(user=user)
 
-# ==================================================
-# DADOS EM MEMÓRIA
-# ==================================================
-
-comunicados_lista = []
-cursos_lista = []
-setores_lista = []
-conclusoes = []
-pedidos_materiais = []
-
 # ==================================================
 # BANCO / USUÁRIOS PADRÃO
 # ==================================================
@@ -130,7 +178,7 @@ with app.app_context():
     db.create_all()
 
     # ==================================================
-    # ✅ MIGRAÇÃO RÁPIDA SQLITE: adiciona coluna equipe se não existir
+    # ✅ MIGRAÇÃO RÁPIDA SQLITE: adiciona colunas novas se não existirem
     # ==================================================
     try:
         uri = app.config.get("SQLALCHEMY_DATABASE_URI", "")
@@ -145,10 +193,36 @@ with app.app_context():
                 conn.commit()
                 print("✅ Coluna 'equipe' criada na tabela funcionario (SQLite).")
 
+            if "comunicado_visto_id" not in cols:
+                cur.execute("ALTER TABLE funcionario ADD COLUMN comunicado_visto_id INTEGER NOT NULL DEFAULT 0;")
+                conn.commit()
+                print("✅ Coluna 'comunicado_visto_id' criada na tabela funcionario (SQLite).")
+
+            cur.execute("PRAGMA table_info(escala_item);")
+            cols_item = [row[1] for row in cur.fetchall()]
+
+            if "fixado" not in cols_item:
+                cur.execute("ALTER TABLE escala_item ADD COLUMN fixado BOOLEAN NOT NULL DEFAULT 0;")
+                conn.commit()
+                print("✅ Coluna 'fixado' criada na tabela escala_item (SQLite).")
+
+            cur.execute("PRAGMA table_info(escala_mes);")
+            cols_mes = [row[1] for row in cur.fetchall()]
+
+            if "versao" not in cols_mes:
+                cur.execute("ALTER TABLE escala_mes ADD COLUMN versao INTEGER NOT NULL DEFAULT 0;")
+                conn.commit()
+                print("✅ Coluna 'versao' criada na tabela escala_mes (SQLite).")
+
+            if "armazenamento" not in cols_mes:
+                cur.execute("ALTER TABLE escala_mes ADD COLUMN armazenamento VARCHAR(10) NOT NULL DEFAULT 'itens';")
+                conn.commit()
+                print("✅ Coluna 'armazenamento' criada na tabela escala_mes (SQLite).")
+
             cur.close()
             conn.close()
     except Exception as e:
-        print("⚠️ Falha ao aplicar migração rápida (equipe):", e)
+        print("⚠️ Falha ao aplicar migração rápida:", e)
 
     # ✅ cria usuários padrão somente se ainda não existirem
     if not Funcionario.query.filter_by(cpf="12345678900").first():
@@ -204,24 +278,334 @@ def funcionario_required(view):
     return wrapped_view
 
 # ==================================================
-# LIMPAR MENSAGENS
+# RESUMO DAS CONVERSAS (SIDEBAR)
+# ==================================================
+# conversa_resumo: 1 linha por (usuário, contato) com a última mensagem
+# e as não lidas. Quem grava mensagem chama registrar_resumos() na mesma
+# transação; a limpeza das vencidas chama _resumos_apos_limpeza(), que
+# refaz os resumos afetados em lote (UPDATE/DELETE por conjunto, sem
+# consulta por conversa) com o mesmo `agora` do DELETE: a lista de
+# conversas nunca aponta para mensagem vencida e conversa que zerou some.
+
+CONVERSAS_LISTA_MAX = 50
+
+def _previa_mensagem(texto, arquivo):
+    t = " ".join((texto or "").split())
+    if not t and arquivo:
+        t = f"📎 {arquivo}"
+    if len(t) > 120:
+        t = t[:119] + "…"
+    return t or None
+
+def registrar_resumos(mensagens):
+    """
+    Atualiza os 2 lados de cada conversa (remetente: última mensagem;
+    destinatário: última mensagem + 1 não lida). Mensagens já com id
+    (flush feito), em ordem de envio. Num lote, 1 UPDATE por lado de
+    conversa (não 1 por mensagem). Não faz commit.
+    """
+    tabela = ConversaResumo.__table__
+
+    por_lado = {}  # (usuario, contato) -> [última mensagem, novas não lidas]
+    for m in mensagens:
+        lado = por_lado.setdefault((m.remetente_id, m.destinatario_id), [m, 0])
+        lado[0] = m
+        if m.destinatario_id != m.remetente_id:
+            lado = por_lado.setdefault((m.destinatario_id, m.remetente_id), [m, 0])
+            lado[0] = m
+            lado[1] += 1
+
+    for (usuario_id, contato_id), (m, nova) in por_lado.items():
+        valores = {
+            "ultima_mensagem_id": m.id,
+            "ultimo_texto": _previa_mensagem(m.texto, m.arquivo),
+            "ultimo_envio": m.data_envio,
+            "ultimo_expira": m.expira_em,
+            "ultimo_remetente_id": m.remetente_id,
+        }
+        r = db.session.execute(
+            tabela.update()
+            .where(tabela.c.usuario_id == usuario_id)
+            .where(tabela.c.contato_id == contato_id)
+            .values(**valores, nao_lidas=tabela.c.nao_lidas + nova)
+        )
+        if not r.rowcount:
+            db.session.execute(
+                tabela.insert().values(usuario_id=usuario_id, contato_id=contato_id, nao_lidas=nova, **valores)
+            )
+
+def marcar_conversa_lida(usuario_id: int, contato_id: int):
+    """Zera as não lidas ao abrir a conversa. Não faz commit."""
+    tabela = ConversaResumo.__table__
+    db.session.execute(
+        tabela.update()
+        .where(tabela.c.usuario_id == usuario_id)
+        .where(tabela.c.contato_id == contato_id)
+        .where(tabela.c.nao_lidas > 0)
+        .values(nao_lidas=0, lido_em=datetime.utcnow())
+    )
+
+def _resumos_apos_limpeza(agora: datetime, pares_vencidos):
+    """
+    Depois do DELETE das vencidas (mesma transação, mesmo `agora`), sem
+    laço por conversa (`pares_vencidos`: (destinatario_id, remetente_id)
+    das mensagens apagadas, lidos antes do DELETE):
+    - resumo com a última mensagem vencida aponta para a mais nova viva
+      (1 UPDATE com subconsulta); sem nenhuma viva fica NULL e é apagado
+    - texto/envio/validade/remetente copiados da nova última (1 SELECT +
+      1 UPDATE em lote)
+    - não lidas recontadas só nos pares que perderam mensagem e tinham
+      não lidas (1 UPDATE em lote; o custo segue o que venceu, não o
+      total de conversas com não lidas)
+    Retorna quantos resumos foram apagados.
+    """
+    tabela = ConversaResumo.__table__
+    msg = Mensagem.__table__
+
+    mais_nova_viva = (
+        db.select(msg.c.id)
+        .where(db.or_(
+            (msg.c.remetente_id == tabela.c.usuario_id) & (msg.c.destinatario_id == tabela.c.contato_id),
+            (msg.c.remetente_id == tabela.c.contato_id) & (msg.c.destinatario_id == tabela.c.usuario_id),
+        ))
+        .where(msg.c.expira_em >= agora)
+        .order_by(msg.c.data_envio.desc(), msg.c.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        tabela.update().where(tabela.c.ultimo_expira < agora).values(ultima_mensagem_id=mais_nova_viva)
+    )
+    r = db.session.execute(
+        tabela.delete().where(tabela.c.ultimo_expira < agora).where(tabela.c.ultima_mensagem_id.is_(None))
+    )
+
+    novas = [
+        {
+            "b_id": resumo_id,
+            "b_texto": _previa_mensagem(texto, arquivo),
+            "b_envio": data_envio,
+            "b_expira": expira_em,
+            "b_remetente": remetente_id,
+        }
+        for resumo_id, texto, arquivo, data_envio, expira_em, remetente_id in db.session.execute(
+            db.select(tabela.c.id, msg.c.texto, msg.c.arquivo, msg.c.data_envio, msg.c.expira_em, msg.c.remetente_id)
+            .join(msg, msg.c.id == tabela.c.ultima_mensagem_id)
+            .where(tabela.c.ultimo_expira < agora)
+        )
+    ]
+    if novas:
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.id == bindparam("b_id"))
+            .values(
+                ultimo_texto=bindparam("b_texto"),
+                ultimo_envio=bindparam("b_envio"),
+                ultimo_expira=bindparam("b_expira"),
+                ultimo_remetente_id=bindparam("b_remetente"),
+            ),
+            novas,
+        )
+
+    pares = [{"b_usuario": usuario_id, "b_contato": contato_id} for usuario_id, contato_id in pares_vencidos]
+    if pares:
+        nao_lidas = (
+            db.select(db.func.count(msg.c.id))
+            .where(msg.c.remetente_id == tabela.c.contato_id)
+            .where(msg.c.destinatario_id == tabela.c.usuario_id)
+            .where(msg.c.data_envio > db.func.coalesce(tabela.c.lido_em, datetime(1970, 1, 1)))
+            .scalar_subquery()
+        )
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.usuario_id == bindparam("b_usuario"))
+            .where(tabela.c.contato_id == bindparam("b_contato"))
+            .where(tabela.c.nao_lidas > 0)
+            .values(nao_lidas=nao_lidas),
+            pares,
+        )
+    return r.rowcount or 0
+
+def reconstruir_resumos():
+    """Refaz conversa_resumo a partir das mensagens vivas (não lidas começam em 0). Faz commit."""
+    ultimas = {}
+    for m in (
+        Mensagem.query
+        .filter(Mensagem.expira_em >= datetime.utcnow())
+        .order_by(Mensagem.data_envio.asc(), Mensagem.id.asc())
+        .yield_per(1000)
+    ):
+        ultimas[(m.remetente_id, m.destinatario_id)] = m
+        ultimas[(m.destinatario_id, m.remetente_id)] = m
+
+    db.session.execute(ConversaResumo.__table__.delete())
+    linhas = [
+        {
+            "usuario_id": usuario_id,
+            "contato_id": contato_id,
+            "ultima_mensagem_id": m.id,
+            "ultimo_texto": _previa_mensagem(m.texto, m.arquivo),
+            "ultimo_envio": m.data_envio,
+            "ultimo_expira": m.expira_em,
+            "ultimo_remetente_id": m.remetente_id,
+            "nao_lidas": 0,
+        }
+        for (usuario_id, contato_id), m in ultimas.items()
+    ]
+    if linhas:
+        db.session.execute(ConversaResumo.__table__.insert(), linhas)
+    db.session.commit()
+    print(f"💬 Resumo de conversas reconstruído: {len(linhas)} linhas")
+    return len(linhas)
+
+@app.cli.command("reconstruir-conversas")
+def cli_reconstruir_conversas():
+    """Refaz a tabela de resumo das conversas a partir das mensagens."""
+    click.echo(f"✅ {reconstruir_resumos()} resumos")
+
+# ==================================================
+# LIMPAR MENSAGENS (VARREDURA EM SEGUNDO PLANO)
 # ==================================================
+# Fora do caminho das requisições: uma tarefa do socketio acorda a cada
+# CHAT_LIMPEZA_INTERVALO_S, apaga as mensagens vencidas com 1 DELETE
+# (índice em expira_em), remove os anexos em lotes e recolhe arquivos de
+# /upload-chat que nunca entraram em mensagem nenhuma.
+# CHAT_LIMPEZA_INTERVALO_S=0 desliga a tarefa (sobra o "flask limpar-chat").
+
+CHAT_LIMPEZA_INTERVALO_S = float(os.getenv("CHAT_LIMPEZA_INTERVALO_S", "300"))
+CHAT_UPLOAD_ORFAO_HORAS = float(os.getenv("CHAT_UPLOAD_ORFAO_HORAS", "2"))  # tempo p/ o upload virar mensagem
+CHAT_LIMPEZA_LOTE = 500
+
+_chat_limpeza_stats = {
+    "execucoes": 0,
+    "mensagens": 0,
+    "anexos": 0,
+    "orfaos": 0,
+    "bytes": 0,
+    "ultima": None,
+    "segundos": 0.0,
+}
+_chat_limpeza_tarefa = None
+
+def _remover_arquivos_chat(nomes):
+    """Apaga anexos em lotes (devolve a vez ao eventlet entre lotes). Retorna (arquivos, bytes)."""
+    arquivos = 0
+    liberados = 0
+    for i, nome in enumerate(nomes, 1):
+        path = os.path.join(UPLOAD_CHAT, nome)
+        try:
+            tamanho = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            continue
+        arquivos += 1
+        liberados += tamanho
+        try:
+            miniatura = _miniatura_chat_path(nome)
+            liberados += os.path.getsize(miniatura)
+            os.remove(miniatura)
+        except OSError:
+            pass
+        if i % CHAT_LIMPEZA_LOTE == 0:
+            socketio.sleep(0)
+    return arquivos, liberados
 
 def limpar_mensagens_vencidas():
+    """1 DELETE das mensagens vencidas + remoção dos anexos delas. Retorna (mensagens, anexos, bytes)."""
     agora = datetime.utcnow()
-    msgs = Mensagem.query.filter(Mensagem.expira_em < agora).all()
+    anexos = [
+        a for (a,) in db.session.query(Mensagem.arquivo)
+        .filter(Mensagem.expira_em < agora)
+        .filter(Mensagem.arquivo.isnot(None))
+    ]
+    # conversas que perdem mensagem: só nelas as não lidas são recontadas
+    pares = (
+        db.session.query(Mensagem.destinatario_id, Mensagem.remetente_id)
+        .filter(Mensagem.expira_em < agora)
+        .distinct()
+        .all()
+    )
+    r = db.session.execute(Mensagem.__table__.delete().where(Mensagem.expira_em < agora))
+    if r.rowcount:
+        _resumos_apos_limpeza(agora, pares)
+    db.session.commit()
 
-    for m in msgs:
-        if m.arquivo:
-            path = os.path.join(UPLOAD_CHAT, m.arquivo)
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass
-        db.session.delete(m)
+    # arquivo que falhar aqui vira órfão e sai na próxima varredura
+    arquivos, liberados = _remover_arquivos_chat(a for a in anexos if a)
+    return r.rowcount or 0, arquivos, liberados
 
-    db.session.commit()
+def limpar_uploads_orfaos():
+    """Arquivos de static/uploads/chat mais velhos que CHAT_UPLOAD_ORFAO_HORAS sem mensagem. Retorna (arquivos, bytes)."""
+    limite = datetime.now().timestamp() - CHAT_UPLOAD_ORFAO_HORAS * 3600
+    try:
+        candidatos = [
+            e.name for e in os.scandir(UPLOAD_CHAT)
+            if e.is_file() and e.stat().st_mtime < limite
+        ]
+    except FileNotFoundError:
+        return 0, 0
+
+    orfaos = []
+    for i in range(0, len(candidatos), CHAT_LIMPEZA_LOTE):
+        lote = candidatos[i:i + CHAT_LIMPEZA_LOTE]
+        usados = {
+            a for (a,) in db.session.query(Mensagem.arquivo).filter(Mensagem.arquivo.in_(lote))
+        }
+        orfaos.extend(n for n in lote if n not in usados)
+
+    return _remover_arquivos_chat(orfaos)
+
+def varrer_chat():
+    """Uma passada completa (vencidas + órfãos), atualizando os contadores."""
+    t0 = perf_counter()
+
+    # 1ª passada do processo: banco antigo (mensagens sem resumo) ganha os resumos
+    if not _chat_limpeza_stats["execucoes"] and not ConversaResumo.query.first() and Mensagem.query.first():
+        reconstruir_resumos()
+
+    mensagens, anexos, bytes_anexos = limpar_mensagens_vencidas()
+    orfaos, bytes_orfaos = limpar_uploads_orfaos()
+
+    st = _chat_limpeza_stats
+    st["execucoes"] += 1
+    st["mensagens"] += mensagens
+    st["anexos"] += anexos
+    st["orfaos"] += orfaos
+    st["bytes"] += bytes_anexos + bytes_orfaos
+    st["ultima"] = datetime.utcnow().isoformat(timespec="seconds")
+    st["segundos"] = round(perf_counter() - t0, 4)
+
+    if mensagens or anexos or orfaos:
+        print(
+            f"🧹 Chat: {mensagens} mensagens vencidas, {anexos} anexos, {orfaos} órfãos, "
+            f"{(bytes_anexos + bytes_orfaos) / 1024:.0f} KB em {st['segundos']}s"
+        )
+    return {"mensagens": mensagens, "anexos": anexos, "orfaos": orfaos, "bytes": bytes_anexos + bytes_orfaos}
+
+def _chat_limpeza_loop():
+    while True:
+        with app.app_context():
+            try:
+                varrer_chat()
+            except Exception as e:
+                db.session.rollback()
+                print("⚠️ Falha na limpeza do chat:", e)
+            finally:
+                db.session.remove()
+        socketio.sleep(CHAT_LIMPEZA_INTERVALO_S)
+
+@app.before_request
+def _iniciar_limpeza_chat():
+    # sobe na 1ª requisição (não em "flask <comando>" nem no import)
+    global _chat_limpeza_tarefa
+    if _chat_limpeza_tarefa is None and CHAT_LIMPEZA_INTERVALO_S > 0:
+        _chat_limpeza_tarefa = socketio.start_background_task(_chat_limpeza_loop)
+
+@app.cli.command("limpar-chat")
+def cli_limpar_chat():
+    """Apaga mensagens vencidas e anexos órfãos do chat agora."""
+    r = varrer_chat()
+    click.echo(f"✅ {r['mensagens']} mensagens, {r['anexos']} anexos, {r['orfaos']} órfãos, {r['bytes']} bytes")
 
 # ==================================================
 # LOGIN / LOGOUT
@@ -337,6 +721,9 @@ def admin_excluir_escala(escala_mes_id):
     try:
         db.session.delete(escala)
         db.session.commit()
+        _grade_cache_invalidar(escala_mes_id)
+        _pdf_cache_remover_escala(escala_mes_id)
+        _cobertura_cache_invalidar(escala_mes_id)
 
         flash("✅ Escala excluída com sucesso!", "success")
 
@@ -355,9 +742,8 @@ def admin_excluir_escala(escala_mes_id):
 def admin_escalas_equipes(escala_mes_id):
     escala = EscalaMes.query.get_or_404(escala_mes_id)
 
-    # pega funcionários que aparecem nessa escala
-    itens = EscalaItem.query.filter_by(escala_mes_id=escala.id).all()
-    func_ids = sorted(set(i.funcionario_id for i in itens))
+    # pega funcionários que aparecem nessa escala (regras + exceções)
+    func_ids = obter_grade(escala.id)["func_ids"]
 
     funcionarios = (
         Funcionario.query
@@ -369,10 +755,16 @@ def admin_escalas_equipes(escala_mes_id):
     EQUIPES_OPCOES = ["", "EQUIPE 1", "EQUIPE 2", "EQUIPE 3", "EQUIPE 4", "EQUIPE 5"]
 
     if request.method == "POST":
+        alterados = []
         for f in funcionarios:
             equipe = (request.form.get(f"equipe_{f.id}") or "").strip()
+            if (f.equipe or None) != (equipe or None):
+                alterados.append(f.id)
             f.equipe = equipe or None
+        _bump_versao_escala(funcionario_ids=alterados)
         db.session.commit()
+        # equipe é do funcionário (vale para todas as escalas em que ele aparece)
+        _grade_cache_invalidar()
         flash("✅ Equipes atualizadas!", "success")
         return redirect(url_for("admin_escala_mes", escala_mes_id=escala.id))
 
@@ -391,7 +783,20 @@ def admin_escalas_equipes(escala_mes_id):
 @login_required
 @funcionario_required
 def comunicados():
-    comunicados = list(reversed(comunicados_lista)) if comunicados_lista else []
+    comunicados = Comunicado.query.order_by(Comunicado.id.desc()).all()
+
+    # abriu a lista: tudo visto (1 UPDATE; badge das outras abas zera junto)
+    if comunicados:
+        uid = session["user_id"]
+        marcados = (
+            Funcionario.query
+            .filter(Funcionario.id == uid, Funcionario.comunicado_visto_id < comunicados[0].id)
+            .update({Funcionario.comunicado_visto_id: comunicados[0].id}, synchronize_session=False)
+        )
+        db.session.commit()
+        if marcados:
+            enviar_contadores([uid])
+
     return render_template("comunicados.html", comunicados=comunicados)
 # ==================================================
 # ADMIN - EXCLUIR COMUNICADO
@@ -401,30 +806,25 @@ def comunicados():
 @login_required
 @direcao_required
 def admin_excluir_comunicado(comunicado_id):
-    global comunicados_lista
+    comunicado = Comunicado.query.get(comunicado_id)
 
-    # procura o comunicado na lista (memória)
-    idx = next((i for i, c in enumerate(comunicados_lista) if int(c.get("id", 0)) == comunicado_id), None)
-
-    if idx is None:
+    if comunicado is None:
         flash("❌ Comunicado não encontrado.", "danger")
         return redirect(url_for("admin_comunicados"))
 
-    comunicado = comunicados_lista[idx]
-
     # se tiver PDF, tenta apagar o arquivo também
-    pdf_nome = comunicado.get("pdf")
+    pdf_nome = comunicado.pdf
     if pdf_nome:
         try:
             caminho = os.path.join(UPLOAD_COMUNICADOS, pdf_nome)
             if os.path.exists(caminho):
                 os.remove(caminho)
         except Exception:
-            # falhou apagar o arquivo, mas ainda apaga o comunicado da lista
+            # falhou apagar o arquivo, mas ainda apaga o comunicado
             pass
 
-    # remove da lista
-    comunicados_lista.pop(idx)
+    db.session.delete(comunicado)
+    db.session.commit()
 
     flash("✅ Comunicado excluído com sucesso!", "success")
     return redirect(url_for("admin_comunicados"))
@@ -440,19 +840,6 @@ def _get_escala_mes_by_date(data_ref: date, setor: str | None = None):
         q = q.filter(EscalaMes.setor == setor)
     return q.order_by(EscalaMes.id.desc()).first()
 
-def _get_item_do_dia(escala_mes_id: int, funcionario_id: int, d: date):
-    inicio_dia = datetime.combine(d, time(0, 0))
-    fim_dia = inicio_dia + timedelta(days=1)
-
-    return (
-        EscalaItem.query
-        .filter(EscalaItem.escala_mes_id == escala_mes_id)
-        .filter(EscalaItem.funcionario_id == funcionario_id)
-        .filter(EscalaItem.inicio >= inicio_dia)
-        .filter(EscalaItem.inicio < fim_dia)
-        .first()
-    )
-
 def _criar_item_padrao(escala_mes_id: int, funcionario_id: int, d: date, tipo="FOLGA"):
     # padrão seguro: cria folga no dia
     ini = datetime.combine(d, time(0, 0))
@@ -522,19 +909,20 @@ def trocas_plantao_nova():
     uid = session["user_id"]
     user = Funcionario.query.get(uid)
 
-    # lista de possíveis substitutos (ativos e diferentes do solicitante)
-    substitutos = (
-        Funcionario.query
-        .filter(Funcionario.status == "Ativo", Funcionario.id != uid)
-        .order_by(Funcionario.nome)
-        .all()
-    )
+    # possíveis substitutos (ativos e diferentes do solicitante): só as primeiras, o resto pela busca
+    substitutos = buscar_funcionarios(excluir_id=uid, so_ativos=True)
 
     if request.method == "POST":
-        substituto_id = int(request.form.get("substituto_id"))
+        substituto_id = request.form.get("substituto_id", type=int)
         data_str = (request.form.get("data") or "").strip()
         motivo = (request.form.get("motivo") or "").strip()
 
+        # a lista da tela não tem todo mundo: confere no diretório
+        substituto = obter_diretorio()["por_id"].get(substituto_id)
+        if not substituto or substituto["id"] == uid or substituto["status"] != "Ativo":
+            flash("❌ Escolha um substituto ativo.", "danger")
+            return redirect(url_for("trocas_plantao_nova"))
+
         d = parse_date_yyyy_mm_dd(data_str)
         if not d:
             flash("❌ Data inválida.", "danger")
@@ -555,6 +943,22 @@ def trocas_plantao_nova():
         db.session.add(nova)
         db.session.commit()
 
+        notificar_direcao("notificacao", {
+            "tipo": "troca_nova",
+            "id": nova.id,
+            "texto": f"🔁 Nova troca de plantão: {user.nome if user else ''} ({d.strftime('%d/%m/%Y')})",
+            "url": url_for("admin_trocas_plantao"),
+        })
+        notificar([substituto_id], "notificacao", {
+            "tipo": "troca",
+            "id": nova.id,
+            "status": nova.status,
+            "texto": f"🔁 {user.nome if user else 'Um colega'} pediu troca com você em {d.strftime('%d/%m/%Y')}",
+            "url": url_for("trocas_plantao"),
+        })
+        enviar_contadores([uid, substituto_id])
+        enviar_contadores_direcao()
+
         flash("✅ Solicitação de troca enviada para a Direção.", "success")
         return redirect(url_for("trocas_plantao"))
 
@@ -583,6 +987,9 @@ def trocas_plantao_cancelar(troca_id):
     t.decidido_em = datetime.utcnow()
     db.session.commit()
 
+    enviar_contadores([t.solicitante_id, t.substituto_id])
+    enviar_contadores_direcao()
+
     flash("✅ Solicitação cancelada.", "success")
     return redirect(url_for("trocas_plantao"))
 
@@ -622,52 +1029,137 @@ def admin_trocas_plantao():
 
 
 # -------------------------
-# Direção: aprovar (troca na escala)
+# Direção: decidir trocas (1 ou várias, 1 transação)
 # -------------------------
-@app.route("/admin/trocas-plantao/<int:troca_id>/aprovar", methods=["POST"])
-@login_required
-@direcao_required
-def admin_trocas_plantao_aprovar(troca_id):
-    t = TrocaPlantao.query.get_or_404(troca_id)
-
-    if t.status != "PENDENTE":
-        flash("❌ Essa solicitação não está mais pendente.", "danger")
-        return redirect(url_for("admin_trocas_plantao"))
-
-    obs = (request.form.get("observacao") or "").strip()
+TROCA_MSG_ERRO = {
+    "nao_encontrada": "Solicitação não encontrada.",
+    "nao_pendente": "Essa solicitação não está mais pendente.",
+    "sem_escala": "Não foi encontrada uma escala para esse mês. Gere a escala primeiro.",
+    "erro": "Erro ao aplicar na escala. Verifique os logs.",
+}
+
+def decidir_trocas(troca_ids, acao: str, observacao: str | None = None, decidido_por_id=None):
+    """
+    Aprova ("aprovar") ou recusa ("recusar") várias trocas de uma vez.
+    - 1 SELECT das trocas, 1 SELECT de todos os itens de escala envolvidos
+      (escala IN, funcionário IN, faixa de dias), trocas aplicadas em memória
+      na ordem em que foram pedidas, 1 bump de versão por escala e 1 commit
+    - retorna [{"id", "ok", "status" | "erro"}] na ordem de troca_ids
+    """
+    troca_ids = list(dict.fromkeys(int(i) for i in troca_ids))
+    trocas = {t.id: t for t in TrocaPlantao.query.filter(TrocaPlantao.id.in_(troca_ids))} if troca_ids else {}
+
+    resultados = {}
+    validas = []
+    for tid in troca_ids:
+        t = trocas.get(tid)
+        if not t:
+            resultados[tid] = {"id": tid, "ok": False, "erro": "nao_encontrada"}
+        elif t.status != "PENDENTE":
+            resultados[tid] = {"id": tid, "ok": False, "erro": "nao_pendente"}
+        elif acao == "aprovar" and not t.escala_mes_id:
+            resultados[tid] = {"id": tid, "ok": False, "erro": "sem_escala"}
+        else:
+            validas.append(t)
 
-    # precisa de escala para efetivar a troca
-    if not t.escala_mes_id:
-        flash("❌ Não foi encontrada uma escala para esse mês. Gere a escala primeiro.", "danger")
-        return redirect(url_for("admin_trocas_plantao"))
+    # mesma ordem de quando os pedidos chegaram (trocas no mesmo dia se encadeiam)
+    validas.sort(key=lambda t: (t.criado_em or datetime.min, t.id))
 
+    agora = datetime.utcnow()
+    celulas = {}
     try:
-        # pega/garante itens do dia para ambos
-        item_a = _get_item_do_dia(t.escala_mes_id, t.solicitante_id, t.data)
-        item_b = _get_item_do_dia(t.escala_mes_id, t.substituto_id, t.data)
-
-        if not item_a:
-            item_a = _criar_item_padrao(t.escala_mes_id, t.solicitante_id, t.data, tipo="FOLGA")
-        if not item_b:
-            item_b = _criar_item_padrao(t.escala_mes_id, t.substituto_id, t.data, tipo="FOLGA")
-
-        # troca efetivamente
-        _swap_items(item_a, item_b)
-
-        # marca como aprovada
-        t.status = "APROVADA"
-        t.decidido_em = datetime.utcnow()
-        t.decidido_por_id = session.get("user_id")
-        t.observacao_direcao = obs or None
+        if acao == "aprovar" and validas:
+            escala_ids = {t.escala_mes_id for t in validas}
+            fids = {t.solicitante_id for t in validas} | {t.substituto_id for t in validas}
+            ini = datetime.combine(min(t.data for t in validas), time(0, 0))
+            fim = datetime.combine(max(t.data for t in validas), time(0, 0)) + timedelta(days=1)
+
+            # dia sem item gravado: o tipo vem da grade (regra da escala); sem nada, FOLGA
+            grades = {i: obter_grade(i) for i in escala_ids}
+
+            itens = {}
+            for it in (
+                EscalaItem.query
+                .filter(EscalaItem.escala_mes_id.in_(escala_ids))
+                .filter(EscalaItem.funcionario_id.in_(fids))
+                .filter(EscalaItem.inicio >= ini)
+                .filter(EscalaItem.inicio < fim)
+                .order_by(EscalaItem.inicio)
+            ):
+                itens.setdefault((it.escala_mes_id, it.funcionario_id, it.inicio.date()), it)
+
+            def item_do_dia(escala_mes_id, funcionario_id, d):
+                # após a troca o item segue do mesmo funcionário e no mesmo dia (só tipo/horário mudam)
+                chave = (escala_mes_id, funcionario_id, d)
+                if chave not in itens:
+                    grade = grades[escala_mes_id]
+                    li = grade["linha"].get(funcionario_id) if grade else None
+                    cod = int(grade["matriz"][li, d.day - 1]) if li is not None else escala_grid.VAZIO
+                    tipo = escala_grid.TIPOS[cod] or "FOLGA"
+                    itens[chave] = _criar_item_padrao(escala_mes_id, funcionario_id, d, tipo=tipo)
+                return itens[chave]
+
+            for t in validas:
+                item_a = item_do_dia(t.escala_mes_id, t.solicitante_id, t.data)
+                item_b = item_do_dia(t.escala_mes_id, t.substituto_id, t.data)
+                _swap_items(item_a, item_b)
+                item_a.fixado = True
+                item_b.fixado = True
+                celulas[(t.escala_mes_id, t.solicitante_id, t.data.day)] = item_a
+                celulas[(t.escala_mes_id, t.substituto_id, t.data.day)] = item_b
+
+            _bump_versao_escala(escala_mes_ids=escala_ids)
+
+        novo_status = "APROVADA" if acao == "aprovar" else "RECUSADA"
+        for t in validas:
+            t.status = novo_status
+            t.decidido_em = agora
+            t.decidido_por_id = decidido_por_id
+            t.observacao_direcao = observacao or None
+            resultados[t.id] = {"id": t.id, "ok": True, "status": novo_status}
 
         db.session.commit()
-        flash("✅ Troca aprovada e aplicada na escala.", "success")
-
     except Exception as e:
         db.session.rollback()
-        print("❌ Erro ao aprovar troca:", e)
-        flash("❌ Erro ao aprovar troca. Verifique os logs.", "danger")
+        print("❌ Erro ao decidir trocas:", e)
+        for t in validas:
+            resultados[t.id] = {"id": t.id, "ok": False, "erro": "erro"}
+        return [resultados[tid] for tid in troca_ids]
+
+    por_escala = defaultdict(list)
+    for (escala_mes_id, fid, dia), item in celulas.items():
+        por_escala[escala_mes_id].append((fid, dia, item.tipo))
+    for escala_mes_id, lista in por_escala.items():
+        _grade_cache_patch(escala_mes_id, lista)
+
+    if validas:
+        notificar_trocas(validas)
+
+    return [resultados[tid] for tid in troca_ids]
+
+def _flash_decisao(resultados, acao: str):
+    ok = sum(1 for r in resultados if r["ok"])
+    if ok:
+        if acao == "aprovar":
+            flash(f"✅ {ok} troca(s) aprovada(s) e aplicada(s) na escala.", "success")
+        else:
+            flash(f"✅ {ok} solicitação(ões) recusada(s).", "success")
+    for r in resultados:
+        if not r["ok"]:
+            flash(f"❌ Troca #{r['id']}: {TROCA_MSG_ERRO[r['erro']]}", "danger")
+
+# -------------------------
+# Direção: aprovar (troca na escala)
+# -------------------------
+@app.route("/admin/trocas-plantao/<int:troca_id>/aprovar", methods=["POST"])
+@login_required
+@direcao_required
+def admin_trocas_plantao_aprovar(troca_id):
+    TrocaPlantao.query.get_or_404(troca_id)
+    obs = (request.form.get("observacao") or "").strip()
 
+    resultados = decidir_trocas([troca_id], "aprovar", obs, session.get("user_id"))
+    _flash_decisao(resultados, "aprovar")
     return redirect(url_for("admin_trocas_plantao"))
 
 
@@ -678,326 +1170,278 @@ def admin_trocas_plantao_aprovar(troca_id):
 @login_required
 @direcao_required
 def admin_trocas_plantao_recusar(troca_id):
-    t = TrocaPlantao.query.get_or_404(troca_id)
-
-    if t.status != "PENDENTE":
-        flash("❌ Essa solicitação não está mais pendente.", "danger")
-        return redirect(url_for("admin_trocas_plantao"))
-
+    TrocaPlantao.query.get_or_404(troca_id)
     obs = (request.form.get("observacao") or "").strip()
 
-    t.status = "RECUSADA"
-    t.decidido_em = datetime.utcnow()
-    t.decidido_por_id = session.get("user_id")
-    t.observacao_direcao = obs or None
-
-    db.session.commit()
-    flash("✅ Solicitação recusada.", "success")
+    resultados = decidir_trocas([troca_id], "recusar", obs, session.get("user_id"))
+    _flash_decisao(resultados, "recusar")
     return redirect(url_for("admin_trocas_plantao"))
 
-#===================================================
-#ESCALA PDF
-#===================================================
-@app.get("/admin/escalas/<int:escala_mes_id>/pdf")
+
+# -------------------------
+# Direção: decidir em lote
+# -------------------------
+@app.route("/admin/trocas-plantao/lote", methods=["POST"])
 @login_required
 @direcao_required
-def admin_escala_mes_pdf(escala_mes_id):
-    escala = EscalaMes.query.get_or_404(escala_mes_id)
-
-    # pega itens
-    itens = (
-        EscalaItem.query
-        .filter_by(escala_mes_id=escala.id)
-        .order_by(EscalaItem.funcionario_id.asc(), EscalaItem.inicio.asc())
-        .all()
-    )
-
-    # mapa funcionario -> {dia: tipo}
-    por_func_dia = {}
-    func_ids = sorted(set(i.funcionario_id for i in itens))
+def admin_trocas_plantao_lote():
+    """
+    Form: troca_ids (vários), acao=aprovar|recusar, observacao.
+    JSON: {"ids": [...], "acao": "...", "observacao": "..."} -> resultado por troca.
+    """
+    if request.is_json:
+        dados = request.get_json(silent=True) or {}
+        ids = dados.get("ids") or []
+        acao = (dados.get("acao") or "").strip().lower()
+        obs = (dados.get("observacao") or "").strip()
+    else:
+        ids = request.form.getlist("troca_ids")
+        acao = (request.form.get("acao") or "").strip().lower()
+        obs = (request.form.get("observacao") or "").strip()
 
-    funcionarios = (
-        Funcionario.query
-        .filter(Funcionario.id.in_(func_ids))
-        .order_by(Funcionario.nome)
-        .all()
-    )
-    func_map = {f.id: f for f in funcionarios}
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        ids = None
+
+    if acao not in ("aprovar", "recusar") or not ids:
+        if request.is_json:
+            return {"ok": False, "error": "Informe as trocas e a ação (aprovar/recusar)."}, 400
+        flash("❌ Selecione ao menos uma solicitação.", "danger")
+        return redirect(url_for("admin_trocas_plantao"))
 
-    for it in itens:
-        dia = int(it.inicio.strftime("%d"))
-        por_func_dia.setdefault(it.funcionario_id, {})[dia] = it.tipo
+    t0 = perf_counter()
+    resultados = decidir_trocas(ids, acao, obs, session.get("user_id"))
+    print(f"🔁 Trocas em lote ({acao}): {len(ids)} em {perf_counter() - t0:.3f}s")
 
-    # agrupa por equipe (igual você já faz no HTML)
-    por_equipe = {}
-    for fid in func_ids:
-        f = func_map.get(fid)
-        equipe = (getattr(f, "equipe", None) or "SEM EQUIPE").strip().upper()
-        por_equipe.setdefault(equipe, []).append(fid)
+    if request.is_json:
+        return {"ok": True, "resultados": resultados}
 
-    # ordena nomes dentro da equipe
-    for eq in por_equipe:
-        por_equipe[eq] = sorted(
-            por_equipe[eq],
-            key=lambda x: (func_map.get(x).nome or "").upper() if func_map.get(x) else ""
-        )
+    _flash_decisao(resultados, acao)
+    return redirect(url_for("admin_trocas_plantao"))
 
-    # ordena equipes (EQUIPE 1..N, SEM EQUIPE por último)
-    def ordem_equipe(nome):
-        n = (nome or "").upper().strip()
-        if n == "SEM EQUIPE":
-            return (999, n)
-        num = "".join(ch for ch in n if ch.isdigit())
-        return (int(num) if num else 500, n)
+#===================================================
+#ESCALA PDF
+#===================================================
+# ==================================================
+# CACHE EM DISCO DOS PDFs DE ESCALA (POR VERSÃO)
+# ==================================================
+# Arquivo: escala_<id>_v<versao>.pdf. A versão (EscalaMes.versao) sobe a
+# cada alteração de itens/equipes, então arquivo existente = PDF atual.
+
+ESCALA_PDF_CACHE_DIR = os.getenv("ESCALA_PDF_CACHE_DIR", os.path.join(app.instance_path, "cache", "escalas_pdf"))
+ESCALA_PDF_CACHE_MAX_MB = float(os.getenv("ESCALA_PDF_CACHE_MAX_MB", "200"))
+ESCALA_PDF_CACHE_MAX_DIAS = float(os.getenv("ESCALA_PDF_CACHE_MAX_DIAS", "30"))
+os.makedirs(ESCALA_PDF_CACHE_DIR, exist_ok=True)
+
+_pdf_cache_stats = {"hits": 0, "misses": 0, "removidos": 0}
+
+def _pdf_cache_path(escala_mes_id: int, versao: int):
+    return os.path.join(ESCALA_PDF_CACHE_DIR, f"escala_{escala_mes_id}_v{versao}.pdf")
+
+def _pdf_cache_remover_escala(escala_mes_id: int, manter: str | None = None):
+    # apaga as versões antigas (ou todas) de uma escala
+    prefixo = f"escala_{escala_mes_id}_v"
+    for nome in os.listdir(ESCALA_PDF_CACHE_DIR):
+        caminho = os.path.join(ESCALA_PDF_CACHE_DIR, nome)
+        if nome.startswith(prefixo) and caminho != manter:
+            try:
+                os.remove(caminho)
+                _pdf_cache_stats["removidos"] += 1
+            except OSError:
+                pass
+
+def _pdf_cache_podar(diretorio=None, max_mb=None, max_dias=None, stats=None):
+    # remove por idade e depois os mais antigos até caber no limite de tamanho
+    diretorio = diretorio or ESCALA_PDF_CACHE_DIR
+    max_mb = ESCALA_PDF_CACHE_MAX_MB if max_mb is None else max_mb
+    max_dias = ESCALA_PDF_CACHE_MAX_DIAS if max_dias is None else max_dias
+    stats = _pdf_cache_stats if stats is None else stats
+
+    agora = datetime.now().timestamp()
+    arquivos = []
+    for nome in os.listdir(diretorio):
+        if not nome.endswith(".pdf"):
+            continue
+        caminho = os.path.join(diretorio, nome)
+        try:
+            st = os.stat(caminho)
+        except OSError:
+            continue
+        arquivos.append((st.st_mtime, st.st_size, caminho))
 
-    equipes_ordenadas = sorted(por_equipe.keys(), key=ordem_equipe)
+    arquivos.sort()
+    total = sum(a[1] for a in arquivos)
+    limite = max_mb * 1024 * 1024
 
-    # dias do mês
-    dias_no_mes = calendar.monthrange(escala.ano, escala.mes)[1]
-    dias = list(range(1, dias_no_mes + 1))
+    for mtime, tamanho, caminho in arquivos:
+        velho = (agora - mtime) > max_dias * 86400
+        if not velho and total <= limite:
+            break
+        try:
+            os.remove(caminho)
+            stats["removidos"] += 1
+            total -= tamanho
+        except OSError:
+            pass
 
-    # ==========================
-    # PDF (modelo grade)
-    # ==========================
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=landscape(A4))
-    W, H = landscape(A4)
-
-    # ==========================
-    # LOGOS (corrigido para pegar .png/.jpg/.jpeg)
-    # Seus arquivos estão em: static/img/logo_hospital.jpeg e static/img/logo_prefeitura.png
-    # ==========================
-    def _find_logo(*paths):
-        for p in paths:
-            if p and os.path.exists(p):
-                return p
-        return None
+def obter_pdf_escala(escala: EscalaMes):
+    """
+    Caminho do PDF da escala na versão atual (gera e grava se não existir).
+    Retorna (caminho, hit).
+    """
+    caminho = _pdf_cache_path(escala.id, escala.versao or 0)
+    if os.path.exists(caminho):
+        _pdf_cache_stats["hits"] += 1
+        return caminho, True
 
-    logo_pref = _find_logo(
-        os.path.join(BASE_DIR, "static", "img", "logo_prefeitura.png"),
-        os.path.join(BASE_DIR, "static", "img", "logo_prefeitura.jpg"),
-        os.path.join(BASE_DIR, "static", "img", "logo_prefeitura.jpeg"),
-    )
-    logo_hosp = _find_logo(
-        os.path.join(BASE_DIR, "static", "img", "logo_hospital.png"),
-        os.path.join(BASE_DIR, "static", "img", "logo_hospital.jpg"),
-        os.path.join(BASE_DIR, "static", "img", "logo_hospital.jpeg"),
-    )
+    _pdf_cache_stats["misses"] += 1
+    grade = obter_grade(escala.id)
+    return _pdf_cache_gravar(escala, pdf_layout.gerar_pdf_escala(grade)), False
 
-    # layout
-    margin = 20
-    top = H - margin
+def _pdf_cache_gravar(escala: EscalaMes, conteudo: bytes):
+    caminho = _pdf_cache_path(escala.id, escala.versao or 0)
 
-    # --- Cabeçalho com logos e títulos ---
-    header_h = 60
-    c.setLineWidth(1)
+    # grava em arquivo temporário e troca (nunca serve PDF pela metade)
+    tmp = f"{caminho}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(conteudo)
+    os.replace(tmp, caminho)
 
-    # textos
-    setor_txt = (escala.setor or "TODOS").upper()
+    _pdf_cache_remover_escala(escala.id, manter=caminho)
+    _pdf_cache_podar()
+    return caminho
 
-    # logos (com try pra não quebrar se der algum erro de leitura)
-    try:
-        if logo_pref:
-            c.drawImage(
-                ImageReader(logo_pref),
-                margin, top - 50, 45, 45,
-                preserveAspectRatio=True,
-                mask="auto"
-            )
-    except Exception as e:
-        print("⚠️ Erro logo prefeitura:", e)
+def _nome_pdf_escala(escala):
+    return f"escala_grade_{escala.ano}_{escala.mes:02d}_{(escala.setor or 'todos').replace(' ', '_')}.pdf"
 
-    try:
-        if logo_hosp:
-            c.drawImage(
-                ImageReader(logo_hosp),
-                W - margin - 45, top - 50, 45, 45,
-                preserveAspectRatio=True,
-                mask="auto"
-            )
-    except Exception as e:
-        print("⚠️ Erro logo hospital:", e)
-
-    c.setFont("Helvetica-Bold", 12)
-    c.drawCentredString(W / 2, top - 18, "SECRETARIA MUNICIPAL DE SAÚDE DE CABO FRIO")
-    c.setFont("Helvetica-Bold", 14)
-    c.drawCentredString(W / 2, top - 36, "HOSPITAL MUNICIPAL DA MULHER")
-
-    c.setFont("Helvetica", 10)
-    c.drawCentredString(W / 2, top - 52, f"ESCALA — {escala.mes:02d}/{escala.ano} — SETOR: {setor_txt}")
-
-    y = top - header_h - 10
-
-    # --- Tabela (grade) ---
-    # coluna nome + CH + vínculo (igual sua planilha)
-    col_nome_w = 220
-    col_ch_w = 45
-    col_vinc_w = 80
-    grid_x = margin
-    grid_w = W - margin * 2
-
-    # largura para dias
-    dias_area_w = grid_w - (col_nome_w + col_ch_w + col_vinc_w)
-    cell_w = max(12, dias_area_w / max(len(dias), 1))  # garante mínimo
-    row_h = 16
-    header_row_h = 18
-
-    def draw_table_header(y0):
-        # linha header (NOME/CH/VÍNCULO + dias)
-        c.setFont("Helvetica-Bold", 8)
-        c.setFillGray(0.95)
-        c.rect(grid_x, y0 - header_row_h, grid_w, header_row_h, fill=1, stroke=1)
-        c.setFillGray(0)
-
-        x = grid_x
-        c.drawString(x + 4, y0 - 13, "NOME DO FUNCIONÁRIO(A)")
-        x += col_nome_w
-        c.drawString(x + 4, y0 - 13, "CH")
-        x += col_ch_w
-        c.drawString(x + 4, y0 - 13, "VÍNCULO")
-        x += col_vinc_w
-
-        for d in dias:
-            c.drawCentredString(x + cell_w / 2, y0 - 13, f"{d:02d}")
-            x += cell_w
-
-    def cell_label(tipo):
-        if tipo == "PLANTAO_24H":
-            return "24H"
-        if tipo == "EXPEDIENTE":
-            return "X"
-        if tipo == "FOLGA":
-            return "F"
-        return ""
+def _bump_versao_escala(escala_mes_ids=None, funcionario_ids=None):
+    """
+    Sobe EscalaMes.versao (invalida PDFs em cache). Não faz commit.
+    - escala_mes_ids: escalas alteradas diretamente
+    - funcionario_ids: escalas em que esses funcionários aparecem (nome/equipe mudou)
+    """
+    tabela = EscalaMes.__table__
+    if escala_mes_ids:
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.id.in_(list(escala_mes_ids)))
+            .values(versao=tabela.c.versao + 1)
+        )
+    if funcionario_ids:
+        sub_itens = (
+            db.select(EscalaItem.escala_mes_id)
+            .where(EscalaItem.funcionario_id.in_(list(funcionario_ids)))
+            .distinct()
+        )
+        sub_regras = (
+            db.select(EscalaRegra.escala_mes_id)
+            .where(EscalaRegra.funcionario_id.in_(list(funcionario_ids)))
+            .distinct()
+        )
+        db.session.execute(
+            tabela.update()
+            .where(db.or_(tabela.c.id.in_(sub_itens), tabela.c.id.in_(sub_regras)))
+            .values(versao=tabela.c.versao + 1)
+        )
 
-    def draw_page_header():
-        top2 = H - margin
+@app.get("/admin/cache/status")
+@login_required
+@direcao_required
+def admin_cache_status():
+    return {
+        "grades": {**_grade_cache_stats, "itens": len(_grade_cache), "max": ESCALA_CACHE_MAX},
+        "pdf_escalas": {**_pdf_cache_stats, "dir": ESCALA_PDF_CACHE_DIR},
+        "pdf_relatorios": {**_relatorio_cache_stats, "dir": RELATORIO_PDF_CACHE_DIR},
+        "cobertura": {**_cobertura_stats, "itens": len(_cobertura_cache), "max": COBERTURA_CACHE_MAX},
+        "chat_gravacao": {
+            **_fila_chat_stats,
+            "pendentes": len(_fila_chat),
+            "assincrona": CHAT_GRAVACAO_ASSINCRONA,
+            "intervalo_ms": CHAT_GRAVACAO_INTERVALO_MS,
+            "lote": CHAT_GRAVACAO_LOTE,
+            "tentativas": CHAT_GRAVACAO_TENTATIVAS,
+            "arquivo_falhas": CHAT_FALHAS_ARQUIVO,
+        },
+        "chat_limpeza": {
+            **_chat_limpeza_stats,
+            "ativa": _chat_limpeza_tarefa is not None,
+            "intervalo_s": CHAT_LIMPEZA_INTERVALO_S,
+        },
+        "chat_anexos": {
+            **_anexos_stats,
+            "max_lado": CHAT_IMAGEM_MAX_LADO,
+            "miniatura_lado": CHAT_MINIATURA_LADO,
+            "dir_miniaturas": CHAT_MINIATURAS_DIR,
+        },
+        "presenca": {
+            **_presenca_stats,
+            "worker": _WORKER_ID,
+            "online": len(usuarios_online()),
+            "digitando": {**_digitando_stats, "intervalo_ms": CHAT_DIGITANDO_INTERVALO_MS},
+        },
+        "notificacoes": dict(_notificacoes_stats),
+        "diretorio": {
+            **_diretorio_stats,
+            "versao": _diretorio["versao"],
+            "funcionarios": len(_diretorio["pessoas"]),
+            "verificar_s": DIRETORIO_VERIFICAR_S,
+        },
+        "plantao": {
+            **{k: v for k, v in _indice_plantao_stats.items() if k != "invalidado"},
+            "janelas": [f"{de:%m/%Y}–{ate:%m/%Y}" for de, ate in _indices_plantao],
+        },
+    }
 
-        # logos
-        try:
-            if logo_pref:
-                c.drawImage(ImageReader(logo_pref), margin, top2 - 50, 45, 45,
-                            preserveAspectRatio=True, mask="auto")
-        except Exception as e:
-            print("⚠️ Erro logo prefeitura (nova pág):", e)
+@app.get("/admin/escalas/<int:escala_mes_id>/pdf")
+@login_required
+@direcao_required
+def admin_escala_mes_pdf(escala_mes_id):
+    escala = EscalaMes.query.get_or_404(escala_mes_id)
 
-        try:
-            if logo_hosp:
-                c.drawImage(ImageReader(logo_hosp), W - margin - 45, top2 - 50, 45, 45,
-                            preserveAspectRatio=True, mask="auto")
-        except Exception as e:
-            print("⚠️ Erro logo hospital (nova pág):", e)
-
-        c.setFont("Helvetica-Bold", 12)
-        c.drawCentredString(W / 2, top2 - 18, "SECRETARIA MUNICIPAL DE SAÚDE DE CABO FRIO")
-        c.setFont("Helvetica-Bold", 14)
-        c.drawCentredString(W / 2, top2 - 36, "HOSPITAL MUNICIPAL DA MULHER")
-        c.setFont("Helvetica", 10)
-        c.drawCentredString(W / 2, top2 - 52, f"ESCALA — {escala.mes:02d}/{escala.ano} — SETOR: {setor_txt}")
-
-        return top2 - header_h - 10
-
-    def ensure_page_space(next_rows=1):
-        nonlocal y
-        min_y = margin + 30
-        if y - (next_rows * row_h) < min_y:
-            c.showPage()
-            y = draw_page_header()
-            draw_table_header(y)
-            y -= header_row_h
-
-    # desenha header tabela
-    draw_table_header(y)
-    y -= header_row_h
-
-    # --- Conteúdo por equipe ---
-    for equipe_nome in equipes_ordenadas:
-        ensure_page_space(next_rows=2)
-
-        # faixa da equipe (estilo planilha)
-        c.setFillGray(0.85)
-        c.rect(grid_x, y - row_h, grid_w, row_h, fill=1, stroke=1)
-        c.setFillGray(0)
-        c.setFont("Helvetica-Bold", 9)
-        c.drawString(grid_x + 6, y - 12, f"{equipe_nome} — SETOR: {setor_txt}")
-        y -= row_h
-
-        # linhas dos funcionários
-        for fid in por_equipe[equipe_nome]:
-            ensure_page_space(next_rows=1)
-
-            f = func_map.get(fid)
-            nome = (f.nome if f else "FUNCIONÁRIO").upper()
-            ch = (f.carga_horaria or "").upper() if f else ""
-            vinc = (f.tipo_vinculo or "").upper() if f else ""
-
-            # fundo branco
-            c.setFillGray(1)
-            c.rect(grid_x, y - row_h, grid_w, row_h, fill=1, stroke=1)
-            c.setFillGray(0)
-
-            # colunas fixas
-            c.setFont("Helvetica", 8)
-            x = grid_x
-
-            # nome
-            c.drawString(x + 4, y - 12, nome[:42])
-            x += col_nome_w
-
-            # CH
-            c.drawCentredString(x + col_ch_w / 2, y - 12, ch[:6])
-            x += col_ch_w
-
-            # vínculo
-            c.drawString(x + 4, y - 12, vinc[:12])
-            x += col_vinc_w
-
-            # dias
-            mapa_dias = por_func_dia.get(fid, {})
-            c.setFont("Helvetica-Bold", 7)
-
-            for d in dias:
-                dow = date(escala.ano, escala.mes, d).weekday()  # 5=sab, 6=dom
-                if dow >= 5:
-                    c.setFillGray(0.96)
-                    c.rect(x, y - row_h, cell_w, row_h, fill=1, stroke=1)
-                    c.setFillGray(0)
-                else:
-                    c.rect(x, y - row_h, cell_w, row_h, fill=0, stroke=1)
-
-                tipo = mapa_dias.get(d)
-                lab = cell_label(tipo)
-                if lab:
-                    c.drawCentredString(x + cell_w / 2, y - 12, lab)
-
-                x += cell_w
-
-            y -= row_h
-
-        # espaçador entre equipes
-        y -= 4
-
-    c.save()
-    buffer.seek(0)
+    caminho, hit = obter_pdf_escala(escala)
+    print(f"📄 PDF escala {escala.id} v{escala.versao or 0}: {'HIT' if hit else 'MISS'} {_pdf_cache_stats}")
 
-    filename = f"escala_grade_{escala.ano}_{escala.mes:02d}_{(escala.setor or 'todos').replace(' ', '_')}.pdf"
-    return send_file(buffer, as_attachment=True, download_name=filename, mimetype="application/pdf")
+    resp = send_file(
+        caminho,
+        as_attachment=True,
+        download_name=_nome_pdf_escala(escala),
+        mimetype="application/pdf",
+        conditional=True,
+        etag=f"escala-{escala.id}-v{escala.versao or 0}",
+        max_age=0
+    )
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.headers["X-Cache"] = "HIT" if hit else "MISS"
+    return resp
 # ==================================================
 # CURSOS FUNCIONÁRIO
 # ==================================================
 
+def _cursos_concluidos(funcionario_id):
+    return {
+        cid for (cid,) in db.session.query(ConclusaoCurso.curso_id)
+        .filter(ConclusaoCurso.funcionario_id == funcionario_id)
+    }
+
 @app.route("/meus-cursos")
 @login_required
 @funcionario_required
 def meus_cursos():
-    lista = []
+    feitos = _cursos_concluidos(session["user_id"])
 
-    for curso in cursos_lista:
-        status = "Pendente"
-        for c in conclusoes:
-            if c["user_id"] == session["user_id"] and c["curso_id"] == curso["id"]:
-                status = "Realizado"
-        lista.append({**curso, "status": status})
+    lista = []
+    for curso in Curso.query.order_by(Curso.id).all():
+        lista.append({
+            "id": curso.id,
+            "titulo": curso.titulo,
+            "descricao": curso.descricao,
+            "video": curso.video,
+            "pdf": curso.pdf,
+            "carga": curso.carga,
+            "data": curso.data,
+            "status": "Realizado" if curso.id in feitos else "Pendente",
+        })
 
     return render_template("meus_cursos.html", cursos=lista)
 
@@ -1010,20 +1454,22 @@ def meus_cursos():
 @funcionario_required
 def concluir_curso(id):
     user = Funcionario.query.get(session["user_id"])
-    curso = next((c for c in cursos_lista if c["id"] == id), None)
+    curso = Curso.query.get(id)
 
     if not curso:
         return "Curso não encontrado"
 
-    if not any(
-        c for c in conclusoes
-        if c["user_id"] == user.id and c["curso_id"] == id
-    ):
-        conclusoes.append({
-            "user_id": user.id,
-            "curso_id": id,
-            "data": date.today().strftime("%d/%m/%Y")
-        })
+    if not ConclusaoCurso.query.filter_by(funcionario_id=user.id, curso_id=id).first():
+        db.session.add(ConclusaoCurso(
+            funcionario_id=user.id,
+            curso_id=id,
+            data=date.today().strftime("%d/%m/%Y")
+        ))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # duplo clique / outro worker gravou a mesma conclusão antes
+            db.session.rollback()
 
     return gerar_certificado_pdf(user, curso)
 
@@ -1035,15 +1481,14 @@ def concluir_curso(id):
 @login_required
 @funcionario_required
 def meu_progresso():
-    total = sum(int(c["carga"]) for c in cursos_lista) if cursos_lista else 0
+    feitos = _cursos_concluidos(session["user_id"])
+    total = 0
     feito = 0
 
-    for curso in cursos_lista:
-        if any(
-            c for c in conclusoes
-            if c["user_id"] == session["user_id"] and c["curso_id"] == curso["id"]
-        ):
-            feito += int(curso["carga"])
+    for curso in Curso.query.all():
+        total += int(curso.carga)
+        if curso.id in feitos:
+            feito += int(curso.carga)
 
     progresso = int((feito / total) * 100) if total else 0
 
@@ -1064,15 +1509,19 @@ def meu_progresso():
 def meus_certificados():
     lista = []
 
-    for c in conclusoes:
-        if c["user_id"] == session["user_id"]:
-            curso = next((x for x in cursos_lista if x["id"] == c["curso_id"]), None)
-            if curso:
-                lista.append({
-                    "curso": curso["titulo"],
-                    "data": c["data"],
-                    "id": curso["id"]
-                })
+    conclusoes = (
+        db.session.query(ConclusaoCurso.data, Curso.id, Curso.titulo)
+        .join(Curso, Curso.id == ConclusaoCurso.curso_id)
+        .filter(ConclusaoCurso.funcionario_id == session["user_id"])
+        .order_by(ConclusaoCurso.id)
+        .all()
+    )
+    for data_str, curso_id, titulo in conclusoes:
+        lista.append({
+            "curso": titulo,
+            "data": data_str,
+            "id": curso_id
+        })
 
     return render_template("meus_certificados.html", certificados=lista)
 
@@ -1146,8 +1595,8 @@ def admin_dashboard():
         total_funcionarios=len(funcionarios),
         ativos=len([f for f in funcionarios if f.status == "Ativo"]),
         inativos=len([f for f in funcionarios if f.status == "Inativo"]),
-        total_cursos=len(cursos_lista),
-        total_comunicados=len(comunicados_lista)
+        total_cursos=Curso.query.count(),
+        total_comunicados=Comunicado.query.count()
     )
 
 # ==================================================
@@ -1198,14 +1647,12 @@ def admin_graficos():
 
     if escala:
         escala_titulo = f"Itens da escala — {escala.mes:02d}/{escala.ano} — {escala.setor or 'TODOS'}"
-        por_tipo = (
-            db.session.query(EscalaItem.tipo, db.func.count(EscalaItem.id))
-            .filter(EscalaItem.escala_mes_id == escala.id)
-            .group_by(EscalaItem.tipo)
-            .all()
-        )
-        escala_labels = [t[0] or "-" for t in por_tipo]
-        escala_values = [int(t[1]) for t in por_tipo]
+        grade = obter_grade(escala.id)
+        contagem = np.bincount(grade["matriz"].ravel(), minlength=len(escala_grid.TIPOS))
+        for cod, n in enumerate(contagem.tolist()):
+            if cod and n:
+                escala_labels.append(escala_grid.TIPOS[cod])
+                escala_values.append(int(n))
 
     return render_template(
         "admin/graficos.html",
@@ -1219,42 +1666,440 @@ def admin_graficos():
         escala_values=escala_values,
         escala_titulo=escala_titulo
     )
+
 # ==================================================
-# ADMIN - FUNCIONÁRIOS
+# ADMIN - COBERTURA (HEATMAP POR SETOR)
 # ==================================================
+# Quantas pessoas em serviço (EXPEDIENTE / PLANTAO_24H) por setor do
+# funcionário e por dia ou hora, em qualquer intervalo de datas.
+# - intervalos (inicio/fim) de cada EscalaMes lidos 1 vez por versão
+# - contagem por varredura vetorizada (escala_grid.cobertura)
+# - o mesmo funcionário em 2 escalas do mês (ex.: TODOS + setor) conta 1 vez
 
-@app.route("/admin/funcionarios")
-@login_required
-@direcao_required
-def admin_funcionarios():
-    busca = request.args.get("busca")
+COBERTURA_TIPOS = ("EXPEDIENTE", "PLANTAO_24H")
+COBERTURA_CACHE_MAX = int(os.getenv("COBERTURA_CACHE_MAX", "256"))
+COBERTURA_MAX_SLOTS = 24 * 400
 
-    if busca:
-        funcionarios = Funcionario.query.filter(
-            (Funcionario.nome.ilike(f"%{busca}%")) |
-            (Funcionario.cpf.ilike(f"%{busca}%")) |
-            (Funcionario.funcao.ilike(f"%{busca}%")) |
-            (Funcionario.email.ilike(f"%{busca}%"))
+_cobertura_cache = OrderedDict()      # (escala_mes_id, versao) -> intervalos
+_cobertura_resultado = OrderedDict()  # (de, ate, granularidade, versões) -> resposta
+_cobertura_stats = {"hits": 0, "misses": 0}
+
+def _intervalos_escalas(escalas):
+    """
+    {escala_mes_id: {"fid", "setor", "ini", "fim", "tipo"}} dos itens em serviço,
+    em cache por (id, versão). Escalas "itens" que faltam vêm em 1 SELECT só;
+    escalas "regras" saem da grade expandida (obter_grade).
+    """
+    resultado = {}
+    faltando = {}
+    for escala_mes_id, versao in escalas:
+        chave = (escala_mes_id, versao)
+        dados = _cobertura_cache.get(chave)
+        if dados is not None:
+            _cobertura_cache.move_to_end(chave)
+            _cobertura_stats["hits"] += 1
+            resultado[escala_mes_id] = dados
+        else:
+            _cobertura_stats["misses"] += 1
+            faltando[escala_mes_id] = versao
+
+    por_regra = set()
+    if faltando:
+        por_regra = {
+            i for (i,) in db.session.query(EscalaMes.id)
+            .filter(EscalaMes.id.in_(list(faltando)))
+            .filter(EscalaMes.armazenamento == "regras")
+        }
+
+    por_escala = {}
+    for escala_mes_id in por_regra:
+        grade = obter_grade(escala_mes_id)
+        if grade is None:
+            continue
+        e = grade["escala"]
+        linhas_g, inicios, fins, tipos = escala_grid.intervalos_da_grade(
+            grade["matriz"], e["ano"], e["mes"],
+            [escala_grid.CODIGO_POR_TIPO[t] for t in COBERTURA_TIPOS]
+        )
+        fids = np.array(grade["func_ids"], dtype=np.int64)[linhas_g]
+        # funcionário excluído não conta (igual ao JOIN do formato antigo)
+        ok = np.array([f in grade["funcionarios"] for f in fids.tolist()], dtype=bool)
+        setores = [
+            (grade["funcionarios"][f]["setor"] or "SEM SETOR") for f in fids[ok].tolist()
+        ]
+        por_escala[escala_mes_id] = (fids[ok], setores, inicios[ok], fins[ok], tipos[ok])
+
+    if len(faltando) > len(por_regra):
+        item = EscalaItem.__table__
+        func = Funcionario.__table__
+        # inicio/fim como texto: evita converter 1 datetime por linha no Python
+        linhas = db.session.execute(
+            db.select(
+                item.c.escala_mes_id,
+                item.c.funcionario_id,
+                func.c.setor,
+                db.cast(item.c.inicio, db.String),
+                db.cast(item.c.fim, db.String),
+                item.c.tipo,
+            )
+            .join(func, func.c.id == item.c.funcionario_id)
+            .where(item.c.escala_mes_id.in_([i for i in faltando if i not in por_regra]))
+            .where(item.c.tipo.in_(COBERTURA_TIPOS))
         ).all()
-    else:
-        funcionarios = Funcionario.query.all()
 
-    return render_template("admin/funcionarios.html", funcionarios=funcionarios, busca=busca)
+        colunas = {i: ([], [], [], [], []) for i in faltando if i not in por_regra}
+        for escala_mes_id, fid, setor, inicio, fim, tipo in linhas:
+            cols = colunas[escala_mes_id]
+            cols[0].append(fid)
+            cols[1].append(setor or "SEM SETOR")
+            cols[2].append(inicio)
+            cols[3].append(fim)
+            cols[4].append(escala_grid.CODIGO_POR_TIPO.get(tipo, escala_grid.VAZIO))
+
+        for escala_mes_id, (fids, setores, inicios, fins, tipos) in colunas.items():
+            por_escala[escala_mes_id] = (
+                fids, setores, escala_grid.para_minutos(inicios), escala_grid.para_minutos(fins), tipos
+            )
 
-# ==================================================
-# ADMIN - CURSOS
-# ==================================================
+    for escala_mes_id, (fids, setores, inicios, fins, tipos) in por_escala.items():
+        dados = {
+            "fid": np.array(fids, dtype=np.int64),
+            "setor": np.array(setores, dtype=object),
+            "ini": np.asarray(inicios, dtype=np.int64),
+            "fim": np.asarray(fins, dtype=np.int64),
+            "tipo": np.array(tipos, dtype=np.int8),
+        }
+        # versões antigas da mesma escala não servem mais
+        for antiga in [k for k in _cobertura_cache if k[0] == escala_mes_id]:
+            del _cobertura_cache[antiga]
+        _cobertura_cache[(escala_mes_id, faltando[escala_mes_id])] = dados
+        resultado[escala_mes_id] = dados
 
-@app.route("/admin/cursos")
-@login_required
-@direcao_required
-def admin_cursos():
-    return render_template("admin/cursos.html", cursos=cursos_lista)
+    while len(_cobertura_cache) > COBERTURA_CACHE_MAX:
+        _cobertura_cache.popitem(last=False)
 
-@app.route("/admin/cursos/novo", methods=["GET", "POST"])
-@login_required
-@direcao_required
-def admin_novo_curso():
+    return resultado
+
+def _cobertura_cache_invalidar(escala_mes_id: int):
+    for k in [k for k in _cobertura_cache if k[0] == escala_mes_id]:
+        del _cobertura_cache[k]
+    _cobertura_resultado.clear()
+    _indice_plantao_invalidar()
+
+def calcular_cobertura(de: date, ate: date, granularidade: str = "dia"):
+    """
+    {"inicio", "fim", "granularidade", "slots": [rótulos], "setores": [..], "valores": [[..]]}
+    valores[i][j] = pessoas em serviço no setor i na faixa j.
+    """
+    slot_min = 60 if granularidade == "hora" else 1440
+    n_slots = ((ate - de).days + 1) * (1440 // slot_min)
+    if n_slots <= 0 or n_slots > COBERTURA_MAX_SLOTS:
+        raise ValueError("Intervalo inválido ou grande demais para essa granularidade.")
+
+    # escalas dos meses tocados (+ mês anterior: plantão de 24h do último dia entra no dia 1)
+    ini_mes = (de.replace(day=1) - timedelta(days=1)).replace(day=1)
+    escalas = (
+        db.session.query(EscalaMes.id, EscalaMes.versao)
+        .filter((EscalaMes.ano * 100 + EscalaMes.mes) >= ini_mes.year * 100 + ini_mes.month)
+        .filter((EscalaMes.ano * 100 + EscalaMes.mes) <= ate.year * 100 + ate.month)
+        .order_by(EscalaMes.id)
+        .all()
+    )
+
+    assinatura = (de, ate, granularidade, tuple((e.id, e.versao or 0) for e in escalas))
+    if assinatura in _cobertura_resultado:
+        _cobertura_resultado.move_to_end(assinatura)
+        return _cobertura_resultado[assinatura]
+
+    partes = _intervalos_escalas([(e.id, e.versao or 0) for e in escalas]).values()
+    partes = [p for p in partes if len(p["fid"])]
+
+    t0 = int(escala_grid.para_minutos([datetime.combine(de, time(0, 0))])[0])
+    if partes:
+        fid = np.concatenate([p["fid"] for p in partes])
+        setor = np.concatenate([p["setor"] for p in partes])
+        ini = np.concatenate([p["ini"] for p in partes])
+        fim = np.concatenate([p["fim"] for p in partes])
+
+        # mesma pessoa, mesmo início em escalas diferentes: conta 1 vez
+        _, unicos = np.unique(np.stack([fid, ini]), axis=1, return_index=True)
+        setor, ini, fim = setor[unicos], ini[unicos], fim[unicos]
+
+        setores, grupos = np.unique(setor.astype(str), return_inverse=True)
+        matriz = escala_grid.cobertura(ini, fim, grupos, len(setores), t0, n_slots, slot_min)
+        setores = setores.tolist()
+    else:
+        setores = []
+        matriz = np.zeros((0, n_slots), dtype=np.int32)
+
+    if granularidade == "hora":
+        slots = [
+            (datetime.combine(de, time(0, 0)) + timedelta(hours=h)).strftime("%Y-%m-%d %H:00")
+            for h in range(n_slots)
+        ]
+    else:
+        slots = [(de + timedelta(days=d)).isoformat() for d in range(n_slots)]
+
+    resultado = {
+        "inicio": de.isoformat(),
+        "fim": ate.isoformat(),
+        "granularidade": granularidade,
+        "slots": slots,
+        "setores": setores,
+        "valores": matriz.tolist(),
+        "maximo": int(matriz.max()) if matriz.size else 0,
+    }
+
+    _cobertura_resultado[assinatura] = resultado
+    while len(_cobertura_resultado) > 32:
+        _cobertura_resultado.popitem(last=False)
+    return resultado
+
+def _parse_intervalo_cobertura(args):
+    hoje = date.today()
+    padrao_de = hoje.replace(day=1)
+    padrao_ate = date(hoje.year, hoje.month, calendar.monthrange(hoje.year, hoje.month)[1])
+    try:
+        de = date.fromisoformat(args.get("de")) if args.get("de") else padrao_de
+        ate = date.fromisoformat(args.get("ate")) if args.get("ate") else padrao_ate
+    except ValueError:
+        raise ValueError("Datas inválidas (use AAAA-MM-DD).")
+    if ate < de:
+        raise ValueError("A data final é anterior à inicial.")
+    granularidade = "hora" if args.get("granularidade") == "hora" else "dia"
+    return de, ate, granularidade
+
+@app.get("/admin/cobertura.json")
+@login_required
+@direcao_required
+def admin_cobertura_json():
+    try:
+        de, ate, granularidade = _parse_intervalo_cobertura(request.args)
+        t0 = perf_counter()
+        resultado = calcular_cobertura(de, ate, granularidade)
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}, 400
+
+    print(f"🗺️ Cobertura {de}..{ate} ({granularidade}) em {perf_counter() - t0:.3f}s {_cobertura_stats}")
+    return {"ok": True, **resultado}
+
+@app.get("/admin/cobertura")
+@login_required
+@direcao_required
+def admin_cobertura():
+    try:
+        de, ate, granularidade = _parse_intervalo_cobertura(request.args)
+        # por hora, a página mostra no máximo 14 dias (o JSON não tem esse limite)
+        if granularidade == "hora" and (ate - de).days > 13:
+            ate = de + timedelta(days=13)
+        resultado = calcular_cobertura(de, ate, granularidade)
+    except ValueError as e:
+        flash(f"❌ {e}", "danger")
+        return redirect(url_for("admin_cobertura"))
+
+    return render_template("admin/cobertura.html", c=resultado, de=de, ate=ate, granularidade=granularidade)
+
+# ==================================================
+# QUEM ESTÁ DE SERVIÇO (ÍNDICE DE INTERVALOS)
+# ==================================================
+# Índice em memória com os turnos do mês anterior, atual e seguinte
+# (plantão de 24h atravessa a meia-noite e a virada do mês). Consultas de
+# outra data montam o índice da janela delas (guardamos poucas janelas).
+# - reaproveita os intervalos da cobertura (cache por versão da escala)
+# - reconstruído quando muda a assinatura (id, versão) das escalas da janela:
+#   edições neste processo forçam a conferência na hora; as de outros
+#   processos aparecem na próxima (a cada PLANTAO_INDICE_VERIFICAR_S segundos)
+# - consulta: bisect nos inícios ordenados, microssegundos
+
+PLANTAO_INDICE_VERIFICAR_S = float(os.getenv("PLANTAO_INDICE_VERIFICAR_S", "5"))
+
+PLANTAO_INDICE_JANELAS = 3
+
+_indices_plantao = OrderedDict()  # (mês anterior, mês seguinte) -> índice
+_indice_plantao_stats = {"reconstrucoes": 0, "consultas": 0, "invalidado": float("-inf")}
+
+def _indice_plantao_invalidar():
+    # a próxima consulta confere as versões das escalas no banco
+    _indice_plantao_stats["invalidado"] = perf_counter()
+
+def _janela_meses(hoje: date):
+    anterior = (hoje.replace(day=1) - timedelta(days=1)).replace(day=1)
+    seguinte = (hoje.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return anterior, seguinte
+
+def obter_indice_plantao(agora: datetime | None = None):
+    agora = agora or datetime.now()
+    janela = _janela_meses(agora.date())
+    idx = _indices_plantao.get(janela)
+
+    if idx is not None:
+        _indices_plantao.move_to_end(janela)
+        if (
+            idx["verificado"] > _indice_plantao_stats["invalidado"]
+            and perf_counter() - idx["verificado"] < PLANTAO_INDICE_VERIFICAR_S
+        ):
+            return idx
+    else:
+        idx = {"assinatura": None, "verificado": float("-inf")}
+
+    de, ate = janela
+    escalas = (
+        db.session.query(EscalaMes.id, EscalaMes.versao)
+        .filter((EscalaMes.ano * 100 + EscalaMes.mes) >= de.year * 100 + de.month)
+        .filter((EscalaMes.ano * 100 + EscalaMes.mes) <= ate.year * 100 + ate.month)
+        .order_by(EscalaMes.id)
+        .all()
+    )
+    assinatura = tuple((e.id, e.versao or 0) for e in escalas)
+    idx["verificado"] = perf_counter()
+    if assinatura == idx["assinatura"]:
+        return idx
+
+    partes = [p for p in _intervalos_escalas(assinatura).values() if len(p["fid"])]
+    if partes:
+        fid = np.concatenate([p["fid"] for p in partes])
+        setor = np.concatenate([p["setor"] for p in partes])
+        ini = np.concatenate([p["ini"] for p in partes])
+        fim = np.concatenate([p["fim"] for p in partes])
+        tipo = np.concatenate([p["tipo"] for p in partes])
+
+        # mesma pessoa, mesmo início em escalas diferentes: 1 vez só
+        _, unicos = np.unique(np.stack([fid, ini]), axis=1, return_index=True)
+        fid, setor, ini, fim, tipo = fid[unicos], setor[unicos], ini[unicos], fim[unicos], tipo[unicos]
+    else:
+        fid = np.zeros(0, dtype=np.int64)
+        setor = np.zeros(0, dtype=object)
+        ini = fim = np.zeros(0, dtype=np.int64)
+        tipo = np.zeros(0, dtype=np.int8)
+
+    por_setor = {}
+    for nome_setor in set(setor.tolist()):
+        pos = np.nonzero(setor == nome_setor)[0]
+        por_setor[nome_setor] = (pos, escala_grid.IndiceIntervalos(ini[pos], fim[pos]))
+
+    nomes = dict(
+        db.session.query(Funcionario.id, Funcionario.nome)
+        .filter(Funcionario.id.in_(set(fid.tolist())))
+        .all()
+    ) if len(fid) else {}
+
+    idx.update({
+        "assinatura": assinatura,
+        "geral": escala_grid.IndiceIntervalos(ini, fim),
+        "por_setor": por_setor,
+        "fid": fid,
+        "setor": setor,
+        "ini": ini,
+        "fim": fim,
+        "tipo": tipo,
+        "nomes": nomes,
+    })
+    _indices_plantao[janela] = idx
+    while len(_indices_plantao) > PLANTAO_INDICE_JANELAS:
+        _indices_plantao.popitem(last=False)
+
+    _indice_plantao_stats["reconstrucoes"] += 1
+    print(f"🩺 Índice de plantão {de:%m/%Y}–{ate:%m/%Y}: {len(fid)} turnos, {len(por_setor)} setores")
+    return idx
+
+def _minuto_para_texto(m: int):
+    return (datetime(1970, 1, 1) + timedelta(minutes=int(m))).strftime("%Y-%m-%d %H:%M")
+
+def consultar_plantao(idx, a: int, b: int | None = None, setor: str | None = None):
+    """Posições (no índice) de quem está em serviço no minuto a, ou em [a, b)."""
+    _indice_plantao_stats["consultas"] += 1
+    if setor:
+        if setor not in idx["por_setor"]:
+            return np.zeros(0, dtype=np.int64)
+        pos, indice = idx["por_setor"][setor]
+        return pos[indice.em(a) if b is None else indice.entre(a, b)]
+    return idx["geral"].em(a) if b is None else idx["geral"].entre(a, b)
+
+@app.get("/admin/plantao/agora.json")
+@login_required
+@direcao_required
+def admin_plantao_agora():
+    """
+    ?em=AAAA-MM-DDTHH:MM (padrão: agora) ou ?de=...&ate=... ; &setor= opcional.
+    Retorna quem está em serviço agrupado por setor.
+    """
+    try:
+        if request.args.get("de") or request.args.get("ate"):
+            de = datetime.fromisoformat(request.args["de"])
+            ate = datetime.fromisoformat(request.args["ate"])
+            if ate <= de:
+                raise ValueError
+        else:
+            de = datetime.fromisoformat(request.args["em"]) if request.args.get("em") else datetime.now()
+            ate = None
+    except (KeyError, ValueError):
+        return {"ok": False, "error": "Datas inválidas (use AAAA-MM-DDTHH:MM; 'ate' depois de 'de')."}, 400
+
+    idx = obter_indice_plantao(de)
+    a = int(escala_grid.para_minutos([de])[0])
+    b = int(escala_grid.para_minutos([ate])[0]) if ate else None
+
+    t0 = perf_counter()
+    posicoes = consultar_plantao(idx, a, b, (request.args.get("setor") or "").strip() or None)
+    micros = (perf_counter() - t0) * 1e6
+
+    setores = {}
+    for p in sorted(posicoes.tolist(), key=lambda p: idx["nomes"].get(int(idx["fid"][p]), "")):
+        fid = int(idx["fid"][p])
+        setores.setdefault(idx["setor"][p], []).append({
+            "id": fid,
+            "nome": idx["nomes"].get(fid, "-"),
+            "tipo": escala_grid.TIPOS[int(idx["tipo"][p])],
+            "inicio": _minuto_para_texto(idx["ini"][p]),
+            "fim": _minuto_para_texto(idx["fim"][p]),
+        })
+
+    return {
+        "ok": True,
+        "em": de.strftime("%Y-%m-%d %H:%M"),
+        "ate": ate.strftime("%Y-%m-%d %H:%M") if ate else None,
+        "total": len(posicoes),
+        "consulta_us": round(micros, 1),
+        "setores": dict(sorted(setores.items())),
+    }
+
+# ==================================================
+# ADMIN - FUNCIONÁRIOS
+# ==================================================
+
+@app.route("/admin/funcionarios")
+@login_required
+@direcao_required
+def admin_funcionarios():
+    busca = request.args.get("busca")
+
+    if busca:
+        funcionarios = Funcionario.query.filter(
+            (Funcionario.nome.ilike(f"%{busca}%")) |
+            (Funcionario.cpf.ilike(f"%{busca}%")) |
+            (Funcionario.funcao.ilike(f"%{busca}%")) |
+            (Funcionario.email.ilike(f"%{busca}%"))
+        ).all()
+    else:
+        funcionarios = Funcionario.query.all()
+
+    return render_template("admin/funcionarios.html", funcionarios=funcionarios, busca=busca)
+
+# ==================================================
+# ADMIN - CURSOS
+# ==================================================
+
+@app.route("/admin/cursos")
+@login_required
+@direcao_required
+def admin_cursos():
+    cursos = Curso.query.order_by(Curso.id).all()
+    return render_template("admin/cursos.html", cursos=cursos)
+
+@app.route("/admin/cursos/novo", methods=["GET", "POST"])
+@login_required
+@direcao_required
+def admin_novo_curso():
     if request.method == "POST":
         pdf_file = request.files.get("pdf")
         nome = None
@@ -1265,15 +2110,15 @@ def admin_novo_curso():
             nome = secure_filename(pdf_file.filename)
             pdf_file.save(os.path.join(cursos_dir, nome))
 
-        cursos_lista.append({
-            "id": len(cursos_lista) + 1,
-            "titulo": request.form["titulo"],
-            "descricao": request.form["descricao"],
-            "video": request.form["video"],
-            "pdf": nome,
-            "carga": request.form["carga"],
-            "data": date.today().strftime("%d/%m/%Y")
-        })
+        db.session.add(Curso(
+            titulo=request.form["titulo"],
+            descricao=request.form["descricao"],
+            video=request.form["video"],
+            pdf=nome,
+            carga=request.form["carga"],
+            data=date.today().strftime("%d/%m/%Y")
+        ))
+        db.session.commit()
 
         return redirect(url_for("admin_cursos"))
 
@@ -1293,9 +2138,65 @@ def admin_relatorios():
 @login_required
 @direcao_required
 def relatorio_funcionarios():
-    busca = request.args.get("busca", "").strip()
+    filtros, _ = _filtros_relatorio_funcionarios(request.args)
+
+    # página em streaming: as linhas saem do banco em lotes enquanto o HTML é enviado
+    return stream_template(
+        "relatorio_funcionarios.html",
+        funcionarios=_query_relatorio_funcionarios(filtros).yield_per(500),
+        busca=filtros.get("busca", "")
+    )
+
+# ==================================================
+# RELATÓRIO DE FUNCIONÁRIOS (PDF EM CACHE)
+# ==================================================
+# Antes: 1 arquivo static/relatorio_funcionarios_<timestamp>.pdf por clique,
+# nunca apagado. Agora o PDF vai para um cache em disco limitado/podado,
+# chaveado por filtros + campos + dia: o mesmo relatório pedido de novo no
+# mesmo dia sai do cache. Alterar funcionários limpa o cache.
+
+# campo -> (título da coluna, peso da largura)
+CAMPOS_RELATORIO = {
+    "nome": ("Nome", 3),
+    "cpf": ("CPF", 1.3),
+    "matricula": ("Matrícula", 1.2),
+    "setor": ("Setor", 2),
+    "cargo": ("Cargo", 2),
+    "funcao": ("Função", 1.6),
+    "turno": ("Turno", 1),
+    "carga_horaria": ("Carga Horária", 1.1),
+    "tipo_vinculo": ("Vínculo", 1.2),
+    "status": ("Status", 0.9),
+    "telefone": ("Telefone", 1.4),
+    "email": ("Email", 2.4),
+}
+CAMPOS_RELATORIO_PADRAO = ["nome", "cpf", "setor", "cargo"]
+RELATORIO_LOTE = 1000
+
+RELATORIO_PDF_CACHE_DIR = os.getenv("RELATORIO_PDF_CACHE_DIR", os.path.join(app.instance_path, "cache", "relatorios_pdf"))
+RELATORIO_PDF_CACHE_MAX_MB = float(os.getenv("RELATORIO_PDF_CACHE_MAX_MB", "50"))
+RELATORIO_PDF_CACHE_MAX_DIAS = float(os.getenv("RELATORIO_PDF_CACHE_MAX_DIAS", "2"))
+os.makedirs(RELATORIO_PDF_CACHE_DIR, exist_ok=True)
+
+_relatorio_cache_stats = {"hits": 0, "misses": 0, "removidos": 0}
+
+def _filtros_relatorio_funcionarios(args):
+    """Filtros (busca/nome/setor/cargo/status) e campos válidos da querystring."""
+    filtros = {
+        k: (args.get(k) or "").strip()
+        for k in ("busca", "nome", "setor", "cargo", "status")
+    }
+    filtros = {k: v for k, v in filtros.items() if v}
+
+    campos = [c for c in args.getlist("campos") if c in CAMPOS_RELATORIO]
+    if not campos:
+        campos = list(CAMPOS_RELATORIO_PADRAO)
+    return filtros, campos
+
+def _query_relatorio_funcionarios(filtros):
     query = Funcionario.query
 
+    busca = filtros.get("busca")
     if busca:
         query = query.filter(
             (Funcionario.nome.ilike(f"%{busca}%")) |
@@ -1303,111 +2204,119 @@ def relatorio_funcionarios():
             (Funcionario.funcao.ilike(f"%{busca}%")) |
             (Funcionario.email.ilike(f"%{busca}%"))
         )
+    if filtros.get("nome"):
+        query = query.filter(Funcionario.nome.ilike(f"%{filtros['nome']}%"))
+    if filtros.get("setor"):
+        query = query.filter(Funcionario.setor.ilike(f"%{filtros['setor']}%"))
+    if filtros.get("cargo"):
+        query = query.filter(Funcionario.cargo.ilike(f"%{filtros['cargo']}%"))
+    if filtros.get("status"):
+        query = query.filter(Funcionario.status == filtros["status"])
+
+    return query.order_by(Funcionario.nome)
+
+def _linhas_relatorio_funcionarios(filtros, campos):
+    # só as colunas pedidas, lidas do cursor em lotes (sem montar objetos ORM)
+    colunas = [getattr(Funcionario, c) for c in campos]
+    sel = _query_relatorio_funcionarios(filtros).with_entities(*colunas)
+    return db.session.execute(sel.statement.execution_options(yield_per=RELATORIO_LOTE))
+
+def _descricao_filtros(filtros):
+    if not filtros:
+        return "Filtro: todos"
+    return "Filtro: " + "; ".join(f"{k}={v}" for k, v in sorted(filtros.items()))
+
+def _relatorio_cache_path(filtros, campos, dia: date):
+    chave = json.dumps({"f": filtros, "c": campos, "d": dia.isoformat()}, sort_keys=True, ensure_ascii=False)
+    h = hashlib.sha1(chave.encode("utf-8")).hexdigest()[:20]
+    return os.path.join(RELATORIO_PDF_CACHE_DIR, f"funcionarios_{dia:%Y%m%d}_{h}.pdf")
+
+def _relatorio_cache_limpar():
+    # funcionários mudaram: nenhum relatório em cache vale mais
+    for nome in os.listdir(RELATORIO_PDF_CACHE_DIR):
+        try:
+            os.remove(os.path.join(RELATORIO_PDF_CACHE_DIR, nome))
+            _relatorio_cache_stats["removidos"] += 1
+        except OSError:
+            pass
 
-    funcionarios = query.order_by(Funcionario.nome).all()
+def obter_pdf_funcionarios(filtros, campos):
+    """Caminho do PDF do relatório (gera e grava se não existir). Retorna (caminho, hit)."""
+    caminho = _relatorio_cache_path(filtros, campos, date.today())
+    if os.path.exists(caminho):
+        _relatorio_cache_stats["hits"] += 1
+        return caminho, True
 
-    return render_template(
-        "relatorio_funcionarios.html",
-        funcionarios=funcionarios,
-        busca=busca
+    _relatorio_cache_stats["misses"] += 1
+
+    conteudo = pdf_layout.gerar_pdf_tabela(
+        "RELATÓRIO DE FUNCIONÁRIOS",
+        f"{_descricao_filtros(filtros)} — gerado em {datetime.now().strftime('%d/%m/%Y %H:%M')}",
+        [CAMPOS_RELATORIO[c] for c in campos],
+        _linhas_relatorio_funcionarios(filtros, campos),
     )
 
+    tmp = f"{caminho}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(conteudo)
+    os.replace(tmp, caminho)
+
+    _pdf_cache_podar(RELATORIO_PDF_CACHE_DIR, RELATORIO_PDF_CACHE_MAX_MB, RELATORIO_PDF_CACHE_MAX_DIAS, _relatorio_cache_stats)
+    return caminho, False
+
 @app.route("/admin/funcionarios/pdf")
 @login_required
 @direcao_required
 def gerar_pdf_funcionarios():
-    nome = request.args.get("nome")
-    setor = request.args.get("setor")
-    cargo = request.args.get("cargo")
-    status = request.args.get("status")
-    campos = request.args.getlist("campos")
-
-    if not campos:
-        campos = ["nome", "cpf", "setor", "cargo"]
-
-    query = Funcionario.query
-
-    if nome:
-        query = query.filter(Funcionario.nome.ilike(f"%{nome}%"))
-    if setor:
-        query = query.filter(Funcionario.setor.ilike(f"%{setor}%"))
-    if cargo:
-        query = query.filter(Funcionario.cargo.ilike(f"%{cargo}%"))
-    if status:
-        query = query.filter(Funcionario.status == status)
-
-    funcionarios = query.order_by(Funcionario.nome).all()
-
-    nome_arquivo = f"relatorio_funcionarios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-    caminho = os.path.join(BASE_DIR, "static", nome_arquivo)
-
-    c = canvas.Canvas(caminho, pagesize=A4)
-    largura, altura = A4
-    y = altura - 2 * cm
-
-    c.setFont("Helvetica-Bold", 14)
-    c.drawCentredString(largura / 2, y, "Hospital Municipal da Mulher")
-    y -= 20
-
-    c.setFont("Helvetica", 11)
-    c.drawCentredString(largura / 2, y, "Secretaria Municipal de Saúde de Cabo Frio")
-    y -= 30
-
-    c.setFont("Helvetica-Bold", 12)
-    c.drawCentredString(largura / 2, y, "Relatório de Funcionários")
-    y -= 30
-
-    c.setFont("Helvetica", 9)
-    c.drawString(2 * cm, y, f"Data: {datetime.now().strftime('%d/%m/%Y %H:%M')}")
-    y -= 20
-
-    c.setFont("Helvetica-Bold", 9)
-
-    x = 2 * cm
-    colunas = {
-        "nome": "Nome",
-        "cpf": "CPF",
-        "setor": "Setor",
-        "cargo": "Cargo",
-        "turno": "Turno",
-        "carga_horaria": "Carga Horária",
-        "tipo_vinculo": "Vínculo"
-    }
-    largura_coluna = 7 * cm
-
-    for campo in campos:
-        titulo = colunas.get(campo, campo)
-        c.drawString(x, y, titulo)
-        x += largura_coluna
-
-    y -= 15
-    c.line(2 * cm, y, largura - 2 * cm, y)
-    y -= 15
-
-    c.setFont("Helvetica", 9)
-
-    for f in funcionarios:
-        x = 2 * cm
-        for campo in campos:
-            valor = getattr(f, campo, "") or ""
-            valor = str(valor)
-            if len(valor) > 35:
-                valor = valor[:35] + "..."
-            c.drawString(x, y, valor)
-            x += largura_coluna
+    filtros, campos = _filtros_relatorio_funcionarios(request.args)
+
+    caminho, hit = obter_pdf_funcionarios(filtros, campos)
+    print(f"📄 Relatório funcionários {filtros} {campos}: {'HIT' if hit else 'MISS'} {_relatorio_cache_stats}")
+
+    resp = send_file(
+        caminho,
+        as_attachment=False,
+        download_name=f"relatorio_funcionarios_{date.today():%Y%m%d}.pdf",
+        mimetype="application/pdf",
+        conditional=True,
+        max_age=0
+    )
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.headers["X-Cache"] = "HIT" if hit else "MISS"
+    return resp
 
-        y -= 15
+# ==================================================
+# EXPORTAR FUNCIONÁRIOS (CSV / XLSX EM STREAMING)
+# ==================================================
+# Mesmos filtros/campos do PDF. Cursor com yield_per + resposta geradora:
+# memória constante e os primeiros bytes saem antes de ler tudo.
 
-        if y < 2 * cm:
-            c.showPage()
-            c.setFont("Helvetica", 9)
-            y = altura - 2 * cm
+FORMATOS_EXPORTACAO = {
+    "csv": (planilhas.gerar_csv, "text/csv"),
+    "xlsx": (planilhas.gerar_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
 
-    c.save()
-    return redirect(f"/static/{nome_arquivo}")
+@app.get("/admin/funcionarios/exportar/<formato>")
+@login_required
+@direcao_required
+def exportar_funcionarios(formato):
+    if formato not in FORMATOS_EXPORTACAO:
+        abort(404)
+    gerar, mimetype = FORMATOS_EXPORTACAO[formato]
+    filtros, campos = _filtros_relatorio_funcionarios(request.args)
+
+    cabecalho = [CAMPOS_RELATORIO[c][0] for c in campos]
+    corpo = gerar(cabecalho, _linhas_relatorio_funcionarios(filtros, campos))
+
+    resp = Response(stream_with_context(corpo), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = (
+        f'attachment; filename="funcionarios_{datetime.now():%Y%m%d_%H%M}.{formato}"'
+    )
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 # ==================================================
-# ADMIN - SETORES (lista em memória)
+# ADMIN - SETORES
 # ==================================================
 
 @app.route("/admin/setores", methods=["GET", "POST"])
@@ -1415,12 +2324,17 @@ def gerar_pdf_funcionarios():
 @direcao_required
 def admin_setores():
     if request.method == "POST":
-        nome = request.form.get("nome")
-        if nome and nome not in setores_lista:
-            setores_lista.append(nome)
+        nome = (request.form.get("nome") or "").strip()
+        if nome and not Setor.query.filter_by(nome=nome).first():
+            db.session.add(Setor(nome=nome))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
         return redirect(url_for("admin_setores"))
 
-    return render_template("admin/setores.html", setores=setores_lista)
+    setores = [nome for (nome,) in db.session.query(Setor.nome).order_by(Setor.id)]
+    return render_template("admin/setores.html", setores=setores)
 
 # ==================================================
 # ADMIN - ADICIONAR FUNCIONÁRIO (COM ESCALA)
@@ -1468,7 +2382,9 @@ def admin_novo_funcionario():
             )
 
             db.session.add(func)
+            _bump_versao_diretorio()
             db.session.commit()
+            _relatorio_cache_limpar()
             return redirect(url_for("admin_funcionarios"))
 
     return render_template("admin/novo_funcionario.html", erro=erro)
@@ -1483,17 +2399,20 @@ def admin_novo_funcionario():
 def admin_certificados():
     lista = []
 
-    for c in conclusoes:
-        funcionario = Funcionario.query.get(c["user_id"])
-        curso = next((x for x in cursos_lista if x["id"] == c["curso_id"]), None)
-
-        if funcionario and curso:
-            lista.append({
-                "funcionario": funcionario.nome,
-                "curso": curso["titulo"],
-                "data": c["data"],
-                "codigo": f'{c["user_id"]}-{c["curso_id"]}-{c["data"]}'
-            })
+    conclusoes = (
+        db.session.query(ConclusaoCurso, Funcionario.nome, Curso.titulo)
+        .join(Funcionario, Funcionario.id == ConclusaoCurso.funcionario_id)
+        .join(Curso, Curso.id == ConclusaoCurso.curso_id)
+        .order_by(ConclusaoCurso.id)
+        .all()
+    )
+    for c, nome, titulo in conclusoes:
+        lista.append({
+            "funcionario": nome,
+            "curso": titulo,
+            "data": c.data,
+            "codigo": f"{c.funcionario_id}-{c.curso_id}-{c.data}"
+        })
 
     return render_template("admin/certificados.html", certificados=lista)
 
@@ -1516,16 +2435,18 @@ def admin_comunicados():
         elif not conteudo_html and not pdf_nome:
             erro = "Informe um texto ou envie um PDF."
         else:
-            comunicados_lista.append({
-                "id": len(comunicados_lista) + 1,
-                "titulo": titulo,
-                "conteudo_html": conteudo_html,
-                "pdf": pdf_nome,
-                "data": datetime.now().strftime("%d/%m/%Y %H:%M")
-            })
+            comunicado = Comunicado(
+                titulo=titulo,
+                conteudo_html=conteudo_html,
+                pdf=pdf_nome,
+                data=datetime.now().strftime("%d/%m/%Y %H:%M")
+            )
+            db.session.add(comunicado)
+            db.session.commit()
+            publicar_comunicado(comunicado)
             sucesso = "Comunicado publicado com sucesso!"
 
-    comunicados = list(reversed(comunicados_lista)) if comunicados_lista else []
+    comunicados = Comunicado.query.order_by(Comunicado.id.desc()).all()
     return render_template(
         "admin/comunicados.html",
         comunicados=comunicados,
@@ -1562,13 +2483,13 @@ def gerar_certificado_pdf(funcionario, curso):
     pdf.drawCentredString(w / 2, h - 300, "concluiu o curso")
 
     pdf.setFont("Helvetica-Bold", 18)
-    pdf.drawCentredString(w / 2, h - 330, curso["titulo"])
+    pdf.drawCentredString(w / 2, h - 330, curso.titulo)
 
     data_str = date.today().strftime("%d/%m/%Y")
     pdf.setFont("Helvetica", 12)
     pdf.drawCentredString(w / 2, h - 370, f"Concluído em {data_str}")
 
-    codigo = f"{funcionario.id}-{curso['id']}-{data_str}"
+    codigo = f"{funcionario.id}-{curso.id}-{data_str}"
 
     base_url = os.getenv("BASE_URL", "http://localhost:5000").rstrip("/")
     url = f"{base_url}/validar-certificado/{codigo}"
@@ -1594,7 +2515,7 @@ def gerar_certificado_pdf(funcionario, curso):
     return send_file(
         buffer,
         as_attachment=True,
-        download_name=f"certificado_{curso['titulo'].replace(' ', '_')}.pdf",
+        download_name=f"certificado_{curso.titulo.replace(' ', '_')}.pdf",
         mimetype="application/pdf"
     )
 
@@ -1615,16 +2536,16 @@ def validar_certificado(codigo):
     funcionario = None
     curso = None
 
-    for c in conclusoes:
-        if (
-            str(c["user_id"]) == user_id and
-            str(c["curso_id"]) == curso_id and
-            c["data"] == data_str
-        ):
+    if user_id.isdigit() and curso_id.isdigit():
+        conclusao = ConclusaoCurso.query.filter_by(
+            funcionario_id=int(user_id),
+            curso_id=int(curso_id),
+            data=data_str
+        ).first()
+        if conclusao:
             valido = True
-            funcionario = Funcionario.query.get(int(user_id))
-            curso = next((x for x in cursos_lista if x["id"] == int(curso_id)), None)
-            break
+            funcionario = conclusao.funcionario
+            curso = conclusao.curso
 
     return render_template(
         "validar_certificado.html",
@@ -1636,7 +2557,7 @@ def validar_certificado(codigo):
     )
 
 # ==================================================
-# PEDIDO DE MATERIAIS (EM MEMÓRIA)
+# PEDIDO DE MATERIAIS
 # ==================================================
 
 @app.route("/pedido-materiais", methods=["GET", "POST"])
@@ -1644,17 +2565,15 @@ def validar_certificado(codigo):
 @funcionario_required
 def pedido_materiais():
     if request.method == "POST":
-        novo = {
-            "id": len(pedidos_materiais) + 1,
-            "funcionario": session["nome"],
-            "setor": request.form["setor"],
-            "material": request.form["material"],
-            "quantidade": request.form["quantidade"],
-            "data": date.today().strftime("%d/%m/%Y"),
-            "status": "Pendente"
-        }
-
-        pedidos_materiais.append(novo)
+        db.session.add(PedidoMaterial(
+            funcionario=session["nome"],
+            setor=request.form["setor"],
+            material=request.form["material"],
+            quantidade=request.form["quantidade"],
+            data=date.today().strftime("%d/%m/%Y"),
+            status="Pendente"
+        ))
+        db.session.commit()
         return redirect(url_for("pedido_materiais"))
 
     return render_template("pedido_materiais.html")
@@ -1663,34 +2582,35 @@ def pedido_materiais():
 @login_required
 @direcao_required
 def admin_pedidos_materiais():
-    return render_template("admin/pedidos_materiais.html", pedidos=pedidos_materiais)
+    pedidos = PedidoMaterial.query.order_by(PedidoMaterial.id).all()
+    return render_template("admin/pedidos_materiais.html", pedidos=pedidos)
 
 @app.route("/admin/pedido/<int:id>/aprovar")
 @login_required
 @direcao_required
 def aprovar_pedido(id):
-    for p in pedidos_materiais:
-        if p["id"] == id:
-            p["status"] = "Aprovado"
-            break
+    pedido = PedidoMaterial.query.get(id)
+    if pedido:
+        pedido.status = "Aprovado"
+        db.session.commit()
     return redirect(url_for("admin_pedidos_materiais"))
 
 @app.route("/admin/pedido/<int:id>/rejeitar")
 @login_required
 @direcao_required
 def rejeitar_pedido(id):
-    for p in pedidos_materiais:
-        if p["id"] == id:
-            p["status"] = "Rejeitado"
-            break
+    pedido = PedidoMaterial.query.get(id)
+    if pedido:
+        pedido.status = "Rejeitado"
+        db.session.commit()
     return redirect(url_for("admin_pedidos_materiais"))
 
 @app.route("/admin/pedido/<int:id>/excluir")
 @login_required
 @direcao_required
 def excluir_pedido_material(id):
-    global pedidos_materiais
-    pedidos_materiais = [p for p in pedidos_materiais if p["id"] != id]
+    PedidoMaterial.query.filter_by(id=id).delete()
+    db.session.commit()
     return redirect(url_for("admin_pedidos_materiais"))
 
 # ==================================================
@@ -1708,13 +2628,7 @@ def enviar_mensagem():
     nome_arquivo = None
 
     if arquivo and arquivo.filename:
-        os.makedirs(UPLOAD_CHAT, exist_ok=True)
-        nome_arquivo = secure_filename(arquivo.filename)
-
-        base, ext = os.path.splitext(nome_arquivo)
-        nome_final = f"{base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
-        arquivo.save(os.path.join(UPLOAD_CHAT, nome_final))
-        nome_arquivo = nome_final
+        nome_arquivo = salvar_anexo_chat(arquivo)
 
     user = Funcionario.query.get(session["user_id"])
 
@@ -1728,57 +2642,698 @@ def enviar_mensagem():
     )
 
     db.session.add(msg)
+    db.session.flush()
+    registrar_resumos([msg])
     db.session.commit()
 
     if not room:
         room = f"{min(user.id, destino)}_{max(user.id, destino)}"
 
     socketio.emit("nova_mensagem", {
+        "from": user.id,
         "remetente": user.nome,
         "texto": texto,
         "arquivo": nome_arquivo,
+        "miniatura": url_miniatura_chat(nome_arquivo),
         "hora": msg.data_envio.strftime("%H:%M")
     }, room=room)
 
+    if destino != user.id:
+        notificar([destino], "notificacao", {
+            "tipo": "chat",
+            "de": user.id,
+            "texto": f"💬 {user.nome}: {_previa_mensagem(texto, nome_arquivo) or ''}",
+            "url": url_for("chat", destino_id=user.id),
+        })
+        enviar_contadores([destino])
+
     return "", 204
 
+# ==================================================
+# CHAT - GRAVAÇÃO EM GRUPO (WRITE-BEHIND)
+# ==================================================
+# send_message entra numa fila em memória e vai para a sala na hora;
+# uma tarefa do socketio grava a fila a cada CHAT_GRAVACAO_INTERVALO_MS
+# (ou assim que juntar CHAT_GRAVACAO_LOTE mensagens: o handler só acorda
+# a tarefa, não grava) com 1 INSERT em lote + resumos + 1 commit. No
+# SQLite isso troca 1 lock de escrita por mensagem por 1 por lote.
+#
+# Garantias:
+# - a ordem de gravação é a ordem de chegada (data_envio marcada ao enfileirar)
+# - mensagem entregue na sala pode ainda não estar no banco por até
+#   CHAT_GRAVACAO_INTERVALO_MS (histórico/lista de conversas veem depois)
+# - falha no banco: o lote é regravado mensagem a mensagem (as boas
+#   entram); as que falham voltam para o começo da fila e a tarefa
+#   espera o dobro antes de tentar de novo (até 5 s)
+# - mensagem que falha CHAT_GRAVACAO_TENTATIVAS vezes sai da fila e vai
+#   para CHAT_FALHAS_ARQUIVO (1 JSON por linha: dados, erro, tentativas).
+#   Não está no banco nem no histórico; dá para reimportar do arquivo
+# - desligamento normal (atexit / SIGTERM do gunicorn): a fila é gravada;
+#   o que não gravar vai para CHAT_FALHAS_ARQUIVO
+# - queda do processo (kill -9, falta de energia): perde no máximo o que
+#   estava na fila (≈ 1 intervalo de mensagens)
+# CHAT_GRAVACAO_ASSINCRONA=0 volta para 1 commit por mensagem.
+
+CHAT_GRAVACAO_ASSINCRONA = os.getenv("CHAT_GRAVACAO_ASSINCRONA", "1") == "1"
+CHAT_GRAVACAO_INTERVALO_MS = float(os.getenv("CHAT_GRAVACAO_INTERVALO_MS", "20"))
+CHAT_GRAVACAO_LOTE = int(os.getenv("CHAT_GRAVACAO_LOTE", "200"))
+CHAT_GRAVACAO_TENTATIVAS = int(os.getenv("CHAT_GRAVACAO_TENTATIVAS", "5"))
+CHAT_FALHAS_ARQUIVO = os.getenv("CHAT_FALHAS_ARQUIVO", os.path.join(app.instance_path, "chat_falhas.jsonl"))
+
+_fila_chat = deque()
+_fila_chat_stats = {"enfileiradas": 0, "gravadas": 0, "lotes": 0, "maior_lote": 0, "falhas": 0, "descartadas": 0}
+_fila_chat_tarefa = None
+_fila_chat_acordar = None  # Event: lote cheio, grava sem esperar o intervalo
+
+def _mensagem_da_fila(dados: dict):
+    return Mensagem(**{k: v for k, v in dados.items() if k != "tentativas"})
+
+def _gravar_lote_chat(lote):
+    msgs = [_mensagem_da_fila(dados) for dados in lote]
+    db.session.add_all(msgs)
+    db.session.flush()
+    registrar_resumos(msgs)
+    db.session.commit()
+
+def _descartar_mensagens_chat(itens, motivo: str):
+    """Tira da fila de vez: 1 linha JSON por mensagem em CHAT_FALHAS_ARQUIVO."""
+    _fila_chat_stats["descartadas"] += len(itens)
+    try:
+        os.makedirs(os.path.dirname(CHAT_FALHAS_ARQUIVO) or ".", exist_ok=True)
+        with open(CHAT_FALHAS_ARQUIVO, "a", encoding="utf-8") as fh:
+            for dados in itens:
+                fh.write(json.dumps({
+                    "em": datetime.utcnow().isoformat(timespec="seconds"),
+                    "erro": motivo,
+                    "tentativas": dados.get("tentativas", 0),
+                    "dados": {k: v for k, v in dados.items() if k != "tentativas"},
+                }, default=str, ensure_ascii=False) + "\n")
+        print(f"☠️ Chat: {len(itens)} mensagens fora da fila ({motivo.splitlines()[0]}) -> {CHAT_FALHAS_ARQUIVO}")
+    except OSError as e:
+        print(f"❌ Chat: {len(itens)} mensagens perdidas ({motivo}); não deu para gravar o arquivo de falhas:", e)
+
+def _gravar_uma_a_uma(lote):
+    """Lote falhou: grava cada mensagem sozinha. Retorna (gravadas, as que voltam para a fila)."""
+    gravadas, voltam = [], []
+    for i, dados in enumerate(lote):
+        try:
+            _gravar_lote_chat([dados])
+            gravadas.append(dados)
+        except Exception as e:
+            try:
+                db.session.rollback()
+            except Exception as e2:
+                # sessão/conexão quebrada: o que falta volta inteiro para a fila
+                print("⚠️ Chat: rollback falhou, mensagens voltam para a fila:", e2)
+                voltam.extend(lote[i:])
+                break
+            dados["tentativas"] = dados.get("tentativas", 0) + 1
+            if dados["tentativas"] >= CHAT_GRAVACAO_TENTATIVAS:
+                _descartar_mensagens_chat([dados], f"{type(e).__name__}: {e}")
+            else:
+                voltam.append(dados)
+    return gravadas, voltam
+
+def gravar_fila_chat():
+    """
+    Grava tudo o que está na fila (em lotes de CHAT_GRAVACAO_LOTE).
+    Retorna (gravadas, houve_falha); na falha para e deixa o resto na fila.
+    """
+    gravadas = 0
+    while _fila_chat:
+        lote = [_fila_chat.popleft() for _ in range(min(len(_fila_chat), CHAT_GRAVACAO_LOTE))]
+        try:
+            _gravar_lote_chat(lote)
+            falha = False
+        except Exception as e:
+            db.session.rollback()
+            _fila_chat_stats["falhas"] += 1
+            print(f"⚠️ Falha ao gravar lote de {len(lote)} mensagens do chat, tentando uma a uma:", e)
+            lote, voltam = _gravar_uma_a_uma(lote)
+            _fila_chat.extendleft(reversed(voltam))
+            falha = True
+
+        if lote:
+            gravadas += len(lote)
+            _fila_chat_stats["gravadas"] += len(lote)
+            _fila_chat_stats["lotes"] += 1
+            _fila_chat_stats["maior_lote"] = max(_fila_chat_stats["maior_lote"], len(lote))
+
+            # não lidas só mudam no banco aqui: badges dos destinatários do lote
+            # (o lote já está gravado; badge que falha não desfaz nada)
+            try:
+                enviar_contadores({d["destinatario_id"] for d in lote if d["destinatario_id"] != d["remetente_id"]})
+            except Exception as e:
+                print("⚠️ Chat: falha ao enviar contadores do lote gravado:", e)
+        if falha:
+            return gravadas, True
+    return gravadas, False
+
+def _gravacao_chat_loop():
+    espera = CHAT_GRAVACAO_INTERVALO_MS / 1000
+    while True:
+        _fila_chat_acordar.wait(espera)
+        _fila_chat_acordar.clear()
+        if not _fila_chat:
+            continue
+        with app.app_context():
+            try:
+                _, falha = gravar_fila_chat()
+            except Exception as e:
+                # a tarefa não pode morrer: o que ficou na fila vai na próxima volta
+                _fila_chat_stats["falhas"] += 1
+                print("⚠️ Chat: erro na tarefa de gravação, tentando de novo:", e)
+                falha = True
+            finally:
+                try:
+                    db.session.remove()
+                except Exception as e:
+                    print("⚠️ Chat: erro ao liberar a sessão do banco:", e)
+        # banco com problema: não insiste a cada 20 ms
+        espera = min(espera * 2, 5.0) if falha else CHAT_GRAVACAO_INTERVALO_MS / 1000
+
+def _gravar_fila_chat_saida():
+    if _fila_chat:
+        with app.app_context():
+            n, _ = gravar_fila_chat()
+        print(f"💾 Chat: {n} mensagens pendentes gravadas no desligamento")
+    if _fila_chat:
+        _descartar_mensagens_chat(list(_fila_chat), "desligamento com falha ao gravar")
+        _fila_chat.clear()
+
+atexit.register(_gravar_fila_chat_saida)
+
+def enfileirar_mensagem(dados: dict):
+    """Põe a mensagem na fila de gravação (sobe a tarefa na 1ª vez)."""
+    global _fila_chat_tarefa, _fila_chat_acordar
+    if _fila_chat_tarefa is None:
+        _fila_chat_acordar = socketio.server.eio.create_event()
+        _fila_chat_tarefa = socketio.start_background_task(_gravacao_chat_loop)
+
+    _fila_chat.append(dados)
+    _fila_chat_stats["enfileiradas"] += 1
+
+    # rajada: só acorda a tarefa; quem mandou a mensagem não paga o commit
+    if len(_fila_chat) >= CHAT_GRAVACAO_LOTE:
+        _fila_chat_acordar.set()
+
+# ==================================================
+# PRESENÇA / DIGITANDO (SOCKET.IO)
+# ==================================================
+# Quem está online: cada conexão Socket.IO com sessão de login vira uma
+# linha em presenca_socket (vale para todos os workers). Cada worker
+# renova visto_em das suas conexões a cada PRESENCA_HEARTBEAT_S; linhas
+# sem renovação há 3 batidas (worker que caiu/reiniciou) são apagadas.
+#
+# Eventos só nas transições, não a cada conexão/aba:
+# - "presenca" {usuario_id, online}: para todos, quando o usuário abre a
+#   1ª conexão ou fecha a última. O offline espera PRESENCA_OFFLINE_ATRASO_S:
+#   trocar de página desconecta e reconecta logo em seguida e não deve
+#   piscar offline/online na tela dos outros.
+# - "sala_online" {sala, usuarios}: para a sala do chat quando alguém entra/sai.
+# - "show_typing": repassado no máximo 1 vez a cada CHAT_DIGITANDO_INTERVALO_MS
+#   por remetente+sala; as teclas no meio são descartadas (o cliente
+#   mantém o "digitando..." por 1,5 s depois do último aviso).
+
+PRESENCA_HEARTBEAT_S = int(os.getenv("PRESENCA_HEARTBEAT_S", "30"))
+PRESENCA_OFFLINE_ATRASO_S = float(os.getenv("PRESENCA_OFFLINE_ATRASO_S", "5"))
+CHAT_DIGITANDO_INTERVALO_MS = int(os.getenv("CHAT_DIGITANDO_INTERVALO_MS", "800"))
+
+_WORKER_ID = uuid.uuid4().hex
+
+_presenca_tarefa = None
+_presenca_stats = {"conexoes": 0, "desconexoes": 0, "eventos_online": 0, "eventos_offline": 0, "vencidas": 0}
+_offline_pendentes = set()  # usuários esperando o atraso do offline (neste worker)
+
+_digitando_ultimo = {}  # (usuario_id, sala) -> perf_counter do último repasse
+_digitando_stats = {"recebidos": 0, "repassados": 0}
+
+def _presenca_validade():
+    return datetime.utcnow() - timedelta(seconds=PRESENCA_HEARTBEAT_S * 3)
+
+def usuarios_online(ids=None) -> set:
+    """Ids com pelo menos 1 conexão viva (em qualquer worker)."""
+    q = (
+        db.session.query(PresencaSocket.usuario_id)
+        .filter(PresencaSocket.visto_em >= _presenca_validade())
+    )
+    if ids is not None:
+        q = q.filter(PresencaSocket.usuario_id.in_(list(ids)))
+    return {uid for (uid,) in q.distinct()}
+
+def online_na_sala(sala: str) -> list:
+    return sorted(
+        uid for (uid,) in db.session.query(PresencaSocket.usuario_id)
+        .filter(PresencaSocket.sala == sala, PresencaSocket.visto_em >= _presenca_validade())
+        .distinct()
+    )
+
+def _emitir_presenca(usuario_id: int, online: bool):
+    _presenca_stats["eventos_online" if online else "eventos_offline"] += 1
+    socketio.emit("presenca", {"usuario_id": usuario_id, "online": online})
+
+def _emitir_sala_online(sala: str):
+    socketio.emit("sala_online", {"sala": sala, "usuarios": online_na_sala(sala)}, room=sala)
+
+def registrar_conexao(sid: str, usuario_id: int):
+    global _presenca_tarefa
+    if _presenca_tarefa is None and PRESENCA_HEARTBEAT_S > 0:
+        _presenca_tarefa = socketio.start_background_task(_presenca_loop)
+
+    ja_online = bool(usuarios_online([usuario_id]))
+    agora = datetime.utcnow()
+    db.session.merge(PresencaSocket(
+        sid=sid, usuario_id=usuario_id, worker=_WORKER_ID, conectado_em=agora, visto_em=agora
+    ))
+    db.session.commit()
+    _presenca_stats["conexoes"] += 1
+
+    if usuario_id in _offline_pendentes:
+        # voltou dentro do atraso: os outros nem chegaram a ver offline
+        _offline_pendentes.discard(usuario_id)
+    elif not ja_online:
+        _emitir_presenca(usuario_id, True)
+
+def registrar_entrada_sala(sid: str, sala: str):
+    conexao = db.session.get(PresencaSocket, sid)
+    if conexao is None:
+        return
+    conexao.sala = sala
+    db.session.commit()
+    _emitir_sala_online(sala)
+
+def registrar_desconexao(sid: str):
+    conexao = db.session.get(PresencaSocket, sid)
+    if conexao is None:
+        return
+    usuario_id, sala = conexao.usuario_id, conexao.sala
+    db.session.delete(conexao)
+    db.session.commit()
+    _presenca_stats["desconexoes"] += 1
+
+    if sala:
+        _emitir_sala_online(sala)
+    if not usuarios_online([usuario_id]) and usuario_id not in _offline_pendentes:
+        _offline_pendentes.add(usuario_id)
+        socketio.start_background_task(_offline_apos_atraso, usuario_id)
+
+def _offline_apos_atraso(usuario_id: int):
+    socketio.sleep(PRESENCA_OFFLINE_ATRASO_S)
+    if usuario_id not in _offline_pendentes:
+        return  # reconectou neste worker
+    _offline_pendentes.discard(usuario_id)
+    with app.app_context():
+        try:
+            if not usuarios_online([usuario_id]):  # pode ter reconectado em outro worker
+                _emitir_presenca(usuario_id, False)
+        finally:
+            db.session.remove()
+
+def renovar_presenca():
+    """Renova as conexões deste worker e apaga as vencidas (de workers que caíram)."""
+    tabela = PresencaSocket.__table__
+    db.session.execute(
+        tabela.update().where(tabela.c.worker == _WORKER_ID).values(visto_em=datetime.utcnow())
+    )
+
+    validade = _presenca_validade()
+    vencidas = (
+        db.session.query(PresencaSocket.usuario_id, PresencaSocket.sala)
+        .filter(PresencaSocket.visto_em < validade)
+        .all()
+    )
+    if vencidas:
+        db.session.execute(tabela.delete().where(tabela.c.visto_em < validade))
+    db.session.commit()
+
+    if vencidas:
+        _presenca_stats["vencidas"] += len(vencidas)
+        usuarios = {v.usuario_id for v in vencidas}
+        for uid in usuarios - usuarios_online(usuarios):
+            _emitir_presenca(uid, False)
+        for sala in {v.sala for v in vencidas if v.sala}:
+            _emitir_sala_online(sala)
+
+    # avisos de "digitando" antigos não servem para nada
+    limite = perf_counter() - CHAT_DIGITANDO_INTERVALO_MS / 1000
+    for chave in [k for k, t in _digitando_ultimo.items() if t < limite]:
+        del _digitando_ultimo[chave]
+
+def _presenca_loop():
+    while True:
+        socketio.sleep(PRESENCA_HEARTBEAT_S)
+        with app.app_context():
+            try:
+                renovar_presenca()
+            except Exception as e:
+                db.session.rollback()
+                print("⚠️ Falha ao renovar presença:", e)
+            finally:
+                db.session.remove()
+
+def repassar_digitando(usuario_id: int, sala: str) -> bool:
+    """True se este "digitando" deve ser repassado (1 por intervalo por remetente+sala)."""
+    _digitando_stats["recebidos"] += 1
+    agora = perf_counter()
+    chave = (usuario_id, sala)
+    if agora - _digitando_ultimo.get(chave, float("-inf")) < CHAT_DIGITANDO_INTERVALO_MS / 1000:
+        return False
+    _digitando_ultimo[chave] = agora
+    _digitando_stats["repassados"] += 1
+    return True
+
+# ==================================================
+# NOTIFICAÇÕES EM TEMPO REAL (SALA POR USUÁRIO)
+# ==================================================
+# Todo socket com login entra na sala "user:<id>" (e a Direção também em
+# "direcao"), em qualquer página: o base.html abre a conexão. Chat,
+# trocas e edição de escala avisam por aqui em vez de o cliente
+# recarregar a página para descobrir o que mudou:
+# - "contadores" {chat, trocas}: números dos badges do menu (pode vir só
+#   uma das chaves; o cliente atualiza as que vierem)
+# - "notificacao" {tipo, texto, url, ...}: aviso rápido na tela
+# - "comunicado" {id, titulo, texto, url}: 1 broadcast para a sala
+#   "logados" (todo mundo conectado), igual para todos; o cliente soma 1
+#   no badge. O número certo de não vistos fica no servidor: é derivado
+#   de Funcionario.comunicado_visto_id (comunicados com id maior), volta
+#   em "contadores" a cada conexão e zera ao abrir /comunicados.
+# Com fila do Socket.IO ligada o emit chega no worker onde a pessoa está.
+
+SALA_DIRECAO = "direcao"
+SALA_LOGADOS = "logados"
+
+_notificacoes_stats = {"notificacoes": 0, "contadores": 0, "broadcasts": 0, "ultimo_broadcast_ms": None}
+
+def sala_usuario(usuario_id: int) -> str:
+    return f"user:{int(usuario_id)}"
+
+def notificar(usuario_ids, evento: str, dados: dict):
+    """Mesmo evento para vários usuários: 1 emit para todas as salas."""
+    salas = sorted({sala_usuario(uid) for uid in usuario_ids if uid})
+    if not salas:
+        return
+    _notificacoes_stats["notificacoes"] += 1
+    socketio.emit(evento, dados, to=salas)
+
+def notificar_direcao(evento: str, dados: dict):
+    _notificacoes_stats["notificacoes"] += 1
+    socketio.emit(evento, dados, to=SALA_DIRECAO)
+
+def publicar_comunicado(comunicado: Comunicado):
+    """Aviso compacto do comunicado novo para todos os sockets logados, num emit só."""
+    t0 = perf_counter()
+    socketio.emit("comunicado", {
+        "id": comunicado.id,
+        "titulo": comunicado.titulo,
+        "texto": f"📢 Novo comunicado: {comunicado.titulo}",
+        "url": url_for("comunicados"),
+    }, to=SALA_LOGADOS)
+    _notificacoes_stats["broadcasts"] += 1
+    _notificacoes_stats["ultimo_broadcast_ms"] = round((perf_counter() - t0) * 1000, 2)
+
+def _trocas_pendentes_direcao() -> int:
+    return TrocaPlantao.query.filter(TrocaPlantao.status == "PENDENTE").count()
+
+def contadores_usuarios(usuario_ids) -> dict:
+    """
+    {id: {"chat": não lidas, "trocas": pendentes, "comunicados": não vistos}}
+    com 4 consultas para a lista toda (comunicados só para funcionário).
+    """
+    ids = {int(u) for u in usuario_ids if u}
+    if not ids:
+        return {}
+
+    funcoes = {}
+    vistos = {}
+    for uid, funcao, visto in (
+        db.session.query(Funcionario.id, Funcionario.funcao, Funcionario.comunicado_visto_id)
+        .filter(Funcionario.id.in_(ids))
+    ):
+        funcoes[uid] = funcao
+        vistos[uid] = visto or 0
+    chat = dict(
+        db.session.query(ConversaResumo.usuario_id, db.func.sum(ConversaResumo.nao_lidas))
+        .filter(ConversaResumo.usuario_id.in_(ids))
+        .group_by(ConversaResumo.usuario_id)
+    )
+
+    # funcionário: pendentes em que é solicitante ou substituto
+    trocas = Counter()
+    for sol, sub in (
+        db.session.query(TrocaPlantao.solicitante_id, TrocaPlantao.substituto_id)
+        .filter(TrocaPlantao.status == "PENDENTE")
+        .filter(TrocaPlantao.solicitante_id.in_(ids) | TrocaPlantao.substituto_id.in_(ids))
+    ):
+        trocas[sol] += 1
+        if sub != sol:
+            trocas[sub] += 1
+
+    comunicado_ids = None  # ids em ordem crescente (lista curta); não vistos = quantos passam do visto
+    pendentes_direcao = None
+    resultado = {}
+    for uid in ids:
+        if uid not in funcoes:
+            continue
+        cont = {"chat": int(chat.get(uid) or 0)}
+        if funcoes[uid] == "Direção":
+            if pendentes_direcao is None:
+                pendentes_direcao = _trocas_pendentes_direcao()
+            cont["trocas"] = pendentes_direcao
+        else:
+            if comunicado_ids is None:
+                comunicado_ids = [i for (i,) in db.session.query(Comunicado.id).order_by(Comunicado.id)]
+            cont["trocas"] = trocas[uid]
+            cont["comunicados"] = len(comunicado_ids) - bisect_right(comunicado_ids, vistos[uid])
+        resultado[uid] = cont
+    return resultado
+
+def enviar_contadores(usuario_ids, sid: str | None = None):
+    """Manda os badges atualizados para a sala de cada usuário (ou só para o socket `sid`)."""
+    for uid, cont in contadores_usuarios(usuario_ids).items():
+        _notificacoes_stats["contadores"] += 1
+        socketio.emit("contadores", cont, to=sid or sala_usuario(uid))
+
+def enviar_contadores_direcao():
+    """Pedido de troca novo/decidido/cancelado: o badge de toda a Direção muda junto."""
+    _notificacoes_stats["contadores"] += 1
+    socketio.emit("contadores", {"trocas": _trocas_pendentes_direcao()}, to=SALA_DIRECAO)
+
+def notificar_trocas(trocas):
+    """Aviso para solicitante e substituto de cada troca decidida + badges."""
+    envolvidos = set()
+    for t in trocas:
+        envolvidos.update((t.solicitante_id, t.substituto_id))
+        notificar([t.solicitante_id, t.substituto_id], "notificacao", {
+            "tipo": "troca",
+            "id": t.id,
+            "status": t.status,
+            "texto": f"🔁 Troca de {t.data.strftime('%d/%m/%Y')}: {t.status.lower()}",
+            "url": url_for("trocas_plantao"),
+        })
+    enviar_contadores(envolvidos)
+    enviar_contadores_direcao()
+
+def notificar_escala_alterada(escala: EscalaMes, celulas):
+    """Quem teve dia alterado na grade recebe 1 aviso com os seus dias."""
+    dias_por_func = {}
+    for c in celulas:
+        dias_por_func.setdefault(c["funcionario_id"], set()).add(c["dia"])
+
+    for fid, dias in dias_por_func.items():
+        dias = sorted(dias)
+        notificar([fid], "notificacao", {
+            "tipo": "escala",
+            "escala_mes_id": escala.id,
+            "dias": dias,
+            "texto": f"📅 Sua escala de {escala.mes:02d}/{escala.ano} mudou (dia{'s' if len(dias) > 1 else ''} {', '.join(map(str, dias))})",
+            "url": url_for("escalas_view"),
+        })
+
 # ==================================================
 # SOCKET.IO
 # ==================================================
 
+@socketio.on("connect")
+def handle_connect(auth=None):
+    # sessão do Flask (cookie do login); socket sem login conecta, mas não conta como online
+    usuario_id = session.get("user_id")
+    if usuario_id:
+        registrar_conexao(request.sid, usuario_id)
+        join_room(sala_usuario(usuario_id))
+        join_room(SALA_LOGADOS)
+        if session.get("funcao") == "Direção":
+            join_room(SALA_DIRECAO)
+        enviar_contadores([usuario_id], sid=request.sid)
+
+@socketio.on("disconnect")
+def handle_disconnect(motivo=None):
+    registrar_desconexao(request.sid)
+
+def sala_conversa_permitida(sala, usuario_id) -> bool:
+    """
+    Só sala de conversa "menor_maior" (ids numéricos) que tem o usuário.
+    As salas do servidor ("user:<id>", "direcao", "logados") não passam:
+    nelas só se entra pelo connect.
+    """
+    partes = str(sala or "").split("_")
+    if len(partes) != 2 or not all(p.isdigit() for p in partes):
+        return False
+    a, b = int(partes[0]), int(partes[1])
+    return sala == f"{a}_{b}" and a <= b and int(usuario_id) in (a, b)
+
 @socketio.on("join")
 def handle_join(data):
-    join_room(data["room"])
+    # quem entra vem da sessão; sala de outra pessoa (ou reservada) é ignorada
+    sala = (data or {}).get("room")
+    usuario_id = session.get("user_id")
+    if not usuario_id or not sala_conversa_permitida(sala, usuario_id):
+        return
+
+    join_room(sala)
+    registrar_entrada_sala(request.sid, sala)
+
+@socketio.on("typing")
+def handle_typing(data):
+    # só a sessão diz quem está digitando ("from" vem do cliente e não vale)
+    sala = (data or {}).get("room")
+    usuario_id = session.get("user_id")
+    if not sala or not usuario_id:
+        return
+
+    # só quem é da conversa ("menor_maior")
+    if not sala_conversa_permitida(sala, usuario_id):
+        return
+
+    if repassar_digitando(int(usuario_id), sala):
+        emit("show_typing", {"from": int(usuario_id), "room": sala}, room=sala, include_self=False)
 
 @socketio.on("send_message")
 def handle_message(data):
-    limpar_mensagens_vencidas()
-
     remetente = int(data["from"])
     destino = int(data["to"])
     texto = data["text"]
     arquivo = data.get("file")
     room = data["room"]
 
-    msg = Mensagem(
-        remetente_id=remetente,
-        destinatario_id=destino,
-        texto=texto,
-        arquivo=arquivo,
-        data_envio=datetime.utcnow(),
-        expira_em=datetime.utcnow() + timedelta(hours=15)
-    )
+    agora = datetime.utcnow()
+    dados = {
+        "remetente_id": remetente,
+        "destinatario_id": destino,
+        "texto": texto,
+        "arquivo": arquivo,
+        "data_envio": agora,
+        "expira_em": agora + timedelta(hours=15),
+    }
 
-    db.session.add(msg)
-    db.session.commit()
+    if CHAT_GRAVACAO_ASSINCRONA:
+        enfileirar_mensagem(dados)
+    else:
+        msg = Mensagem(**dados)
+        db.session.add(msg)
+        db.session.flush()
+        registrar_resumos([msg])
+        db.session.commit()
+        enviar_contadores([destino])
 
     emit("receive", {
         "from": remetente,
         "text": texto,
         "file": arquivo,
-        "time": msg.data_envio.strftime("%H:%M")
+        "thumb": url_miniatura_chat(arquivo),
+        "time": agora.strftime("%H:%M")
     }, room=room)
 
+    if destino != remetente:
+        notificar([destino], "notificacao", {
+            "tipo": "chat",
+            "de": remetente,
+            "texto": f"💬 {session.get('nome') or 'Nova mensagem'}: {_previa_mensagem(texto, arquivo) or ''}",
+            "url": url_for("chat", destino_id=remetente),
+        })
+
+# ==================================================
+# CHAT - ANEXOS (IMAGEM REDUZIDA + MINIATURA)
+# ==================================================
+# Imagem anexada é gravada já reduzida (CHAT_IMAGEM_MAX_LADO px, sem
+# EXIF/GPS, JPEG progressivo). A conversa mostra só a miniatura WebP
+# (CHAT_MINIATURA_LADO px), gerada na 1ª vez que alguém abre e guardada em
+# CHAT_MINIATURAS_DIR; a imagem inteira só desce no clique.
+# Arquivo que não é imagem (ou que o Pillow não abre) é gravado como veio.
+
+CHAT_IMAGEM_MAX_LADO = int(os.getenv("CHAT_IMAGEM_MAX_LADO", "1600"))
+CHAT_IMAGEM_QUALIDADE = int(os.getenv("CHAT_IMAGEM_QUALIDADE", "80"))
+CHAT_MINIATURA_LADO = int(os.getenv("CHAT_MINIATURA_LADO", "320"))
+CHAT_MINIATURAS_DIR = os.getenv("CHAT_MINIATURAS_DIR", os.path.join(app.instance_path, "cache", "chat_miniaturas"))
+os.makedirs(CHAT_MINIATURAS_DIR, exist_ok=True)
+
+_anexos_stats = {"imagens": 0, "bytes_recebidos": 0, "bytes_gravados": 0, "falhas": 0, "miniaturas": 0}
+
+def salvar_anexo_chat(file_storage) -> str:
+    """Grava o anexo em static/uploads/chat e devolve o nome final."""
+    os.makedirs(UPLOAD_CHAT, exist_ok=True)
+
+    nome = secure_filename(file_storage.filename)
+    base, ext = os.path.splitext(nome)
+    carimbo = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    if imagens_chat.eh_imagem(nome):
+        try:
+            recebidos = file_storage.stream.seek(0, os.SEEK_END)
+            file_storage.stream.seek(0)
+            conteudo, ext_nova = imagens_chat.reduzir_imagem(
+                file_storage.stream, CHAT_IMAGEM_MAX_LADO, CHAT_IMAGEM_QUALIDADE
+            )
+        except Exception as e:
+            _anexos_stats["falhas"] += 1
+            print(f"⚠️ Anexo {nome}: não deu para reduzir ({e}); gravado como veio")
+            file_storage.stream.seek(0)
+        else:
+            nome_final = f"{base}_{carimbo}{ext_nova}"
+            with open(os.path.join(UPLOAD_CHAT, nome_final), "wb") as fh:
+                fh.write(conteudo)
+            _anexos_stats["imagens"] += 1
+            _anexos_stats["bytes_recebidos"] += recebidos
+            _anexos_stats["bytes_gravados"] += len(conteudo)
+            return nome_final
+
+    nome_final = f"{base}_{carimbo}{ext}"
+    file_storage.save(os.path.join(UPLOAD_CHAT, nome_final))
+    return nome_final
+
+def _miniatura_chat_path(nome: str) -> str:
+    return os.path.join(CHAT_MINIATURAS_DIR, f"{nome}.{CHAT_MINIATURA_LADO}.webp")
+
+def url_miniatura_chat(nome):
+    """URL da miniatura do anexo (None se não for imagem)."""
+    if not nome or not imagens_chat.eh_imagem(nome):
+        return None
+    return url_for("chat_miniatura", nome=nome)
+
+@app.context_processor
+def inject_miniatura_chat():
+    return dict(miniatura_chat=url_miniatura_chat)
+
+@app.get("/chat/anexo/<nome>/miniatura")
+@login_required
+def chat_miniatura(nome):
+    nome = secure_filename(nome)
+    origem = os.path.join(UPLOAD_CHAT, nome)
+    if not imagens_chat.eh_imagem(nome) or not os.path.isfile(origem):
+        abort(404)
+
+    destino = _miniatura_chat_path(nome)
+    if not os.path.exists(destino):
+        try:
+            imagens_chat.gerar_miniatura(origem, destino, CHAT_MINIATURA_LADO)
+        except Exception as e:
+            print(f"⚠️ Miniatura de {nome}: {e}")
+            # sem miniatura: manda a própria imagem
+            return send_file(origem, max_age=7 * 86400)
+        _anexos_stats["miniaturas"] += 1
+
+    # nome do anexo leva data/hora e nunca é reaproveitado: pode ficar em cache no navegador
+    return send_file(destino, mimetype="image/webp", max_age=7 * 86400)
+
 # ==================================================
 # UPLOAD CHAT
 # ==================================================
@@ -1787,12 +3342,7 @@ def handle_message(data):
 @login_required
 def upload_chat():
     file = request.files["file"]
-    os.makedirs(UPLOAD_CHAT, exist_ok=True)
-
-    name = secure_filename(file.filename)
-    base, ext = os.path.splitext(name)
-    name_final = f"{base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
-    file.save(os.path.join(UPLOAD_CHAT, name_final))
+    name_final = salvar_anexo_chat(file)
 
     return {"filename": name_final}
 
@@ -1805,21 +3355,161 @@ def upload_chat():
 def conversas():
     user_id = session["user_id"]
 
-    mensagens = Mensagem.query.filter(
-        (Mensagem.remetente_id == user_id) |
-        (Mensagem.destinatario_id == user_id)
-    ).order_by(Mensagem.data_envio.desc()).all()
+    # 1 leitura no índice (usuario_id, ultimo_envio), mais recentes primeiro
+    conversas = (
+        db.session.query(
+            ConversaResumo.contato_id.label("id"),
+            Funcionario.nome,
+            Funcionario.funcao,
+            ConversaResumo.ultimo_texto,
+            ConversaResumo.ultimo_envio,
+            ConversaResumo.ultimo_remetente_id,
+            ConversaResumo.nao_lidas,
+        )
+        .join(Funcionario, Funcionario.id == ConversaResumo.contato_id)
+        .filter(ConversaResumo.usuario_id == user_id)
+        .order_by(ConversaResumo.ultimo_envio.desc())
+        .limit(CONVERSAS_LISTA_MAX)
+        .all()
+    )
+    return render_template("conversas.html", contatos=conversas)
 
-    contatos_ids = set()
+# ==================================================
+# DIRETÓRIO DE FUNCIONÁRIOS (CACHE + BUSCA)
+# ==================================================
+# Lista (id, nome, setor, cargo, status, função) em memória, em ordem de
+# nome, com a chave de busca de cada pessoa já calculada (minúsculas, sem
+# acento: as palavras do nome, setor e cargo). Chat, contatos e troca de
+# plantão mostram só as primeiras DIRETORIO_SUGESTOES; o resto vem da
+# busca /funcionarios/busca enquanto a pessoa digita.
+# - busca: cada palavra digitada é começo de alguma palavra da pessoa
+#   ("jo silv" acha "João da Silva"); bisect no índice de palavras ordenado
+# - versão em versao_cache ("diretorio"): criar/editar/excluir/importar
+#   funcionário sobe na mesma transação. Neste processo remonta na hora;
+#   os outros workers conferem a cada DIRETORIO_VERIFICAR_S segundos.
+
+DIRETORIO_VERIFICAR_S = float(os.getenv("DIRETORIO_VERIFICAR_S", "5"))
+DIRETORIO_SUGESTOES = int(os.getenv("DIRETORIO_SUGESTOES", "20"))
+
+_diretorio = {"versao": None, "verificado": float("-inf"), "pessoas": [], "por_id": {}, "palavras": []}
+_diretorio_stats = {"reconstrucoes": 0, "buscas": 0}
+
+def _palavras_busca(texto) -> list:
+    # mesma normalização dos cabeçalhos do CSV: "Conceição D'Ávila" -> ["conceicao", "davila"]
+    return [p for p in _norm_col(texto).split("_") if p]
+
+def _bump_versao_diretorio():
+    """Chamar antes do commit de quem cria/edita/exclui funcionário."""
+    tabela = VersaoCache.__table__
+    r = db.session.execute(
+        tabela.update().where(tabela.c.nome == "diretorio").values(versao=tabela.c.versao + 1)
+    )
+    if not r.rowcount:
+        db.session.execute(tabela.insert().values(nome="diretorio", versao=1))
+    _diretorio["verificado"] = float("-inf")  # próxima leitura confere no banco
+
+def obter_diretorio():
+    agora = perf_counter()
+    if agora - _diretorio["verificado"] < DIRETORIO_VERIFICAR_S:
+        return _diretorio
+
+    versao = db.session.query(VersaoCache.versao).filter(VersaoCache.nome == "diretorio").scalar() or 0
+    _diretorio["verificado"] = agora
+    if versao == _diretorio["versao"]:
+        return _diretorio
+
+    t0 = perf_counter()
+    pessoas = []
+    palavras = []
+    for f in (
+        db.session.query(
+            Funcionario.id, Funcionario.nome, Funcionario.setor,
+            Funcionario.cargo, Funcionario.status, Funcionario.funcao,
+        )
+        .order_by(Funcionario.nome, Funcionario.id)
+    ):
+        i = len(pessoas)
+        nome = _palavras_busca(f.nome)
+        extras = _palavras_busca(f"{f.setor or ''} {f.cargo or ''}")
+        pessoas.append({
+            "id": f.id,
+            "nome": f.nome,
+            "setor": f.setor,
+            "cargo": f.cargo,
+            "status": f.status,
+            "funcao": f.funcao,
+            "chave": " ".join(nome),                  # nome inteiro (começa com o que foi digitado = vem antes)
+            "palavras": frozenset(nome + extras),
+        })
+        palavras.extend((p, i) for p in set(nome + extras))
+    palavras.sort()
+
+    _diretorio.update(
+        versao=versao,
+        pessoas=pessoas,
+        por_id={p["id"]: p for p in pessoas},
+        palavras=palavras,
+    )
+    _diretorio_stats["reconstrucoes"] += 1
+    print(f"📇 Diretório v{versao}: {len(pessoas)} funcionários em {perf_counter() - t0:.3f}s")
+    return _diretorio
 
-    for m in mensagens:
-        if m.remetente_id == user_id:
-            contatos_ids.add(m.destinatario_id)
-        else:
-            contatos_ids.add(m.remetente_id)
+def buscar_funcionarios(termo: str = "", limite: int = DIRETORIO_SUGESTOES, excluir_id=None, so_ativos=False):
+    """
+    Até `limite` pessoas do diretório (dicts sem as chaves de busca).
+    Sem termo: as primeiras em ordem de nome. Com termo: quem tem o nome
+    começando pelo que foi digitado vem primeiro, depois os demais acertos.
+    """
+    _diretorio_stats["buscas"] += 1
+    d = obter_diretorio()
+    pessoas = d["pessoas"]
+    termos = _palavras_busca(termo)
+
+    if termos:
+        # candidatos pela palavra digitada mais longa (faixa do índice ordenado)
+        maior = max(termos, key=len)
+        palavras = d["palavras"]
+        i = bisect_left(palavras, (maior,))
+        candidatos = set()
+        while i < len(palavras) and palavras[i][0].startswith(maior):
+            candidatos.add(palavras[i][1])
+            i += 1
+
+        outros = [t for t in termos if t != maior]
+        acertos = [
+            pessoas[i] for i in sorted(candidatos)
+            if all(any(p.startswith(t) for p in pessoas[i]["palavras"]) for t in outros)
+        ]
+        prefixo = " ".join(termos)
+        acertos.sort(key=lambda p: not p["chave"].startswith(prefixo))  # sort estável: segue a ordem de nome
+    else:
+        acertos = pessoas
 
-    contatos = Funcionario.query.filter(Funcionario.id.in_(contatos_ids)).all()
-    return render_template("conversas.html", contatos=contatos)
+    resultado = []
+    for p in acertos:
+        if p["id"] == excluir_id or (so_ativos and p["status"] != "Ativo"):
+            continue
+        resultado.append({k: p[k] for k in ("id", "nome", "setor", "cargo", "status", "funcao")})
+        if len(resultado) >= limite:
+            break
+    return resultado
+
+@app.get("/funcionarios/busca")
+@login_required
+def funcionarios_busca():
+    """Busca do diretório para os campos de contato/substituto (JSON)."""
+    limite = min(max(request.args.get("limite", DIRETORIO_SUGESTOES, type=int), 1), 50)
+    resultado = buscar_funcionarios(
+        request.args.get("q", ""),
+        limite=limite,
+        excluir_id=session["user_id"] if request.args.get("excluir_eu") == "1" else None,
+        so_ativos=request.args.get("ativos") == "1",
+    )
+    if request.args.get("online") == "1" and resultado:
+        online = usuarios_online([p["id"] for p in resultado])
+        for p in resultado:
+            p["online"] = p["id"] in online
+    return {"versao": _diretorio["versao"], "resultados": resultado}
 
 # ==================================================
 # LISTA DE CONTATOS PARA CHAT
@@ -1828,10 +3518,79 @@ def conversas():
 @app.route("/contatos-chat")
 @login_required
 def contatos_chat():
-    user_id = session["user_id"]
-    contatos = Funcionario.query.filter(Funcionario.id != user_id).order_by(Funcionario.nome).all()
+    contatos = buscar_funcionarios(excluir_id=session["user_id"])
     return render_template("contatos_chat.html", contatos=contatos)
 
+# ==================================================
+# HISTÓRICO DO CHAT (PAGINAÇÃO POR CURSOR)
+# ==================================================
+# Página = as N mensagens anteriores ao cursor (data_envio, id).
+# Cada sentido da conversa (A->B e B->A) é 1 busca no índice
+# ix_msg_pair_time com LIMIT; as duas são intercaladas em Python.
+# Custo igual para conversa curta ou longa.
+
+CHAT_PAGINA = 50
+CHAT_PAGINA_MAX = 200
+
+def _cursor_chat(m):
+    return f"{m.data_envio.isoformat()}_{m.id}"
+
+def _parse_cursor_chat(s: str | None):
+    try:
+        data, mid = (s or "").rsplit("_", 1)
+        return datetime.fromisoformat(data), int(mid)
+    except ValueError:
+        return None
+
+def historico_chat(user_id: int, outro_id: int, antes=None, limite: int = CHAT_PAGINA):
+    """
+    (mensagens em ordem cronológica, cursor da página anterior ou None).
+    - antes: (data_envio, id) da mensagem mais antiga já exibida
+    """
+    agora = datetime.utcnow()
+    mensagens = []
+    for rem, dest in ((user_id, outro_id), (outro_id, user_id)):
+        q = (
+            Mensagem.query
+            .filter(Mensagem.remetente_id == rem, Mensagem.destinatario_id == dest)
+            .filter(Mensagem.expira_em >= agora)  # vencidas ainda não varridas
+        )
+        if antes:
+            q = q.filter(db.tuple_(Mensagem.data_envio, Mensagem.id) < antes)
+        mensagens.extend(
+            q.order_by(Mensagem.data_envio.desc(), Mensagem.id.desc()).limit(limite + 1).all()
+        )
+
+    mensagens.sort(key=lambda m: (m.data_envio, m.id), reverse=True)
+    tem_mais = len(mensagens) > limite
+    pagina = mensagens[:limite][::-1]
+    return pagina, (_cursor_chat(pagina[0]) if tem_mais and pagina else None)
+
+def _mensagem_json(m):
+    return {
+        "id": m.id,
+        "from": m.remetente_id,
+        "text": m.texto,
+        "file": m.arquivo,
+        "thumb": url_miniatura_chat(m.arquivo),
+        "time": m.data_envio.strftime("%H:%M"),
+        "data": m.data_envio.isoformat(timespec="seconds"),
+    }
+
+@app.route("/chat/<int:destino_id>/historico")
+@login_required
+def chat_historico(destino_id):
+    """?antes=<cursor>&limite=N -> {"mensagens": [...], "proximo": cursor | null}"""
+    antes = None
+    if request.args.get("antes"):
+        antes = _parse_cursor_chat(request.args.get("antes"))
+        if antes is None:
+            return {"ok": False, "error": "Cursor inválido"}, 400
+
+    limite = min(max(request.args.get("limite", CHAT_PAGINA, type=int), 1), CHAT_PAGINA_MAX)
+    mensagens, proximo = historico_chat(session["user_id"], destino_id, antes=antes, limite=limite)
+    return {"ok": True, "mensagens": [_mensagem_json(m) for m in mensagens], "proximo": proximo}
+
 # ==================================================
 # CHAT PRINCIPAL (ESTILO WHATSAPP)
 # ==================================================
@@ -1840,27 +3599,37 @@ def contatos_chat():
 @app.route("/chat/<int:destino_id>", methods=["GET"])
 @login_required
 def chat(destino_id=None):
-    limpar_mensagens_vencidas()
-
     user = Funcionario.query.get(session["user_id"])
 
-    contatos = Funcionario.query.filter(Funcionario.id != user.id).order_by(Funcionario.nome).all()
+    # só as primeiras do diretório; o resto vem da busca (/funcionarios/busca)
+    contatos = buscar_funcionarios(excluir_id=user.id)
 
     mensagens = []
+    proximo = None
     outro = None
     sala = None
 
     if destino_id:
         outro = Funcionario.query.get_or_404(destino_id)
 
-        mensagens = Mensagem.query.filter(
-            ((Mensagem.remetente_id == user.id) & (Mensagem.destinatario_id == destino_id)) |
-            ((Mensagem.remetente_id == destino_id) & (Mensagem.destinatario_id == user.id))
-        ).order_by(Mensagem.data_envio).all()
+        # só a última página; as anteriores vêm de /chat/<id>/historico ao rolar
+        mensagens, proximo = historico_chat(user.id, destino_id)
+
+        marcar_conversa_lida(user.id, destino_id)
+        db.session.commit()
+        enviar_contadores([user.id])
 
         sala = f"{min(user.id, destino_id)}_{max(user.id, destino_id)}"
 
-    return render_template("chat.html", contatos=contatos, mensagens=mensagens, outro=outro, sala=sala)
+    return render_template(
+        "chat.html",
+        contatos=contatos,
+        mensagens=mensagens,
+        proximo=proximo,
+        outro=outro,
+        sala=sala,
+        online=usuarios_online()
+    )
 
 # ==================================================
 # ACESSO NEGADO
@@ -1886,78 +3655,484 @@ def month_range(ano: int, mes: int):
     last_day = date(ano, mes, calendar.monthrange(ano, mes)[1])
     return first_day, last_day
 
+# ==================================================
+# CACHE DE GRADES DA ESCALA (LRU EM MEMÓRIA)
+# ==================================================
+# Grade "decodificada" de uma EscalaMes: matriz int8 (funcionários × dias)
+# + índice ordenado de equipes/funcionários. Usada pela tela da escala,
+# pelo PDF, pelos gráficos, pela cobertura e pelas trocas. Toda rota que
+# altera itens/equipes precisa chamar _grade_cache_invalidar() ou
+# _grade_cache_patch().
+#
+# Cada grade guarda a EscalaMes.versao com que foi montada e obter_grade
+# confere a versão no banco (1 SELECT pela PK): alteração feita em outro
+# worker (que sobe a versão) faz este processo remontar a grade.
+#
+# Escala em armazenamento "regras": a matriz sai da regra de cada
+# funcionário (escala_grid.calcular_grade, conta fechada por dia) e os
+# EscalaItem gravados são só as exceções, aplicadas por cima.
+
+ESCALA_CACHE_MAX = int(os.getenv("ESCALA_CACHE_MAX", "32"))
+
+_grade_cache = OrderedDict()
+_grade_cache_stats = {"hits": 0, "misses": 0, "desatualizadas": 0}
+
+def _ordem_equipe(nome):
+    # EQUIPE 1..N, sem número depois, SEM EQUIPE por último
+    n = (nome or "").upper().strip()
+    if n == "SEM EQUIPE":
+        return (999, n)
+    num = "".join(ch for ch in n if ch.isdigit())
+    return (int(num) if num else 500, n)
+
+def _montar_grade(escala_mes_id: int):
+    escala = EscalaMes.query.get(escala_mes_id)
+    if not escala:
+        return None
+
+    itens = (
+        db.session.query(EscalaItem.funcionario_id, EscalaItem.inicio, EscalaItem.tipo, EscalaItem.observacao)
+        .filter(EscalaItem.escala_mes_id == escala.id)
+        .order_by(EscalaItem.funcionario_id.asc(), EscalaItem.inicio.asc())
+        .all()
+    )
+    regras = (
+        db.session.query(EscalaRegra.funcionario_id, EscalaRegra.escala_tipo, EscalaRegra.plantao_base)
+        .filter(EscalaRegra.escala_mes_id == escala.id)
+        .all()
+    ) if escala.armazenamento == "regras" else []
+    func_ids = sorted(set(i.funcionario_id for i in itens) | set(r.funcionario_id for r in regras))
+
+    funcs = (
+        db.session.query(
+            Funcionario.id, Funcionario.nome, Funcionario.setor, Funcionario.equipe,
+            Funcionario.escala_tipo, Funcionario.plantao_base,
+            Funcionario.carga_horaria, Funcionario.tipo_vinculo
+        )
+        .filter(Funcionario.id.in_(func_ids))
+        .all()
+    ) if func_ids else []
+    funcionarios = {f.id: dict(f._mapping) for f in funcs}
+
+    # agrupa por equipe e ordena nomes dentro da equipe
+    por_equipe = {}
+    for fid in func_ids:
+        f = funcionarios.get(fid)
+        equipe = ((f or {}).get("equipe") or "SEM EQUIPE").strip().upper()
+        por_equipe.setdefault(equipe, []).append(fid)
+
+    equipes = []
+    for equipe in sorted(por_equipe, key=_ordem_equipe):
+        ids = sorted(
+            por_equipe[equipe],
+            key=lambda fid: ((funcionarios.get(fid) or {}).get("nome") or "").upper()
+        )
+        equipes.append((equipe, ids))
+
+    ordem = [fid for _, ids in equipes for fid in ids]
+    linha = {fid: i for i, fid in enumerate(ordem)}
+
+    dias_no_mes = calendar.monthrange(escala.ano, escala.mes)[1]
+    matriz = np.zeros((len(ordem), dias_no_mes), dtype=np.int8)
+    obs = {}
+
+    if regras:
+        linhas_regra = [linha[r.funcionario_id] for r in regras]
+        matriz[linhas_regra] = escala_grid.calcular_grade(
+            [(r.escala_tipo, r.plantao_base) for r in regras], escala.ano, escala.mes
+        )
+
+    for it in itens:
+        li = linha[it.funcionario_id]
+        d = it.inicio.day
+        matriz[li, d - 1] = escala_grid.CODIGO_POR_TIPO.get(it.tipo, escala_grid.VAZIO)
+        if it.observacao:
+            obs[(it.funcionario_id, d)] = it.observacao
+        else:
+            obs.pop((it.funcionario_id, d), None)
+
+    return {
+        "escala": {"id": escala.id, "ano": escala.ano, "mes": escala.mes, "setor": escala.setor},
+        "versao": escala.versao or 0,
+        "dias": list(range(1, dias_no_mes + 1)),
+        "func_ids": ordem,
+        "linha": linha,
+        "funcionarios": funcionarios,
+        "equipes": equipes,
+        "matriz": matriz,
+        "obs": obs,
+    }
+
+def obter_grade(escala_mes_id: int):
+    """Grade da escala (do cache ou montada do banco). None se não existir."""
+    grade = _grade_cache.get(escala_mes_id)
+    if grade is not None:
+        if _versao_escala(escala_mes_id) == grade["versao"]:
+            _grade_cache.move_to_end(escala_mes_id)
+            _grade_cache_stats["hits"] += 1
+            return grade
+        _grade_cache_stats["desatualizadas"] += 1
+        _grade_cache.pop(escala_mes_id, None)
+
+    _grade_cache_stats["misses"] += 1
+    grade = _montar_grade(escala_mes_id)
+    if grade is None:
+        return None
+
+    _grade_cache[escala_mes_id] = grade
+    while len(_grade_cache) > ESCALA_CACHE_MAX:
+        _grade_cache.popitem(last=False)
+    return grade
+
+def _versao_escala(escala_mes_id: int):
+    # None se a escala foi excluída
+    versao = db.session.query(EscalaMes.versao).filter(EscalaMes.id == escala_mes_id).first()
+    return None if versao is None else (versao[0] or 0)
+
+def _grade_cache_invalidar(escala_mes_id: int | None = None):
+    # None = limpa tudo (ex.: mudou nome/equipe de funcionário)
+    _indice_plantao_invalidar()  # índice de plantão confere as versões de novo
+    if escala_mes_id is None:
+        _grade_cache.clear()
+    else:
+        _grade_cache.pop(escala_mes_id, None)
+
+def _grade_cache_patch(escala_mes_id: int, celulas):
+    # atualiza as células [(funcionario_id, dia, tipo), ...] de 1 commit sem
+    # remontar (chamar depois do commit que subiu a versão; 1 leitura da versão
+    # por lote); se algum funcionário não está na grade ou houve outra
+    # alteração no meio, invalida
+    _indice_plantao_invalidar()
+    grade = _grade_cache.get(escala_mes_id)
+    if grade is None:
+        return
+    versao = _versao_escala(escala_mes_id)
+    # versão + 1: só o nosso commit aconteceu desde que a grade foi montada
+    if versao not in (grade["versao"], grade["versao"] + 1):
+        _grade_cache_invalidar(escala_mes_id)
+        return
+    for funcionario_id, dia, tipo in celulas:
+        li = grade["linha"].get(funcionario_id)
+        if li is None or not (1 <= dia <= len(grade["dias"])):
+            _grade_cache_invalidar(escala_mes_id)
+            return
+        grade["matriz"][li, dia - 1] = escala_grid.CODIGO_POR_TIPO.get(tipo, escala_grid.VAZIO)
+    grade["versao"] = versao
+
 def generate_items_for_funcionario(func: Funcionario, escala_mes: EscalaMes, ano: int, mes: int):
     """
     Gera EscalaItem para 1 funcionário no mês:
     - SEG_SEX: seg-sex 08:00-17:00, sáb/dom FOLGA
     - PLANTONISTA_24_96: 24h a cada 5 dias (1 plantão + 4 folgas) baseado em plantao_base
+    (usa o mesmo cálculo da geração em lote; só grava o que mudou e
+    preserva células fixadas)
     """
-    inicio_mes, fim_mes = month_range(ano, mes)
+    return regenerar_incremental(escala_mes, [func], remover_ausentes=False)
 
-    EscalaItem.query.filter_by(
-        escala_mes_id=escala_mes.id,
-        funcionario_id=func.id
-    ).delete()
+# ==================================================
+# GERAÇÃO EM LOTE (MÊS INTEIRO)
+# ==================================================
 
-    escala_tipo = (func.escala_tipo or "SEG_SEX").strip().upper()
+ESCALA_INSERT_LOTE = 2000
 
-    if escala_tipo in ("DIURNO", "DIARIO"):
-        escala_tipo = "SEG_SEX"
+# "regras" (padrão): 1 linha por funcionário + exceções; "itens": 1 linha por pessoa/dia
+ESCALA_ARMAZENAMENTO = os.getenv("ESCALA_ARMAZENAMENTO", "regras").strip().lower()
 
-    if escala_tipo == "SEG_SEX":
-        d = inicio_mes
-        while d <= fim_mes:
-            if d.weekday() <= 4:
-                ini = datetime.combine(d, time(8, 0))
-                fim = datetime.combine(d, time(17, 0))
-                tipo = "EXPEDIENTE"
-            else:
-                ini = datetime.combine(d, time(0, 0))
-                fim = datetime.combine(d, time(23, 59))
-                tipo = "FOLGA"
-
-            db.session.add(EscalaItem(
-                escala_mes_id=escala_mes.id,
-                funcionario_id=func.id,
-                inicio=ini,
-                fim=fim,
-                tipo=tipo,
-                observacao=None
-            ))
-            d += timedelta(days=1)
-        return
+def _inserir_grade(escala_mes: EscalaMes, grade, funcionario_ids, regras=None, commit_por_lote=False):
+    """
+    1 DELETE por escala_mes + INSERT em lotes (core, sem objetos ORM).
+    - regras: [(escala_tipo, plantao_base)] na ordem da grade; com
+      ESCALA_ARMAZENAMENTO="regras" grava só 1 EscalaRegra por funcionário
+      (sem exceções: a geração completa descarta edições anteriores)
+    - commit_por_lote=True: commita a cada lote e devolve a vez ao eventlet,
+      para não segurar o lock de escrita do SQLite por muito tempo
+    Retorna o total de células (dias com item) da escala.
+    """
+    db.session.execute(
+        EscalaItem.__table__.delete().where(EscalaItem.escala_mes_id == escala_mes.id)
+    )
+    db.session.execute(
+        EscalaRegra.__table__.delete().where(EscalaRegra.escala_mes_id == escala_mes.id)
+    )
 
-    if escala_tipo == "PLANTONISTA_24_96":
-        base = parse_date_yyyy_mm_dd(func.plantao_base) if func.plantao_base else None
-        if not base:
-            return
+    if regras is not None and ESCALA_ARMAZENAMENTO == "regras":
+        escala_mes.armazenamento = "regras"
+        # funcionário sem regra válida (linha vazia) não entra, igual ao formato antigo
+        linhas = [
+            {
+                "escala_mes_id": escala_mes.id,
+                "funcionario_id": fid,
+                "escala_tipo": tipo,
+                "plantao_base": base,
+            }
+            for fid, (tipo, base), tem in zip(funcionario_ids, regras, grade.any(axis=1).tolist())
+            if tem
+        ]
+        for i in range(0, len(linhas), ESCALA_INSERT_LOTE):
+            db.session.execute(EscalaRegra.__table__.insert(), linhas[i:i + ESCALA_INSERT_LOTE])
+
+        _bump_versao_escala(escala_mes_ids=[escala_mes.id])
+        if commit_por_lote:
+            db.session.commit()
 
-        start_hour = time(7, 0)
+        _grade_cache_invalidar(escala_mes.id)
+        return int(np.count_nonzero(grade))
+
+    escala_mes.armazenamento = "itens"
+    total = 0
+    lote = []
+    linhas = escala_grid.linhas_da_grade(grade, funcionario_ids, escala_mes.id, escala_mes.ano, escala_mes.mes)
+    for linha in linhas:
+        lote.append(linha)
+        if len(lote) >= ESCALA_INSERT_LOTE:
+            db.session.execute(EscalaItem.__table__.insert(), lote)
+            total += len(lote)
+            lote = []
+            if commit_por_lote:
+                db.session.commit()
+                socketio.sleep(0)
+    if lote:
+        db.session.execute(EscalaItem.__table__.insert(), lote)
+        total += len(lote)
+
+    _bump_versao_escala(escala_mes_ids=[escala_mes.id])
+    if commit_por_lote:
+        db.session.commit()
 
-        d = inicio_mes
-        while d <= fim_mes:
-            delta_days = (d - base).days
-            if delta_days >= 0 and (delta_days % 5 == 0):
-                ini = datetime.combine(d, start_hour)
-                fim = ini + timedelta(hours=24)
-                tipo = "PLANTAO_24H"
-            else:
-                ini = datetime.combine(d, time(0, 0))
-                fim = datetime.combine(d, time(23, 59))
-                tipo = "FOLGA"
-
-            db.session.add(EscalaItem(
-                escala_mes_id=escala_mes.id,
-                funcionario_id=func.id,
-                inicio=ini,
-                fim=fim,
-                tipo=tipo,
-                observacao=None
-            ))
-            d += timedelta(days=1)
-        return
+    _grade_cache_invalidar(escala_mes.id)
+    return total
+
+def _diff_grade(escala_mes: EscalaMes, grade, funcionario_ids, remover_ausentes=True):
+    """
+    Compara a grade alvo com os itens já gravados e executa só o necessário:
+    - INSERT onde não existe item no dia
+    - UPDATE onde o tipo mudou
+    - DELETE onde a regra não gera mais item (ou item duplicado no dia)
+    Itens fixados (edição manual / troca aprovada) nunca são mexidos.
+    - remover_ausentes=False: só considera os funcionário_ids informados
+    Retorna dict com as contagens.
+    """
+    ano, mes = escala_mes.ano, escala_mes.mes
+    n_dias = grade.shape[1]
+
+    q = (
+        db.session.query(EscalaItem.id, EscalaItem.funcionario_id, EscalaItem.inicio,
+                         EscalaItem.tipo, EscalaItem.fixado)
+        .filter(EscalaItem.escala_mes_id == escala_mes.id)
+        .order_by(EscalaItem.id.asc())
+    )
+    if not remover_ausentes:
+        q = q.filter(EscalaItem.funcionario_id.in_(list(funcionario_ids)))
+    existentes = q.all()
+
+    # linhas = funcionários da grade alvo + quem só existe no banco
+    ids = list(funcionario_ids)
+    linha = {fid: i for i, fid in enumerate(ids)}
+    for it in existentes:
+        if it.funcionario_id not in linha:
+            linha[it.funcionario_id] = len(ids)
+            ids.append(it.funcionario_id)
+
+    alvo = np.zeros((len(ids), n_dias), dtype=np.int8)
+    alvo[:grade.shape[0]] = grade
+
+    atual = np.full((len(ids), n_dias), -1, dtype=np.int8)
+    item_id = np.zeros((len(ids), n_dias), dtype=np.int64)
+    fixado = np.zeros((len(ids), n_dias), dtype=bool)
+    duplicados = []
+
+    for it in existentes:
+        li, di = linha[it.funcionario_id], it.inicio.day - 1
+        if atual[li, di] >= 0:
+            # mais de um item no mesmo dia: mantém o mais novo (igual à tela)
+            if not fixado[li, di]:
+                duplicados.append(int(item_id[li, di]))
+            elif not it.fixado:
+                duplicados.append(it.id)
+                continue
+        atual[li, di] = escala_grid.CODIGO_POR_TIPO.get(it.tipo, escala_grid.VAZIO)
+        item_id[li, di] = it.id
+        fixado[li, di] = bool(it.fixado)
+
+    inserir = (atual < 0) & (alvo != 0)
+    atualizar = (atual >= 0) & (alvo != 0) & (atual != alvo) & ~fixado
+    remover = (atual >= 0) & (alvo == 0) & ~fixado
+
+    tabela = EscalaItem.__table__
+
+    # DELETE
+    ids_remover = item_id[remover].tolist() + duplicados
+    for i in range(0, len(ids_remover), ESCALA_INSERT_LOTE):
+        db.session.execute(tabela.delete().where(tabela.c.id.in_(ids_remover[i:i + ESCALA_INSERT_LOTE])))
+
+    # UPDATE
+    linhas_upd = []
+    for li, di in zip(*np.nonzero(atualizar)):
+        cod = int(alvo[li, di])
+        ini, fim = escala_grid.horario(ano, mes, int(di) + 1, cod)
+        linhas_upd.append({"b_id": int(item_id[li, di]), "tipo": escala_grid.TIPOS[cod], "inicio": ini, "fim": fim})
+    if linhas_upd:
+        db.session.execute(
+            tabela.update().where(tabela.c.id == bindparam("b_id")),
+            linhas_upd
+        )
+
+    # INSERT
+    linhas_ins = []
+    for li, di in zip(*np.nonzero(inserir)):
+        cod = int(alvo[li, di])
+        ini, fim = escala_grid.horario(ano, mes, int(di) + 1, cod)
+        linhas_ins.append({
+            "escala_mes_id": escala_mes.id,
+            "funcionario_id": ids[li],
+            "inicio": ini,
+            "fim": fim,
+            "tipo": escala_grid.TIPOS[cod],
+            "observacao": None,
+            "fixado": False,
+        })
+    for i in range(0, len(linhas_ins), ESCALA_INSERT_LOTE):
+        db.session.execute(tabela.insert(), linhas_ins[i:i + ESCALA_INSERT_LOTE])
+
+    if linhas_ins or linhas_upd or ids_remover:
+        _bump_versao_escala(escala_mes_ids=[escala_mes.id])
+    _grade_cache_invalidar(escala_mes.id)
+
+    return {
+        "inseridos": len(linhas_ins),
+        "atualizados": len(linhas_upd),
+        "removidos": len(ids_remover),
+        "fixados": int(((atual >= 0) & fixado & (atual != alvo)).sum()),
+    }
+
+def _diff_regras(escala_mes: EscalaMes, grade, funcionario_ids, regras, remover_ausentes=True):
+    """
+    Incremental para escala em armazenamento "regras":
+    - regra nova/alterada: INSERT/UPDATE em escala_regra (1 linha por funcionário)
+    - exceções não fixadas (sobras de conversão) são apagadas: a regra vale de novo
+    - exceções fixadas (edição manual / troca aprovada) nunca são mexidas
+    - remover_ausentes=False: só considera os funcionário_ids informados
+    Contagens em células (mesmo formato de _diff_grade).
+    """
+    n_dias = grade.shape[1]
+    ids = list(funcionario_ids)
+
+    qr = (
+        db.session.query(EscalaRegra.id, EscalaRegra.funcionario_id,
+                         EscalaRegra.escala_tipo, EscalaRegra.plantao_base)
+        .filter(EscalaRegra.escala_mes_id == escala_mes.id)
+    )
+    qi = (
+        db.session.query(EscalaItem.id, EscalaItem.funcionario_id, EscalaItem.inicio,
+                         EscalaItem.tipo, EscalaItem.fixado)
+        .filter(EscalaItem.escala_mes_id == escala_mes.id)
+        .order_by(EscalaItem.inicio.asc(), EscalaItem.id.asc())
+    )
+    if not remover_ausentes:
+        qr = qr.filter(EscalaRegra.funcionario_id.in_(ids))
+        qi = qi.filter(EscalaItem.funcionario_id.in_(ids))
+    regras_atuais = {r.funcionario_id: r for r in qr.all()}
+    excecoes = qi.all()
+
+    linha = {fid: i for i, fid in enumerate(ids)}
+    for fid in list(regras_atuais) + [it.funcionario_id for it in excecoes]:
+        if fid not in linha:
+            linha[fid] = len(ids)
+            ids.append(fid)
+
+    # antes = regra gravada + exceções; depois = regra nova + exceções fixadas
+    antes = np.zeros((len(ids), n_dias), dtype=np.int8)
+    if regras_atuais:
+        antes[[linha[fid] for fid in regras_atuais]] = escala_grid.calcular_grade(
+            [(r.escala_tipo, r.plantao_base) for r in regras_atuais.values()],
+            escala_mes.ano, escala_mes.mes
+        )
+    depois = np.zeros((len(ids), n_dias), dtype=np.int8)
+    depois[:grade.shape[0]] = grade
+
+    alvo = depois.copy()
+    fixados = 0
+    ids_remover = []
+    for it in excecoes:
+        li, di = linha[it.funcionario_id], it.inicio.day - 1
+        cod = escala_grid.CODIGO_POR_TIPO.get(it.tipo, escala_grid.VAZIO)
+        antes[li, di] = cod
+        if it.fixado:
+            depois[li, di] = cod
+            fixados += int(cod != alvo[li, di])
+        else:
+            ids_remover.append(it.id)
+
+    tabela = EscalaItem.__table__
+    for i in range(0, len(ids_remover), ESCALA_INSERT_LOTE):
+        db.session.execute(tabela.delete().where(tabela.c.id.in_(ids_remover[i:i + ESCALA_INSERT_LOTE])))
+
+    # regras: só o que mudou
+    treg = EscalaRegra.__table__
+    novas = {
+        fid: regra
+        for fid, regra, tem in zip(funcionario_ids, regras, grade.any(axis=1).tolist())
+        if tem
+    }
+    ids_regra_remover = [r.id for fid, r in regras_atuais.items() if fid not in novas]
+    inserir, atualizar = [], []
+    for fid, (tipo, base) in novas.items():
+        atual = regras_atuais.get(fid)
+        if atual is None:
+            inserir.append({"escala_mes_id": escala_mes.id, "funcionario_id": fid,
+                            "escala_tipo": tipo, "plantao_base": base})
+        elif (atual.escala_tipo, atual.plantao_base) != (tipo, base):
+            atualizar.append({"b_id": atual.id, "escala_tipo": tipo, "plantao_base": base})
+    if ids_regra_remover:
+        db.session.execute(treg.delete().where(treg.c.id.in_(ids_regra_remover)))
+    if atualizar:
+        db.session.execute(treg.update().where(treg.c.id == bindparam("b_id")), atualizar)
+    if inserir:
+        db.session.execute(treg.insert(), inserir)
+
+    if ids_remover or ids_regra_remover or inserir or atualizar:
+        _bump_versao_escala(escala_mes_ids=[escala_mes.id])
+    _grade_cache_invalidar(escala_mes.id)
+
+    return {
+        "inseridos": int(((antes == 0) & (depois != 0)).sum()),
+        "atualizados": int(((antes != 0) & (depois != 0) & (antes != depois)).sum()),
+        "removidos": int(((antes != 0) & (depois == 0)).sum()),
+        "fixados": fixados,
+    }
+
+def _aplicar_grade_incremental(escala_mes: EscalaMes, grade, funcionario_ids, regras, remover_ausentes=True):
+    # mantém o formato de armazenamento da escala (conversão: flask compactar-escalas)
+    if escala_mes.armazenamento == "regras":
+        return _diff_regras(escala_mes, grade, funcionario_ids, regras, remover_ausentes=remover_ausentes)
+    return _diff_grade(escala_mes, grade, funcionario_ids, remover_ausentes=remover_ausentes)
+
+def regenerar_incremental(escala_mes: EscalaMes, funcionarios, remover_ausentes=True):
+    """Regeneração incremental (diff). Não faz commit."""
+    regras = [(f.escala_tipo, f.plantao_base) for f in funcionarios]
+    grade = escala_grid.calcular_grade(regras, escala_mes.ano, escala_mes.mes)
+    return _aplicar_grade_incremental(
+        escala_mes, grade, [f.id for f in funcionarios], regras, remover_ausentes=remover_ausentes
+    )
+
+def gerar_itens_escala_mes(escala_mes: EscalaMes, funcionarios):
+    """
+    Gera todos os itens do mês de uma vez:
+    - calcula a grade (funcionários × dias) vetorizada
+    - 1 DELETE por escala_mes
+    - INSERT em lotes (core, sem criar objetos ORM)
+    Retorna (total_itens, segundos). Não faz commit.
+    """
+    t0 = perf_counter()
+
+    regras = [(f.escala_tipo, f.plantao_base) for f in funcionarios]
+    ids = [f.id for f in funcionarios]
+    grade = escala_grid.calcular_grade(regras, escala_mes.ano, escala_mes.mes)
+
+    total = _inserir_grade(escala_mes, grade, ids, regras=regras)
+
+    return total, perf_counter() - t0
 
-    return
 # ==================================================
 # ADMIN - ESCALAS (LISTA DE ESCALAS)
 # ==================================================
@@ -2019,152 +4194,555 @@ def admin_escalas_gerar():
 
     funcionarios = q.order_by(Funcionario.nome).all()
 
-    for f in funcionarios:
-        generate_items_for_funcionario(f, escala_mes, ano, mes)
+    if request.form.get("modo") == "incremental":
+        t0 = perf_counter()
+        r = regenerar_incremental(escala_mes, funcionarios)
+        db.session.commit()
+        print(f"✅ Escala {mes:02d}/{ano} ({setor or 'TODOS'}) incremental: {r} em {perf_counter() - t0:.3f}s")
+        flash(
+            f"✅ Escala atualizada: {r['inseridos']} inseridos, {r['atualizados']} alterados, "
+            f"{r['removidos']} removidos, {r['fixados']} células fixadas preservadas.",
+            "success"
+        )
+        return redirect(url_for("admin_escala_mes", escala_mes_id=escala_mes.id))
 
+    total, segundos = gerar_itens_escala_mes(escala_mes, funcionarios)
     db.session.commit()
 
+    por_segundo = int(total / segundos) if segundos > 0 else total
+    print(f"✅ Escala {mes:02d}/{ano} ({setor or 'TODOS'}): {total} itens em {segundos:.3f}s ({por_segundo} itens/s)")
+    flash(f"✅ Escala gerada: {total} itens em {segundos:.2f}s ({por_segundo} itens/s).", "success")
+
     return redirect(
         url_for("admin_escala_mes", escala_mes_id=escala_mes.id)
     )
 
 # ==================================================
-# ADMIN - ESCALAS
+# GERAÇÃO EM LOTE (VÁRIOS MESES / TODOS OS SETORES)
 # ==================================================
-@app.route("/admin/escalas/<int:escala_mes_id>")
+
+ESCALA_WORKERS = int(os.getenv("ESCALA_WORKERS", "0")) or (os.cpu_count() or 1)
+
+def _parse_ano_mes(s: str):
+    # "YYYY-MM" -> (ano, mes)
+    try:
+        y, m = (s or "").strip().split("-")[:2]
+        ano, mes = int(y), int(m)
+        return (ano, mes) if 1 <= mes <= 12 else None
+    except Exception:
+        return None
+
+def _get_or_create_escala_mes(ano: int, mes: int, setor: str | None, criado_por_id=None):
+    escala_mes = EscalaMes.query.filter_by(ano=ano, mes=mes, setor=setor).first()
+    if not escala_mes:
+        escala_mes = EscalaMes(ano=ano, mes=mes, setor=setor, criado_por_id=criado_por_id)
+        db.session.add(escala_mes)
+        db.session.commit()
+    return escala_mes
+
+def _em_processos(func, tarefas):
+    """
+    Executa func(tarefa) em processos separados (multiprocessing "spawn",
+    para não herdar o hub do eventlet nem conexões do SQLite) e devolve
+    os resultados na ordem em que terminam.
+    - func precisa ser "picklável" (função de módulo sem Flask/banco)
+    - com 1 tarefa ou 1 worker executa aqui mesmo
+    """
+    if len(tarefas) <= 1 or ESCALA_WORKERS <= 1:
+        for t in tarefas:
+            yield func(t)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = min(ESCALA_WORKERS, len(tarefas))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        futuros = [pool.submit(func, t) for t in tarefas]
+        for fut in as_completed(futuros):
+            yield fut.result()
+
+def _calcular_grades(tarefas):
+    return _em_processos(escala_grid.calcular_grade_tarefa, tarefas)
+
+def gerar_escalas_lote(meses, setores, criado_por_id=None, incremental=False):
+    """
+    Gera escalas para vários meses × setores.
+    - setores: lista de nomes, "" = TODOS, ou "all" = cada setor com funcionários ativos
+    - grades calculadas em paralelo; gravação com commit por lote
+    - incremental=True: só grava as diferenças (preserva células fixadas)
+    É um gerador: devolve um dict de progresso a cada escala gravada.
+    """
+    t0 = perf_counter()
+
+    funcionarios = (
+        Funcionario.query
+        .filter_by(status="Ativo")
+        .order_by(Funcionario.nome)
+        .all()
+    )
+
+    por_setor = {}
+    for f in funcionarios:
+        por_setor.setdefault(f.setor, []).append(f)
+
+    if setores == "all":
+        setores = sorted(s for s in por_setor if s)
+    setores = [(s or "").strip() or None for s in setores]
+
+    tarefas = []
+    ids_por_chave = {}
+    regras_por_chave = {}
+    for ano, mes in meses:
+        for setor in setores:
+            lista = funcionarios if setor is None else por_setor.get(setor, [])
+            chave = (ano, mes, setor)
+            ids_por_chave[chave] = [f.id for f in lista]
+            regras = [(f.escala_tipo, f.plantao_base) for f in lista]
+            regras_por_chave[chave] = regras
+            tarefas.append((chave, regras, ano, mes))
+
+    yield {"etapa": "inicio", "total": len(tarefas)}
+
+    feitas = 0
+    total_itens = 0
+    for (ano, mes, setor), grade in _calcular_grades(tarefas):
+        escala_mes = _get_or_create_escala_mes(ano, mes, setor, criado_por_id)
+        chave = (ano, mes, setor)
+        if incremental:
+            r = _aplicar_grade_incremental(escala_mes, grade, ids_por_chave[chave], regras_por_chave[chave])
+            db.session.commit()
+            socketio.sleep(0)
+            n = r["inseridos"] + r["atualizados"] + r["removidos"]
+        else:
+            n = _inserir_grade(
+                escala_mes, grade, ids_por_chave[chave],
+                regras=regras_por_chave[chave], commit_por_lote=True
+            )
+
+        feitas += 1
+        total_itens += n
+        yield {
+            "etapa": "escala",
+            "feitas": feitas,
+            "total": len(tarefas),
+            "escala_mes_id": escala_mes.id,
+            "ano": ano,
+            "mes": mes,
+            "setor": setor or "TODOS",
+            "itens": n,
+        }
+
+    segundos = perf_counter() - t0
+    yield {
+        "etapa": "fim",
+        "feitas": feitas,
+        "total": len(tarefas),
+        "itens": total_itens,
+        "segundos": round(segundos, 3),
+        "itens_por_segundo": int(total_itens / segundos) if segundos > 0 else total_itens,
+    }
+
+@app.route("/admin/escalas/gerar-lote", methods=["POST"])
 @login_required
 @direcao_required
-def admin_escala_mes(escala_mes_id):
-    escala = EscalaMes.query.get_or_404(escala_mes_id)
+def admin_escalas_gerar_lote():
+    de = _parse_ano_mes(request.form.get("de"))
+    ate = _parse_ano_mes(request.form.get("ate")) or de
+
+    if not de or ate < de:
+        return {"ok": False, "error": "Período inválido"}, 400
+
+    setores_raw = (request.form.get("setores") or "all").strip()
+    if setores_raw.lower() in ("all", "todos_setores"):
+        setores = "all"
+    else:
+        setores = [s.strip() for s in setores_raw.split(";")]
+
+    meses = escala_grid.meses_intervalo(de, ate)
+    uid = session.get("user_id")
+    incremental = request.form.get("modo") == "incremental"
+
+    # progresso em NDJSON (1 linha JSON por escala gravada)
+    def stream():
+        try:
+            for p in gerar_escalas_lote(meses, setores, criado_por_id=uid, incremental=incremental):
+                yield json.dumps(p, ensure_ascii=False) + "\n"
+        except Exception as e:
+            db.session.rollback()
+            print("❌ Erro na geração em lote:", e)
+            yield json.dumps({"etapa": "erro", "error": str(e)}, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+
+@app.cli.command("gerar-escalas")
+@click.option("--de", "de_str", required=True, help="Mês inicial (YYYY-MM)")
+@click.option("--ate", "ate_str", default=None, help="Mês final (YYYY-MM)")
+@click.option("--setores", default="all", help='"all" ou lista separada por ";" (vazio = TODOS)')
+@click.option("--incremental", is_flag=True, help="Só grava as diferenças (preserva células fixadas)")
+def cli_gerar_escalas(de_str, ate_str, setores, incremental):
+    """Gera escalas de vários meses/setores de uma vez."""
+    de = _parse_ano_mes(de_str)
+    ate = _parse_ano_mes(ate_str) if ate_str else de
+    if not de or not ate or ate < de:
+        raise click.BadParameter("Período inválido (use YYYY-MM).")
+
+    lista = "all" if setores.strip().lower() == "all" else [s.strip() for s in setores.split(";")]
+
+    for p in gerar_escalas_lote(escala_grid.meses_intervalo(de, ate), lista, incremental=incremental):
+        if p["etapa"] == "escala":
+            click.echo(f"[{p['feitas']}/{p['total']}] {p['mes']:02d}/{p['ano']} {p['setor']}: {p['itens']} itens")
+        elif p["etapa"] == "fim":
+            click.echo(f"✅ {p['feitas']} escalas, {p['itens']} itens em {p['segundos']}s ({p['itens_por_segundo']} itens/s)")
+
+# ==================================================
+# COMPACTAR ESCALAS ANTIGAS (ITENS -> REGRAS + EXCEÇÕES)
+# ==================================================
+
+def compactar_escala(escala: EscalaMes):
+    """
+    Converte uma escala do formato "itens" para "regras":
+    - 1 EscalaRegra por funcionário (escala_tipo/plantao_base atuais dele)
+    - ficam como exceção só os itens fixados, com observação, repetidos
+      no mesmo dia ou diferentes da regra
+    - funcionário com dia vazio onde a regra gera item fica sem regra
+      (todos os itens dele viram exceção)
+    Confere que a grade resultante é idêntica; se não for, levanta ValueError.
+    Não faz commit. Retorna (itens_antes, linhas_depois).
+    """
+    grade = _montar_grade(escala.id)
+    func_ids = grade["func_ids"]
+    funcs = grade["funcionarios"]
+    atual = grade["matriz"]
+
+    regras = [
+        ((funcs.get(fid) or {}).get("escala_tipo"), (funcs.get(fid) or {}).get("plantao_base"))
+        for fid in func_ids
+    ]
+    regra = escala_grid.calcular_grade(regras, escala.ano, escala.mes)
+    com_regra = (
+        regra.any(axis=1)
+        & ~((atual == 0) & (regra != 0)).any(axis=1)
+        & np.array([fid in funcs for fid in func_ids], dtype=bool)
+    )
 
     itens = (
-        EscalaItem.query
-        .filter_by(escala_mes_id=escala.id)
-        .order_by(EscalaItem.funcionario_id.asc(), EscalaItem.inicio.asc())
+        db.session.query(EscalaItem.id, EscalaItem.funcionario_id, EscalaItem.inicio,
+                         EscalaItem.tipo, EscalaItem.fixado, EscalaItem.observacao)
+        .filter(EscalaItem.escala_mes_id == escala.id)
         .all()
     )
+    por_celula = Counter((it.funcionario_id, it.inicio.day) for it in itens)
 
-    por_func = {}
-    funcionarios_ids = sorted(set([i.funcionario_id for i in itens]))
+    apagar = []
+    for it in itens:
+        li, dia = grade["linha"][it.funcionario_id], it.inicio.day
+        if (
+            com_regra[li]
+            and not it.fixado
+            and not it.observacao
+            and por_celula[(it.funcionario_id, dia)] == 1
+            and escala_grid.CODIGO_POR_TIPO.get(it.tipo, escala_grid.VAZIO) == regra[li, dia - 1]
+        ):
+            apagar.append(it.id)
 
-    funcionarios = (
-        Funcionario.query
-        .filter(Funcionario.id.in_(funcionarios_ids))
-        .order_by(Funcionario.nome)
+    tabela = EscalaItem.__table__
+    for i in range(0, len(apagar), ESCALA_INSERT_LOTE):
+        db.session.execute(tabela.delete().where(tabela.c.id.in_(apagar[i:i + ESCALA_INSERT_LOTE])))
+
+    linhas = [
+        {"escala_mes_id": escala.id, "funcionario_id": fid, "escala_tipo": tipo, "plantao_base": base}
+        for fid, (tipo, base), ok in zip(func_ids, regras, com_regra.tolist())
+        if ok
+    ]
+    db.session.execute(
+        EscalaRegra.__table__.delete().where(EscalaRegra.escala_mes_id == escala.id)
+    )
+    if linhas:
+        db.session.execute(EscalaRegra.__table__.insert(), linhas)
+
+    escala.armazenamento = "regras"
+    db.session.flush()
+
+    nova = _montar_grade(escala.id)
+    if nova["func_ids"] != func_ids or not np.array_equal(nova["matriz"], atual) or nova["obs"] != grade["obs"]:
+        raise ValueError(f"grade da escala {escala.id} mudaria na conversão")
+
+    _bump_versao_escala(escala_mes_ids=[escala.id])
+    _grade_cache_invalidar(escala.id)
+    return len(itens), len(itens) - len(apagar) + len(linhas)
+
+@app.cli.command("compactar-escalas")
+@click.option("--ids", default="", help="IDs separados por vírgula (vazio = todas no formato antigo)")
+def cli_compactar_escalas(ids):
+    """Converte escalas do formato antigo (1 item por pessoa/dia) para regras + exceções."""
+    q = EscalaMes.query.filter(EscalaMes.armazenamento != "regras")
+    if ids.strip():
+        q = q.filter(EscalaMes.id.in_([int(i) for i in ids.split(",") if i.strip()]))
+
+    total_antes = total_depois = 0
+    for escala in q.order_by(EscalaMes.ano, EscalaMes.mes, EscalaMes.id).all():
+        try:
+            antes, depois = compactar_escala(escala)
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            click.echo(f"⚠️ {escala.mes:02d}/{escala.ano} {escala.setor or 'TODOS'}: {e}")
+            continue
+        total_antes += antes
+        total_depois += depois
+        click.echo(f"{escala.mes:02d}/{escala.ano} {escala.setor or 'TODOS'}: {antes} -> {depois} linhas")
+
+    _cobertura_resultado.clear()
+    click.echo(f"✅ {total_antes} -> {total_depois} linhas")
+
+# ==================================================
+# EXPORTAR TODAS AS ESCALAS DO MÊS (ZIP)
+# ==================================================
+
+def exportar_escalas_zip(ano: int, mes: int):
+    """
+    Gera o ZIP com o PDF de todas as escalas do mês, em pedaços (gerador).
+    - PDFs já no cache em disco entram direto
+    - os demais são renderizados em paralelo (processos) e entram no ZIP
+      assim que cada um fica pronto
+    """
+    escalas = (
+        EscalaMes.query
+        .filter_by(ano=ano, mes=mes)
+        .order_by(EscalaMes.setor)
         .all()
     )
 
-    func_map = {f.id: f for f in funcionarios}
+    saida = planilhas.SaidaStream()
+    zf = zipfile.ZipFile(saida, mode="w", compression=zipfile.ZIP_STORED)
+
+    pendentes = []
+    por_id = {}
+    for e in escalas:
+        caminho = _pdf_cache_path(e.id, e.versao or 0)
+        if os.path.exists(caminho):
+            _pdf_cache_stats["hits"] += 1
+            zf.write(caminho, arcname=_nome_pdf_escala(e))
+            yield saida.retirar()
+        else:
+            _pdf_cache_stats["misses"] += 1
+            por_id[e.id] = e
+            pendentes.append((e.id, obter_grade(e.id)))
 
-    for it in itens:
-        por_func.setdefault(it.funcionario_id, []).append(it)
+    for escala_mes_id, conteudo in _em_processos(pdf_layout.gerar_pdf_escala_tarefa, pendentes):
+        e = por_id[escala_mes_id]
+        _pdf_cache_gravar(e, conteudo)
+        zf.writestr(_nome_pdf_escala(e), conteudo)
+        yield saida.retirar()
 
-    dias_no_mes = calendar.monthrange(escala.ano, escala.mes)[1]
-    dias = list(range(1, dias_no_mes + 1))
+    zf.close()
+    yield saida.retirar()
 
-    # ==================================================
-    # ✅ AGRUPAR FUNCIONÁRIOS POR EQUIPE (para exibir igual Excel)
-    # ==================================================
-    por_equipe = {}
+@app.get("/admin/escalas/exportar-zip")
+@login_required
+@direcao_required
+def admin_escalas_exportar_zip():
+    ano = request.args.get("ano", type=int)
+    mes = request.args.get("mes", type=int)
+    if not ano or not mes or not (1 <= mes <= 12):
+        abort(400)
+
+    resp = Response(stream_with_context(exportar_escalas_zip(ano, mes)), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f'attachment; filename="escalas_{ano}_{mes:02d}.zip"'
+    return resp
+
+@app.cli.command("exportar-escalas")
+@click.option("--ano", type=int, required=True)
+@click.option("--mes", type=int, required=True)
+@click.option("--saida", default=None, help="Arquivo .zip (padrão: escalas_<ano>_<mes>.zip)")
+def cli_exportar_escalas(ano, mes, saida):
+    """Exporta o PDF de todas as escalas do mês em um ZIP."""
+    saida = saida or f"escalas_{ano}_{mes:02d}.zip"
+    t0 = perf_counter()
+    with open(saida, "wb") as fh:
+        for parte in exportar_escalas_zip(ano, mes):
+            fh.write(parte)
+    click.echo(f"✅ {saida} gerado em {perf_counter() - t0:.2f}s")
 
-    for func_id in funcionarios_ids:
-        f = func_map.get(func_id)
-        equipe = (getattr(f, "equipe", None) or "SEM EQUIPE").strip().upper()
-        por_equipe.setdefault(equipe, []).append(func_id)
+# ==================================================
+# ADMIN - ESCALAS
+# ==================================================
+# rótulo e classe CSS de cada código da grade (tela da escala)
+ROTULO_CELULA = ("-", "EXP", "F", "24H", "FÉR")
+CLASSE_CELULA = ("", "tipo-EXPEDIENTE", "tipo-FOLGA", "tipo-PLANTAO_24H", "tipo-FERIAS")
 
-    # ordena cada equipe por nome
-    for equipe in por_equipe:
-        por_equipe[equipe] = sorted(
-            por_equipe[equipe],
-            key=lambda fid: ((func_map.get(fid).nome or "") if func_map.get(fid) else "").upper()
-        )
+def _fins_de_semana(grade):
+    esc = grade["escala"]
+    return {d for d in grade["dias"] if date(esc["ano"], esc["mes"], d).weekday() >= 5}
 
-    # ordena equipes (EQUIPE 1..N, e SEM EQUIPE por último)
-    def ordem_equipe(nome):
-        n = (nome or "").upper().strip()
-        if n == "SEM EQUIPE":
-            return (999, n)
-        try:
-            num = int("".join(ch for ch in n if ch.isdigit()) or "0")
-            return (num, n)
-        except Exception:
-            return (500, n)
+def montar_linhas_escala(grade):
+    """
+    Prepara a grade para o template em uma passada só:
+    [(equipe, [{"id", "f", "cont": {24H/EXP/F}, "celulas": [(classe, rotulo, obs), ...]}])]
+    """
+    matriz = grade["matriz"]
+    obs = grade["obs"]
+
+    # contadores por linha (vetorizado)
+    cont = np.stack([
+        (matriz == escala_grid.PLANTAO_24H).sum(axis=1),
+        (matriz == escala_grid.EXPEDIENTE).sum(axis=1),
+        (matriz == escala_grid.FOLGA).sum(axis=1),
+    ], axis=1).tolist()
+
+    celula_por_codigo = [(CLASSE_CELULA[cod], ROTULO_CELULA[cod]) for cod in range(len(escala_grid.TIPOS))]
+
+    equipes = []
+    for equipe, ids in grade["equipes"]:
+        linhas = []
+        for fid in ids:
+            li = grade["linha"][fid]
+            celulas = [celula_por_codigo[cod] + (None,) for cod in matriz[li].tolist()]
+            if obs:
+                for d in grade["dias"]:
+                    o = obs.get((fid, d))
+                    if o:
+                        celulas[d - 1] = celulas[d - 1][:2] + (o,)
+            c24, cexp, cf = cont[li]
+            linhas.append({
+                "id": fid,
+                "f": grade["funcionarios"].get(fid),
+                "cont": {"24H": c24, "EXP": cexp, "F": cf},
+                "celulas": celulas,
+            })
+        equipes.append((equipe, linhas))
+    return equipes
 
-    por_equipe_ordenado = dict(sorted(por_equipe.items(), key=lambda kv: ordem_equipe(kv[0])))
+@app.route("/admin/escalas/<int:escala_mes_id>")
+@login_required
+@direcao_required
+def admin_escala_mes(escala_mes_id):
+    grade = obter_grade(escala_mes_id)
+    if grade is None:
+        abort(404)
 
     return render_template(
         "admin/escala_mes.html",
-        escala=escala,
-        por_func=por_func,
-        func_map=func_map,
-        dias=dias,
-        por_equipe=por_equipe_ordenado
+        escala=grade["escala"],
+        dias=grade["dias"],
+        fins_de_semana=_fins_de_semana(grade),
+        equipes=montar_linhas_escala(grade),
+        total_funcionarios=len(grade["func_ids"])
     )
 
 # ==================================================
 # ✅ EDITAR DIA DA ESCALA (CÉLULA CLICÁVEL)
 # ==================================================
 
+TIPOS_EDITAVEIS = {"EXPEDIENTE", "FOLGA", "PLANTAO_24H"}
+
+def _validar_edicoes(escala: EscalaMes, edicoes):
+    """
+    [(funcionario_id, dia, tipo)] validado; a última edição da mesma célula vence.
+    Levanta ValueError com a mensagem para o cliente.
+    """
+    n_dias = calendar.monthrange(escala.ano, escala.mes)[1]
+    por_celula = {}
+    for i, e in enumerate(edicoes):
+        try:
+            fid = int(e["funcionario_id"])
+            dia = int(e["dia"])
+            tipo = (e.get("tipo") or "").strip()
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValueError(f"Edição {i + 1}: dados inválidos")
+        if tipo not in TIPOS_EDITAVEIS:
+            raise ValueError(f"Edição {i + 1}: tipo inválido")
+        if not (1 <= dia <= n_dias):
+            raise ValueError(f"Edição {i + 1}: dia inválido")
+        por_celula.pop((fid, dia), None)
+        por_celula[(fid, dia)] = tipo
+    return [(fid, dia, tipo) for (fid, dia), tipo in por_celula.items()]
+
+def aplicar_edicoes_escala(escala: EscalaMes, edicoes):
+    """
+    Aplica várias edições de célula em uma transação só:
+    - 1 SELECT por faixa de dias (funcionários IN + inicio entre o 1º e o último dia)
+    - cria o item do dia se não existir, marca fixado (a regeneração preserva)
+    - 1 bump de versão e 1 commit
+    Retorna [{funcionario_id, dia, tipo, label}].
+    """
+    if not edicoes:
+        return []
+
+    fids = {fid for fid, _, _ in edicoes}
+    dias = [dia for _, dia, _ in edicoes]
+    ini = datetime(escala.ano, escala.mes, min(dias))
+    fim = datetime(escala.ano, escala.mes, max(dias)) + timedelta(days=1)
+
+    existentes = {}
+    for item in (
+        EscalaItem.query
+        .filter(EscalaItem.escala_mes_id == escala.id)
+        .filter(EscalaItem.funcionario_id.in_(fids))
+        .filter(EscalaItem.inicio >= ini)
+        .filter(EscalaItem.inicio < fim)
+        .order_by(EscalaItem.inicio)
+    ):
+        existentes.setdefault((item.funcionario_id, item.inicio.day), item)
+
+    resultado = []
+    for fid, dia, tipo in edicoes:
+        item = existentes.get((fid, dia))
+        if not item:
+            item = EscalaItem(escala_mes_id=escala.id, funcionario_id=fid, observacao=None)
+            db.session.add(item)
+            existentes[(fid, dia)] = item
+
+        codigo = escala_grid.CODIGO_POR_TIPO[tipo]
+        item.inicio, item.fim = escala_grid.horario(escala.ano, escala.mes, dia, codigo)
+        item.tipo = tipo
+        item.fixado = True
+        resultado.append({"funcionario_id": fid, "dia": dia, "tipo": tipo, "label": ROTULO_CELULA[codigo]})
+
+    _bump_versao_escala(escala_mes_ids=[escala.id])
+    db.session.commit()
+
+    _grade_cache_patch(escala.id, [(r["funcionario_id"], r["dia"], r["tipo"]) for r in resultado])
+
+    notificar_escala_alterada(escala, resultado)
+    return resultado
+
 @app.route("/admin/escalas/<int:escala_mes_id>/editar-dia", methods=["POST"])
 @login_required
 @direcao_required
 def admin_escala_editar_dia(escala_mes_id):
     escala = EscalaMes.query.get_or_404(escala_mes_id)
 
-    funcionario_id = int(request.form.get("funcionario_id"))
-    dia = int(request.form.get("dia"))
-    novo_tipo = (request.form.get("tipo") or "").strip()
-
-    TIPOS_VALIDOS = {"EXPEDIENTE", "FOLGA", "PLANTAO_24H"}
-    if novo_tipo not in TIPOS_VALIDOS:
-        return {"ok": False, "error": "Tipo inválido"}, 400
+    try:
+        edicoes = _validar_edicoes(escala, [request.form])
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}, 400
 
-    d = date(escala.ano, escala.mes, dia)
-    inicio_dia = datetime.combine(d, time(0, 0))
-    fim_dia = inicio_dia + timedelta(days=1)
+    r = aplicar_edicoes_escala(escala, edicoes)[0]
+    return {"ok": True, "tipo": r["tipo"], "label": r["label"]}
 
-    item = (
-        EscalaItem.query
-        .filter(EscalaItem.escala_mes_id == escala.id)
-        .filter(EscalaItem.funcionario_id == funcionario_id)
-        .filter(EscalaItem.inicio >= inicio_dia)
-        .filter(EscalaItem.inicio < fim_dia)
-        .first()
-    )
+@app.route("/admin/escalas/<int:escala_mes_id>/editar-dias", methods=["POST"])
+@login_required
+@direcao_required
+def admin_escala_editar_dias(escala_mes_id):
+    """Lote de edições da grade: {"edicoes": [{"funcionario_id", "dia", "tipo"}, ...]}."""
+    escala = EscalaMes.query.get_or_404(escala_mes_id)
 
-    if not item:
-        item = EscalaItem(
-            escala_mes_id=escala.id,
-            funcionario_id=funcionario_id,
-            inicio=inicio_dia,
-            fim=inicio_dia + timedelta(hours=1),
-            tipo="FOLGA",
-            observacao=None
-        )
-        db.session.add(item)
-
-    if novo_tipo == "EXPEDIENTE":
-        item.inicio = datetime.combine(d, time(8, 0))
-        item.fim = datetime.combine(d, time(17, 0))
-    elif novo_tipo == "FOLGA":
-        item.inicio = datetime.combine(d, time(0, 0))
-        item.fim = datetime.combine(d, time(23, 59))
-    elif novo_tipo == "PLANTAO_24H":
-        item.inicio = datetime.combine(d, time(7, 0))
-        item.fim = item.inicio + timedelta(hours=24)
-
-    item.tipo = novo_tipo
-    db.session.commit()
+    dados = request.get_json(silent=True) or {}
+    edicoes = dados.get("edicoes")
+    if not isinstance(edicoes, list) or not edicoes:
+        return {"ok": False, "error": "Nenhuma edição enviada"}, 400
+    if len(edicoes) > ESCALA_INSERT_LOTE:
+        return {"ok": False, "error": "Edições demais em um lote"}, 400
 
-    label = "-"
-    if novo_tipo == "EXPEDIENTE":
-        label = "EXP"
-    elif novo_tipo == "FOLGA":
-        label = "F"
-    elif novo_tipo == "PLANTAO_24H":
-        label = "24H"
+    try:
+        edicoes = _validar_edicoes(escala, edicoes)
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}, 400
 
-    return {"ok": True, "tipo": novo_tipo, "label": label}
+    t0 = perf_counter()
+    celulas = aplicar_edicoes_escala(escala, edicoes)
+    print(f"✏️ Escala {escala.id}: {len(celulas)} células em {perf_counter() - t0:.3f}s")
+    return {"ok": True, "celulas": celulas}
 
 # ==================================================
 # IMPORTAR FUNCIONÁRIOS (CSV)
@@ -2283,7 +4861,10 @@ def importar_funcionarios():
         db.session.add(funcionario)
         adicionados += 1
 
+    if adicionados:
+        _bump_versao_diretorio()
     db.session.commit()
+    _relatorio_cache_limpar()
 
     colunas_detectadas = ", ".join(list(df.columns))
 
@@ -2344,7 +4925,11 @@ def admin_funcionario_editar(func_id):
         else:
             funcionario.plantao_base = None
 
+        _bump_versao_escala(funcionario_ids=[funcionario.id])
+        _bump_versao_diretorio()
         db.session.commit()
+        _grade_cache_invalidar()
+        _relatorio_cache_limpar()
         return redirect(url_for("admin_funcionario_ver", func_id=funcionario.id))
 
     return render_template("admin/funcionario_editar.html", funcionario=funcionario)
@@ -2358,8 +4943,12 @@ def admin_funcionario_editar(func_id):
 @direcao_required
 def admin_funcionario_excluir(func_id):
     func = Funcionario.query.get_or_404(func_id)
+    _bump_versao_escala(funcionario_ids=[func.id])
+    _bump_versao_diretorio()
     db.session.delete(func)
     db.session.commit()
+    _grade_cache_invalidar()
+    _relatorio_cache_limpar()
     return redirect("/admin/funcionarios")
 # ==================================================
 # START (LOCAL)
@@ -0,0 +1,69 @@
+"""
+Benchmark: gravação das mensagens do chat (evento send_message do Socket.IO).
+
+Compara 1 commit por mensagem (CHAT_GRAVACAO_ASSINCRONA=0, como era) com
+a fila write-behind (INSERT em lote + 1 commit a cada CHAT_GRAVACAO_LOTE
+mensagens). O tempo conta até a última mensagem estar gravada no banco.
+
+Uso:
+    python benchmarks/chat_gravacao.py [mensagens] [remetentes]
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# banco descartável (o app cria tabelas/usuários padrão ao importar)
+os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import app as app_mod  # noqa: E402
+from app import app, db, socketio, Mensagem, ConversaResumo  # noqa: E402
+
+
+def rodada(cliente, n_msgs: int, n_remetentes: int, assincrona: bool):
+    app_mod.CHAT_GRAVACAO_ASSINCRONA = assincrona
+
+    with app.app_context():
+        db.session.execute(Mensagem.__table__.delete())
+        db.session.execute(ConversaResumo.__table__.delete())
+        db.session.commit()
+
+    t0 = perf_counter()
+    for i in range(n_msgs):
+        a = 1 + i % n_remetentes
+        b = 1 + (i + 1) % n_remetentes
+        cliente.emit("send_message", {
+            "from": a,
+            "to": b,
+            "text": f"mensagem {i}",
+            "room": f"{min(a, b)}_{max(a, b)}",
+        })
+    with app.app_context():
+        app_mod.gravar_fila_chat()  # o que sobrou na fila (desligamento / próximo intervalo)
+    segundos = perf_counter() - t0
+
+    with app.app_context():
+        gravadas = Mensagem.query.count()
+    return segundos, gravadas
+
+
+def main():
+    n_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_remetentes = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    cliente = socketio.test_client(app)
+
+    t_antes, g_antes = rodada(cliente, n_msgs, n_remetentes, assincrona=False)
+    t_depois, g_depois = rodada(cliente, n_msgs, n_remetentes, assincrona=True)
+
+    print(f"{n_msgs} mensagens, {n_remetentes} usuários (SQLite em {os.environ['SQLITE_PATH']})")
+    print(f"  1 commit/mensagem: {t_antes:7.2f} s  {n_msgs / t_antes:9.0f} msg/s  ({g_antes} gravadas)")
+    print(f"  fila em lote:      {t_depois:7.2f} s  {n_msgs / t_depois:9.0f} msg/s  ({g_depois} gravadas)")
+    print(f"  ganho:             {t_antes / t_depois:7.1f}x")
+    print(f"  lotes: {app_mod._fila_chat_stats['lotes']}  maior lote: {app_mod._fila_chat_stats['maior_lote']}")
+
+
+if __name__ == "__main__":
+    main()
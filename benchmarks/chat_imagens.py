@@ -0,0 +1,113 @@
+"""
+Benchmark: anexos de imagem do chat (redução + miniatura).
+
+Gera "fotos de celular" sintéticas (4032x3024, JPEG q92 com EXIF/GPS),
+envia por /enviar-mensagem e compara os bytes:
+- recebido:  o que o celular mandou (e o que a conversa baixava antes)
+- gravado:   imagem reduzida (o que desce no clique)
+- miniatura: o que a conversa baixa agora
+
+Uso:
+    python benchmarks/chat_imagens.py [imagens]
+"""
+import io
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# banco e pastas descartáveis (o app cria tabelas/usuários padrão ao importar)
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("SQLITE_PATH", os.path.join(_tmp, "bench.db"))
+os.environ.setdefault("CHAT_MINIATURAS_DIR", os.path.join(_tmp, "miniaturas"))
+
+import app as app_mod  # noqa: E402
+from app import app, Funcionario  # noqa: E402
+
+
+def foto_sintetica(semente: int) -> bytes:
+    # gradiente + formas + ruído de sensor: comprime parecido com foto de verdade
+    rng = np.random.default_rng(semente)
+    h, w = 3024, 4032
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    base = np.stack([
+        128 + 90 * np.sin(x / (300 + 50 * c) + semente) * np.cos(y / (410 + 30 * c))
+        for c in range(3)
+    ], axis=-1)
+    # textura em várias escalas (folhas, tecido, cabelo) sobrevive à redução
+    for escala, forca in ((4, 18), (16, 14), (64, 10)):
+        ruido = rng.normal(0, forca, size=(h // escala + 1, w // escala + 1, 3)).astype(np.float32)
+        base += np.repeat(np.repeat(ruido, escala, axis=0), escala, axis=1)[:h, :w]
+    base += rng.normal(0, 7, size=base.shape)
+    img = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8), "RGB")
+
+    exif = Image.Exif()
+    exif[0x010F] = "Fabricante"           # Make
+    exif[0x0110] = "Celular X"            # Model
+    exif[0x0112] = 6                      # Orientation: girar 90°
+    exif[0x8825] = {1: "S", 2: (8.0, 3.0, 30.0), 3: "W", 4: (34.0, 52.0, 10.0)}  # GPS
+
+    saida = io.BytesIO()
+    img.save(saida, "JPEG", quality=92, exif=exif)
+    return saida.getvalue()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    cliente = app.test_client()
+    with app.app_context():
+        user = Funcionario.query.first()
+    with cliente.session_transaction() as s:
+        s["user_id"] = user.id
+        s["nome"] = user.nome
+        s["funcao"] = user.funcao
+
+    recebido = gravado = miniatura = 0
+    t_envio = t_mini = 0.0
+    for i in range(n):
+        foto = foto_sintetica(i)
+
+        t0 = perf_counter()
+        r = cliente.post("/enviar-mensagem", data={
+            "texto": "", "destino": str(user.id), "room": "bench",
+            "arquivo": (io.BytesIO(foto), f"IMG_{i:04d}.jpg"),
+        }, content_type="multipart/form-data")
+        t_envio += perf_counter() - t0
+        assert r.status_code == 204, r.status_code
+
+        with app.app_context():
+            from app import Mensagem
+            nome = Mensagem.query.order_by(Mensagem.id.desc()).first().arquivo
+        caminho = os.path.join(app_mod.UPLOAD_CHAT, nome)
+
+        t0 = perf_counter()
+        r = cliente.get(f"/chat/anexo/{nome}/miniatura")
+        t_mini += perf_counter() - t0
+        assert r.status_code == 200, r.status_code
+
+        with Image.open(caminho) as img:
+            assert not img.getexif(), "EXIF não foi removido"
+            dims = img.size
+
+        recebido += len(foto)
+        gravado += os.path.getsize(caminho)
+        miniatura += len(r.data)
+
+        os.remove(caminho)
+        os.remove(app_mod._miniatura_chat_path(nome))
+
+    print(f"{n} fotos 4032x3024 (JPEG q92 com EXIF/GPS) -> gravadas em {dims[0]}x{dims[1]}, sem EXIF")
+    print(f"  recebido (antes ia inteiro para a conversa): {recebido / n / 1024:8.0f} KB/foto")
+    print(f"  gravado (baixado só no clique):              {gravado / n / 1024:8.0f} KB/foto  ({recebido / gravado:.1f}x menor)")
+    print(f"  miniatura (o que a conversa baixa agora):    {miniatura / n / 1024:8.0f} KB/foto  ({recebido / miniatura:.0f}x menor)")
+    print(f"  tempo: envio+redução {t_envio / n * 1000:.0f} ms/foto, 1ª miniatura {t_mini / n * 1000:.0f} ms/foto")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmark: comunicado novo para 500 sockets conectados.
+
+Sobe 1 servidor do app (eventlet, como no gunicorn), conecta N
+funcionários logados (cookie de sessão assinado com a SECRET_KEY do
+app) e publica comunicados pelo POST /admin/comunicados da Direção.
+Mede:
+- custo do broadcast no servidor (1 emit para a sala "logados")
+- latência POST -> evento "comunicado" em cada cliente
+- o que era antes: cada funcionário recarregando /comunicados
+e confere o contador de não vistos que o servidor manda na reconexão.
+
+Uso:
+    python benchmarks/comunicados_fanout.py [sockets] [comunicados]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, AQUI)
+sys.path.insert(0, os.path.abspath(os.path.join(AQUI, "..")))
+
+from socketio_dois_workers import Cliente, _esperar_worker, _porta_livre  # noqa: E402
+
+# banco descartável (o app cria tabelas/usuários padrão ao importar)
+_pasta = tempfile.mkdtemp()
+os.environ["SQLITE_PATH"] = os.path.join(_pasta, "bench.db")
+os.environ.setdefault("CHAT_LIMPEZA_INTERVALO_S", "0")
+
+from app import app, db, Funcionario  # noqa: E402
+
+
+def cookie_sessao(user_id, nome, funcao):
+    assinado = app.session_interface.get_signing_serializer(app).dumps(
+        {"user_id": user_id, "nome": nome, "funcao": funcao}
+    )
+    return f"{app.config['SESSION_COOKIE_NAME']}={assinado}"
+
+
+def criar_funcionarios(n):
+    with app.app_context():
+        existentes = Funcionario.query.filter(Funcionario.cpf.like("8%")).count()
+        for i in range(existentes, n):
+            db.session.add(Funcionario(
+                nome=f"Bench {i:04d}", cpf=f"8{i:010d}", senha="1",
+                funcao="Funcionário", status="Ativo",
+            ))
+        db.session.commit()
+        funcs = (
+            Funcionario.query.filter(Funcionario.cpf.like("8%"))
+            .order_by(Funcionario.id).limit(n).all()
+        )
+        direcao = Funcionario.query.filter_by(funcao="Direção").first()
+        return (
+            [cookie_sessao(f.id, f.nome, f.funcao) for f in funcs],
+            cookie_sessao(direcao.id, direcao.nome, direcao.funcao),
+        )
+
+
+def http(porta, caminho, cookie, dados=None):
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{porta}{caminho}",
+        data=urllib.parse.urlencode(dados).encode() if dados is not None else None,
+        headers={"Cookie": cookie},
+    )
+    with urllib.request.urlopen(req) as r:
+        return r.read()
+
+
+def ms(valores):
+    v = sorted(x * 1000 for x in valores)
+    return (
+        f"mediana {statistics.median(v):.1f} ms  "
+        f"p95 {v[max(0, int(len(v) * 0.95) - 1)]:.1f} ms  máx {v[-1]:.1f} ms"
+    )
+
+
+def main():
+    n_sockets = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    n_comunicados = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    cookies, cookie_direcao = criar_funcionarios(n_sockets)
+
+    porta = _porta_livre()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(AQUI, "socketio_dois_workers.py"), "--worker", str(porta)],
+        env=dict(os.environ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _esperar_worker(porta)
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=50) as ex:
+            clientes = list(ex.map(lambda c: Cliente(porta, cookie=c), cookies))
+        print(f"{n_sockets} sockets logados conectados em {time.perf_counter() - t0:.1f}s")
+
+        # cada conexão nova avisa "presenca" para todos: espera a rajada passar
+        time.sleep(2)
+
+        chegadas = [[] for _ in range(n_comunicados)]
+        trava = threading.Lock()
+        parar = threading.Event()
+
+        def ouvir(cli):
+            vistos = 0
+            while vistos < n_comunicados and not parar.is_set():
+                ev = cli.eventos(timeout=0.5)
+                if ev and ev[0] == "comunicado":
+                    agora = time.perf_counter()
+                    with trava:
+                        chegadas[vistos].append(agora)
+                    vistos += 1
+
+        leitores = [threading.Thread(target=ouvir, args=(c,), daemon=True) for c in clientes]
+        for t in leitores:
+            t.start()
+
+        lat, post, servidor = [], [], []
+        for k in range(n_comunicados):
+            t0 = time.perf_counter()
+            http(porta, "/admin/comunicados", cookie_direcao, {
+                "titulo": f"Comunicado {k}", "conteudo_html": "<p>teste de carga</p>",
+            })
+            post.append(time.perf_counter() - t0)
+
+            limite = time.time() + 10
+            while len(chegadas[k]) < n_sockets and time.time() < limite:
+                time.sleep(0.01)
+            lat.extend(t - t0 for t in chegadas[k])
+
+            status = json.loads(http(porta, "/admin/cache/status", cookie_direcao))
+            servidor.append(status["notificacoes"]["ultimo_broadcast_ms"] / 1000)
+
+        parar.set()
+        recebidos = sum(len(c) for c in chegadas)
+        print(f"{n_comunicados} comunicados publicados (1 emit cada para a sala \"logados\")")
+        print(f"  entregues: {recebidos}/{n_sockets * n_comunicados}")
+        print(f"  emit no servidor:              {ms(servidor)}")
+        print(f"  POST /admin/comunicados:       {ms(post)}")
+        print(f"  POST -> evento em cada socket: {ms(lat)}")
+
+        # o contador de não vistos é do servidor: reconectar devolve o total
+        cli = Cliente(porta, cookie=cookies[0])
+        contador = None
+        limite = time.time() + 5
+        while contador is None and time.time() < limite:
+            ev = cli.eventos(timeout=0.5)
+            if ev and ev[0] == "contadores":
+                contador = ev[1].get("comunicados")
+        print(f"  não vistos na reconexão: {contador} (esperado {n_comunicados})")
+        cli.fechar()
+
+        # antes: ninguém era avisado; cada um recarregava a página para descobrir
+        t0 = time.perf_counter()
+        for c in cookies:
+            http(porta, "/comunicados", c)
+        total = time.perf_counter() - t0
+        print(
+            f"  antes: {n_sockets} recargas de /comunicados = {total:.2f}s de servidor "
+            f"({total / n_sockets * 1000:.1f} ms cada) por rodada de verificação"
+        )
+
+        for c in clientes:
+            c.fechar()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
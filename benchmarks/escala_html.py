@@ -0,0 +1,164 @@
+"""
+Benchmark: renderização da grade da escala (400 funcionários × 31 dias).
+
+Compara o template antigo (para cada dia, percorre todos os itens do
+funcionário: O(dias²)) com a grade montada no servidor
+(admin/_escala_grade.html + montar_linhas_escala: 1 passada por célula).
+
+Uso:
+    python benchmarks/escala_html.py [funcionarios] [repeticoes]
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# banco descartável (o app cria tabelas/usuários padrão ao importar)
+os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import numpy as np  # noqa: E402
+
+import escala_grid  # noqa: E402
+from app import app, montar_linhas_escala, _fins_de_semana  # noqa: E402
+
+# trecho do template antigo (admin/escala_mes.html antes da grade no servidor)
+TEMPLATE_ANTIGO = """
+<table class="cal-table">
+  {% for equipe, ids in por_equipe.items() %}
+    <tr class="team-row"><td colspan="{{ 1 + (dias|length) }}">{{ equipe }} — SETOR: {{ escala.setor or "TODOS" }}</td></tr>
+    {% for func_id in ids %}
+      {% set itens = por_func.get(func_id) %}
+      {% set f = func_map.get(func_id) %}
+      {% set c_plantao = namespace(v=0) %}
+      {% set c_expediente = namespace(v=0) %}
+      {% set c_folga = namespace(v=0) %}
+      {% for it in itens %}
+        {% if it.tipo == "PLANTAO_24H" %}{% set c_plantao.v = c_plantao.v + 1 %}
+        {% elif it.tipo == "EXPEDIENTE" %}{% set c_expediente.v = c_expediente.v + 1 %}
+        {% elif it.tipo == "FOLGA" %}{% set c_folga.v = c_folga.v + 1 %}{% endif %}
+      {% endfor %}
+      <tr>
+        <td class="sticky-col">
+          <span class="nome">👤 {{ f.nome if f else "Funcionário" }}</span>
+          <span class="meta">{{ f.setor if f and f.setor else "-" }} | {{ f.escala_tipo if f and f.escala_tipo else "-" }}</span>
+          <span class="badge b-plantao">24H: {{ c_plantao.v }}</span>
+          <span class="badge b-exp">EXP: {{ c_expediente.v }}</span>
+          <span class="badge b-folga">F: {{ c_folga.v }}</span>
+        </td>
+        {% for d in dias %}
+          {% set ns = namespace(status=None, obs=None) %}
+          {% for it in itens %}
+            {% set dia_item = it.inicio.strftime("%d")|int %}
+            {% if dia_item == d %}{% set ns.status = it.tipo %}{% set ns.obs = it.observacao %}{% endif %}
+          {% endfor %}
+          <td title="Clique para editar | {{ ns.status or '-' }}{% if ns.obs %} — {{ ns.obs }}{% endif %}">
+            {% if ns.status == "PLANTAO_24H" %}
+              <div class="cell tipo-PLANTAO_24H js-cell" data-func="{{ func_id }}" data-dia="{{ d }}" data-tipo="PLANTAO_24H">24H</div>
+            {% elif ns.status == "EXPEDIENTE" %}
+              <div class="cell tipo-EXPEDIENTE js-cell" data-func="{{ func_id }}" data-dia="{{ d }}" data-tipo="EXPEDIENTE">EXP</div>
+            {% elif ns.status == "FOLGA" %}
+              <div class="cell tipo-FOLGA js-cell" data-func="{{ func_id }}" data-dia="{{ d }}" data-tipo="FOLGA">F</div>
+            {% else %}
+              <div class="cell js-cell" style="background:transparent; color:#999; font-weight:600;" data-func="{{ func_id }}" data-dia="{{ d }}" data-tipo="">-</div>
+            {% endif %}
+          </td>
+        {% endfor %}
+      </tr>
+    {% endfor %}
+  {% endfor %}
+</table>
+"""
+
+
+def grade_sintetica(n_func: int, ano=2026, mes=3):
+    regras = [
+        ("PLANTONISTA_24_96", f"2026-01-0{i % 5 + 1}") if i % 3 == 0 else ("SEG_SEX", None)
+        for i in range(n_func)
+    ]
+    matriz = escala_grid.calcular_grade(regras, ano, mes)
+    ids = list(range(1, n_func + 1))
+    funcionarios = {
+        fid: {"id": fid, "nome": f"FUNCIONARIO {fid:04d}", "setor": "ASG", "equipe": f"EQUIPE {fid % 4 + 1}",
+              "escala_tipo": regras[fid - 1][0], "plantao_base": regras[fid - 1][1],
+              "carga_horaria": "40H", "tipo_vinculo": "ESTATUTARIO"}
+        for fid in ids
+    }
+    equipes = [(f"EQUIPE {e}", [fid for fid in ids if fid % 4 + 1 == e]) for e in range(1, 5)]
+    ordem = [fid for _, lst in equipes for fid in lst]
+    return {
+        "escala": {"id": 1, "ano": ano, "mes": mes, "setor": "ASG"},
+        "dias": list(range(1, matriz.shape[1] + 1)),
+        "func_ids": ordem,
+        "linha": {fid: fid - 1 for fid in ids},
+        "funcionarios": funcionarios,
+        "equipes": equipes,
+        "matriz": matriz,
+        "obs": {},
+    }
+
+
+def contexto_antigo(grade):
+    esc = grade["escala"]
+    por_func = {}
+    for fid in grade["func_ids"]:
+        linha = grade["matriz"][grade["linha"][fid]].tolist()
+        por_func[fid] = [
+            {"tipo": escala_grid.TIPOS[cod], "inicio": datetime(esc["ano"], esc["mes"], d), "observacao": None}
+            for d, cod in zip(grade["dias"], linha) if cod
+        ]
+    return {
+        "escala": esc,
+        "por_func": por_func,
+        "func_map": grade["funcionarios"],
+        "dias": grade["dias"],
+        "por_equipe": dict(grade["equipes"]),
+    }
+
+
+def medir(fn, repeticoes):
+    tempos = []
+    html = ""
+    for _ in range(repeticoes):
+        t0 = perf_counter()
+        html = fn()
+        tempos.append(perf_counter() - t0)
+    return float(np.median(tempos)), len(html.encode("utf-8"))
+
+
+def main():
+    n_func = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    grade = grade_sintetica(n_func)
+
+    with app.app_context():
+        tpl_antigo = app.jinja_env.from_string(TEMPLATE_ANTIGO)
+        tpl_novo = app.jinja_env.get_template("admin/_escala_grade.html")
+
+        ctx_antigo = contexto_antigo(grade)
+
+        def render_antigo():
+            return tpl_antigo.render(**ctx_antigo)
+
+        def render_novo():
+            return tpl_novo.render(
+                escala=grade["escala"],
+                dias=grade["dias"],
+                fins_de_semana=_fins_de_semana(grade),
+                equipes=montar_linhas_escala(grade),
+            )
+
+        t_antigo, b_antigo = medir(render_antigo, repeticoes)
+        t_novo, b_novo = medir(render_novo, repeticoes)
+
+    print(f"Grade {n_func} × {len(grade['dias'])} (mediana de {repeticoes})")
+    print(f"  antigo: {t_antigo * 1000:8.1f} ms  {b_antigo / 1024:8.0f} KiB")
+    print(f"  novo:   {t_novo * 1000:8.1f} ms  {b_novo / 1024:8.0f} KiB")
+    print(f"  ganho:  {t_antigo / t_novo:8.1f}x tempo  {b_antigo / b_novo:6.1f}x bytes")
+
+
+if __name__ == "__main__":
+    main()
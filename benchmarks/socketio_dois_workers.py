@@ -0,0 +1,206 @@
+"""
+Benchmark: chat entre 2 workers (processos) pela fila do Socket.IO.
+
+Sobe 2 servidores do app (eventlet, só WebSocket), como o gunicorn faz
+com -w 2. O usuário 2 está conectado no worker B (sala "1_2") e o
+usuário 1 manda mensagens pelo worker A. Mede quantas chegam em B e a
+latência A -> fila -> B.
+
+Roda 2 vezes: sem fila (como era com -w 1: B não recebe nada) e com
+SOCKETIO_MESSAGE_QUEUE=sqlite:///... (ou a URL passada, ex. redis://...).
+
+Os clientes falam o protocolo do Engine.IO/Socket.IO direto no WebSocket
+(simple-websocket, já nas dependências), sem precisar do cliente python.
+
+Serve também de teste: sai com código 1 se, com a fila, alguma mensagem
+não chegar em B (dá para rodar no CI).
+
+Uso:
+    python benchmarks/socketio_dois_workers.py [mensagens] [url_da_fila]
+"""
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import simple_websocket
+
+RAIZ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+# ---------- worker (processo do servidor) ----------
+def worker(porta: int):
+    import eventlet
+    eventlet.monkey_patch()  # como o worker eventlet do gunicorn
+
+    sys.path.insert(0, RAIZ)
+    from app import app, socketio
+
+    socketio.run(app, host="127.0.0.1", port=porta, log_output=False)
+
+
+# ---------- cliente Socket.IO mínimo ----------
+class Cliente:
+    def __init__(self, porta: int, cookie: str | None = None):
+        # cookie: sessão do Flask (socket "logado")
+        self.ws = simple_websocket.Client.connect(
+            f"ws://127.0.0.1:{porta}/socket.io/?EIO=4&transport=websocket",
+            headers={"Cookie": cookie} if cookie else None,
+        )
+        # o pacote "open" do Engine.IO ("0{...}") às vezes chega junto com a
+        # resposta do handshake e o simple-websocket perde; não faz falta
+        self.ws.receive(timeout=0.5)
+        self.ws.send("40")  # conecta no namespace "/"
+        self.pendentes = []  # eventos emitidos no connect podem chegar antes do "40"
+        fim = time.time() + 5
+        while time.time() < fim:
+            msg = self.ws.receive(timeout=1)
+            if msg and msg.startswith("40"):
+                return
+            if msg and msg.startswith("42"):
+                self.pendentes.append(json.loads(msg[2:]))
+        raise RuntimeError(f"sem resposta do worker na porta {porta}")
+
+    def emit(self, evento, dados):
+        self.ws.send("42" + json.dumps([evento, dados]))
+
+    def eventos(self, timeout):
+        # devolve (nome, dados) e responde os pings do servidor
+        if self.pendentes:
+            return self.pendentes.pop(0)
+        msg = self.ws.receive(timeout=timeout)
+        if msg is None:
+            return None
+        if msg == "2":
+            self.ws.send("3")
+            return None
+        if msg.startswith("42"):
+            return json.loads(msg[2:])
+        return None
+
+    def fechar(self):
+        self.ws.close()
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _esperar_worker(porta, limite=30):
+    # a porta abre antes do app terminar de subir: espera o upgrade do WebSocket
+    fim = time.time() + limite
+    while time.time() < fim:
+        try:
+            simple_websocket.Client.connect(
+                f"ws://127.0.0.1:{porta}/socket.io/?EIO=4&transport=websocket"
+            ).close()
+            return
+        except (OSError, simple_websocket.ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError(f"worker na porta {porta} não subiu")
+
+
+def cookie_sessao(user_id: int) -> str:
+    # sessão do Flask assinada com a mesma SECRET_KEY dos workers: o "join"
+    # só aceita a sala de conversa de quem está logado
+    from flask import Flask
+
+    f = Flask(__name__)
+    f.secret_key = os.getenv("SECRET_KEY", "hospital2026_dev_troque_em_producao")
+    assinado = f.session_interface.get_signing_serializer(f).dumps(
+        {"user_id": user_id, "nome": f"Usuário {user_id}", "funcao": "Funcionário"}
+    )
+    return f"{f.config['SESSION_COOKIE_NAME']}={assinado}"
+
+
+# ---------- orquestração ----------
+def rodada(n_msgs: int, fila: str, pasta: str):
+    env = dict(os.environ)
+    env["SQLITE_PATH"] = os.path.join(pasta, "bench.db")
+    env["SOCKETIO_MESSAGE_QUEUE"] = fila
+    env["SOCKETIO_SO_WEBSOCKET"] = "1"
+
+    portas = [_porta_livre(), _porta_livre()]
+    procs = []
+    for porta in portas:
+        procs.append(subprocess.Popen(
+            [sys.executable, __file__, "--worker", str(porta)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+        _esperar_worker(porta)  # um de cada vez: o primeiro cria o banco
+
+    try:
+        a = Cliente(portas[0], cookie=cookie_sessao(1))
+        b = Cliente(portas[1], cookie=cookie_sessao(2))
+        b.emit("join", {"room": "1_2"})
+        time.sleep(0.2)
+
+        latencias = []
+
+        def receber():
+            limite = time.time() + 5 + n_msgs * 0.02
+            while len(latencias) < n_msgs and time.time() < limite:
+                ev = b.eventos(timeout=0.5)
+                if ev and ev[0] == "receive":
+                    enviado = float(ev[1]["text"].split()[1])
+                    latencias.append(time.time() - enviado)
+
+        leitor = threading.Thread(target=receber)
+        leitor.start()
+
+        for i in range(n_msgs):
+            a.emit("send_message", {
+                "from": 1, "to": 2, "room": "1_2",
+                "text": f"{i} {time.time():.6f}",
+            })
+            time.sleep(0.005)
+
+        leitor.join()
+        a.fechar()
+        b.fechar()
+        return latencias
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+
+def main():
+    n_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pasta = tempfile.mkdtemp()
+    url = sys.argv[2] if len(sys.argv) > 2 else f"sqlite:///{os.path.join(pasta, 'socketio_fila.db')}"
+
+    print(f"{n_msgs} mensagens do worker A para um cliente conectado no worker B")
+    recebidas_com_fila = 0
+    for nome, fila in (("sem fila", ""), (url, url)):
+        lat = rodada(n_msgs, fila, pasta)
+        if fila:
+            recebidas_com_fila = len(lat)
+        if lat:
+            ms = sorted(x * 1000 for x in lat)
+            print(
+                f"  {nome}: {len(lat)}/{n_msgs} recebidas  "
+                f"latência mediana {statistics.median(ms):.1f} ms  "
+                f"p95 {ms[max(0, int(len(ms) * 0.95) - 1)]:.1f} ms  máx {ms[-1]:.1f} ms"
+            )
+        else:
+            print(f"  {nome}: 0/{n_msgs} recebidas")
+
+    if recebidas_com_fila < n_msgs:
+        print(f"❌ FALHOU: com a fila só {recebidas_com_fila}/{n_msgs} mensagens chegaram no worker B")
+        sys.exit(1)
+    print("✅ OK: todas as mensagens chegaram no worker B pela fila")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        worker(int(sys.argv[2]))
+    else:
+        main()
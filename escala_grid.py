@@ -0,0 +1,260 @@
+import calendar
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+# ==================================================
+# GRADE DA ESCALA (CÁLCULO VETORIZADO)
+# ==================================================
+# Módulo "puro" (sem Flask/banco): pode ser usado pelo app
+# e também por processos auxiliares (multiprocessing).
+
+# códigos pequenos para cada tipo de célula
+VAZIO = 0
+EXPEDIENTE = 1
+FOLGA = 2
+PLANTAO_24H = 3
+FERIAS = 4
+
+TIPOS = ("", "EXPEDIENTE", "FOLGA", "PLANTAO_24H", "FERIAS")
+CODIGO_POR_TIPO = {t: i for i, t in enumerate(TIPOS) if t}
+
+# horário de cada tipo em minutos a partir da 00:00 do dia (inicio, fim)
+HORARIOS = {
+    EXPEDIENTE: (8 * 60, 17 * 60),
+    FOLGA: (0, 23 * 60 + 59),
+    PLANTAO_24H: (7 * 60, 7 * 60 + 24 * 60),
+    FERIAS: (0, 23 * 60 + 59),
+}
+
+# 1970-01-01 foi quinta-feira (weekday 3)
+_EPOCH_WEEKDAY = 3
+
+
+def normalizar_escala_tipo(escala_tipo: str | None) -> str:
+    t = (escala_tipo or "SEG_SEX").strip().upper()
+    if t in ("DIURNO", "DIARIO"):
+        t = "SEG_SEX"
+    return t
+
+
+def _parse_base(s: str | None):
+    try:
+        y, m, d = (s or "").split("-")
+        return date(int(y), int(m), int(d))
+    except Exception:
+        return None
+
+
+def horario(ano: int, mes: int, dia: int, codigo: int):
+    """(inicio, fim) do tipo `codigo` no dia informado."""
+    ini_min, fim_min = HORARIOS[codigo]
+    base = datetime(ano, mes, dia)
+    return base + timedelta(minutes=ini_min), base + timedelta(minutes=fim_min)
+
+
+def dias_do_mes(ano: int, mes: int) -> np.ndarray:
+    n = calendar.monthrange(ano, mes)[1]
+    inicio = np.datetime64(date(ano, mes, 1), "D")
+    return inicio + np.arange(n)
+
+
+def calcular_grade(regras, ano: int, mes: int) -> np.ndarray:
+    """
+    Calcula a grade do mês para vários funcionários de uma vez.
+    - regras: lista de (escala_tipo, plantao_base) na mesma ordem das linhas
+    - retorna matriz int8 (funcionários × dias) com os códigos acima
+    - SEG_SEX: seg-sex EXPEDIENTE, sáb/dom FOLGA
+    - PLANTONISTA_24_96: PLANTAO_24H a cada 5 dias a partir de plantao_base
+    - sem regra válida (ex.: 24x96 sem base): linha VAZIO
+    """
+    dias = dias_do_mes(ano, mes).astype(np.int64)
+    grade = np.zeros((len(regras), len(dias)), dtype=np.int8)
+    if not len(regras):
+        return grade
+
+    tipos = np.array([normalizar_escala_tipo(t) for t, _ in regras])
+
+    # SEG_SEX
+    seg_sex = tipos == "SEG_SEX"
+    if seg_sex.any():
+        dow = (dias + _EPOCH_WEEKDAY) % 7
+        linha = np.where(dow <= 4, EXPEDIENTE, FOLGA).astype(np.int8)
+        grade[seg_sex] = linha
+
+    # PLANTONISTA_24_96
+    bases = [
+        _parse_base(pb) if t == "PLANTONISTA_24_96" else None
+        for t, (_, pb) in zip(tipos, regras)
+    ]
+    plantonista = np.array([b is not None for b in bases], dtype=bool)
+    if plantonista.any():
+        base_dias = np.array(
+            [np.datetime64(b, "D").astype(np.int64) for b in bases if b is not None],
+            dtype=np.int64
+        )
+        delta = dias[None, :] - base_dias[:, None]
+        grade[plantonista] = np.where((delta >= 0) & (delta % 5 == 0), PLANTAO_24H, FOLGA)
+
+    return grade
+
+
+def linhas_da_grade(grade: np.ndarray, funcionario_ids, escala_mes_id: int, ano: int, mes: int):
+    """
+    Converte a grade em dicts prontos para INSERT em lote (escala_item).
+    Gera as linhas funcionário por funcionário, na ordem da grade.
+    """
+    minutos_dia = dias_do_mes(ano, mes).astype("datetime64[m]")
+    ids = np.asarray(funcionario_ids, dtype=np.int64)
+
+    # horários pré-calculados por tipo (vetor de dias)
+    ini_por_tipo = {}
+    fim_por_tipo = {}
+    for codigo, (ini_min, fim_min) in HORARIOS.items():
+        ini_por_tipo[codigo] = (minutos_dia + np.timedelta64(ini_min, "m")).astype("datetime64[us]").tolist()
+        fim_por_tipo[codigo] = (minutos_dia + np.timedelta64(fim_min, "m")).astype("datetime64[us]").tolist()
+
+    linhas_idx, dias_idx = np.nonzero(grade)
+    codigos = grade[linhas_idx, dias_idx]
+
+    for li, di, cod in zip(linhas_idx.tolist(), dias_idx.tolist(), codigos.tolist()):
+        yield {
+            "escala_mes_id": escala_mes_id,
+            "funcionario_id": int(ids[li]),
+            "inicio": ini_por_tipo[cod][di],
+            "fim": fim_por_tipo[cod][di],
+            "tipo": TIPOS[cod],
+            "observacao": None,
+        }
+
+
+def calcular_grade_tarefa(tarefa):
+    """
+    Versão "picklável" para ProcessPoolExecutor.
+    tarefa = (chave, regras, ano, mes) -> (chave, grade)
+    """
+    chave, regras, ano, mes = tarefa
+    return chave, calcular_grade(regras, ano, mes)
+
+
+def meses_intervalo(de: tuple, ate: tuple):
+    """Lista de (ano, mes) de `de` até `ate` (inclusive)."""
+    ano, mes = de
+    meses = []
+    while (ano, mes) <= tuple(ate):
+        meses.append((ano, mes))
+        mes += 1
+        if mes > 12:
+            ano, mes = ano + 1, 1
+    return meses
+
+
+# ==================================================
+# COBERTURA (VARREDURA DE INTERVALOS)
+# ==================================================
+
+_ORDINAL_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def para_minutos(datas) -> np.ndarray:
+    """Lista de datetime (ou texto ISO, como vem do banco) -> minutos desde 1970-01-01 (int64)."""
+    if len(datas) and isinstance(datas[0], str):
+        # texto: o numpy converte tudo de uma vez em C
+        return np.array(datas, dtype="datetime64[m]").astype(np.int64)
+    # aritmética direta: ~10x mais rápido que np.array(..., "datetime64[m]") com objetos datetime
+    return np.fromiter(
+        ((d.toordinal() - _ORDINAL_EPOCH) * 1440 + d.hour * 60 + d.minute for d in datas),
+        dtype=np.int64,
+        count=len(datas),
+    )
+
+
+def intervalos_da_grade(grade: np.ndarray, ano: int, mes: int, codigos=(EXPEDIENTE, PLANTAO_24H)):
+    """
+    Intervalos das células da grade com tipo em `codigos`, sem passar por
+    datetime: minuto do dia 1 + dia * 1440 + horário do tipo.
+    Retorna (linhas, ini_min, fim_min, tipos) — arrays na mesma ordem.
+    """
+    linhas, dias = np.nonzero(np.isin(grade, codigos))
+    tipos = grade[linhas, dias]
+
+    ini_tipo = np.zeros(len(TIPOS), dtype=np.int64)
+    fim_tipo = np.zeros(len(TIPOS), dtype=np.int64)
+    for codigo, (ini_min, fim_min) in HORARIOS.items():
+        ini_tipo[codigo] = ini_min
+        fim_tipo[codigo] = fim_min
+
+    dia1 = (date(ano, mes, 1).toordinal() - _ORDINAL_EPOCH) * 1440
+    base = dia1 + dias.astype(np.int64) * 1440
+    return linhas, base + ini_tipo[tipos], base + fim_tipo[tipos], tipos
+
+
+def cobertura(ini_min, fim_min, grupos, n_grupos: int, t0_min: int, n_slots: int, slot_min: int) -> np.ndarray:
+    """
+    Quantas pessoas em serviço por grupo e por faixa de tempo.
+    - ini_min/fim_min: intervalos em minutos (ver para_minutos)
+    - grupos: índice do grupo (0..n_grupos-1) de cada intervalo
+    - faixas de `slot_min` minutos a partir de t0_min; um intervalo conta
+      em toda faixa que ele toca
+    Varredura: +1 na faixa de início, -1 depois da última, soma acumulada.
+    Retorna matriz int32 (n_grupos × n_slots).
+    """
+    ini = np.asarray(ini_min, dtype=np.int64) - t0_min
+    fim = np.asarray(fim_min, dtype=np.int64) - t0_min
+    g = np.asarray(grupos, dtype=np.int64)
+
+    a = np.clip(ini // slot_min, 0, n_slots)
+    b = np.clip(-(-fim // slot_min), 0, n_slots)  # teto
+    ok = b > a
+    a, b, g = a[ok], b[ok], g[ok]
+
+    largura = n_slots + 1
+    tamanho = n_grupos * largura
+    delta = (
+        np.bincount(g * largura + a, minlength=tamanho)
+        - np.bincount(g * largura + b, minlength=tamanho)
+    ).reshape(n_grupos, largura)
+    return np.cumsum(delta[:, :-1], axis=1, dtype=np.int32)
+
+
+# ==================================================
+# ÍNDICE DE INTERVALOS ("QUEM ESTÁ DE SERVIÇO")
+# ==================================================
+
+class IndiceIntervalos:
+    """
+    Intervalos [ini, fim) ordenados pelo início, para consulta por bisect.
+    Como nenhum turno passa de `duracao_max`, quem está em serviço no
+    instante t começou em [t - duracao_max, t]: só essa fatia é olhada.
+    """
+
+    def __init__(self, ini, fim):
+        ini = np.asarray(ini, dtype=np.int64)
+        fim = np.asarray(fim, dtype=np.int64)
+        self.ordem = np.argsort(ini, kind="stable")
+        self.ini = ini[self.ordem]
+        self.fim = fim[self.ordem]
+        self._inicios = self.ini.tolist()  # lista Python: bisect direto, sem conversão
+        self.duracao_max = int((self.fim - self.ini).max()) if len(self.ini) else 0
+
+    def __len__(self):
+        return len(self._inicios)
+
+    def entre(self, a: int, b: int) -> np.ndarray:
+        """Posições originais dos intervalos que tocam [a, b) (ini < b e fim > a)."""
+        lo = bisect_left(self._inicios, a - self.duracao_max)
+        hi = bisect_left(self._inicios, b)
+        if lo >= hi:
+            return self.ordem[:0]
+        fatia = self.fim[lo:hi] > a
+        return self.ordem[lo:hi][fatia]
+
+    def em(self, t: int) -> np.ndarray:
+        """Posições originais dos intervalos em andamento no instante t (ini <= t < fim)."""
+        lo = bisect_left(self._inicios, t - self.duracao_max)
+        hi = bisect_right(self._inicios, t)
+        if lo >= hi:
+            return self.ordem[:0]
+        fatia = self.fim[lo:hi] > t
+        return self.ordem[lo:hi][fatia]
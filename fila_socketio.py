@@ -0,0 +1,105 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import socketio
+
+# ==================================================
+# FILA DO SOCKET.IO EM SQLITE (VÁRIOS WORKERS NA MESMA MÁQUINA)
+# ==================================================
+# Com mais de 1 worker, cada processo só conhece os sockets conectados nele.
+# O emit para uma sala ("1_2", ...) precisa chegar nos outros processos:
+# o python-socketio resolve isso com um "client manager" pub/sub
+# (Redis, RabbitMQ/Kombu, Kafka, ZeroMQ). Este aqui usa um arquivo SQLite
+# como barramento: publica = INSERT, escuta = SELECT id > último a cada
+# poucos ms. Sem serviço extra — serve para rodar 2+ workers no mesmo
+# servidor e para testar o modo multi-worker localmente. Em vários
+# servidores, use Redis (SOCKETIO_MESSAGE_QUEUE=redis://...).
+#
+# - o id AUTOINCREMENT nunca volta atrás nem é reaproveitado, então
+#   "id > último lido" não perde nem repete mensagem
+# - quem escuta começa do fim (como um pub/sub: não recebe o que foi
+#   publicado antes de subir)
+# - mensagens com mais de `retencao` segundos são apagadas; um worker
+#   travado por mais tempo que isso perde os eventos do período
+
+TABELA = "socketio_fila"
+
+
+def caminho_da_url(url: str) -> str:
+    """'sqlite:///instance/fila.db' -> 'instance/fila.db' (mesma regra do SQLAlchemy)."""
+    if not url.startswith("sqlite:///"):
+        raise ValueError(f"URL de fila SQLite inválida: {url!r} (use sqlite:///caminho.db)")
+    caminho = url[len("sqlite:///"):]
+    if not caminho or caminho == ":memory:":
+        raise ValueError("A fila precisa de um arquivo (memória não é compartilhada entre processos)")
+    return caminho
+
+
+class SqliteFilaManager(socketio.PubSubManager):
+    name = "sqlite"
+
+    def __init__(self, url="sqlite:///socketio_fila.db", channel="socketio",
+                 write_only=False, logger=None, intervalo=0.05, retencao=60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.caminho = caminho_da_url(url)
+        self.intervalo = intervalo
+        self.retencao = retencao
+
+        self._lock = threading.Lock()
+        self._con_publicar = None
+
+        pasta = os.path.dirname(os.path.abspath(self.caminho))
+        os.makedirs(pasta, exist_ok=True)
+        con = self._conectar()
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {TABELA} ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " canal TEXT NOT NULL,"
+            " dados TEXT NOT NULL,"
+            " criado REAL NOT NULL)"
+        )
+        con.execute(f"CREATE INDEX IF NOT EXISTS ix_{TABELA}_criado ON {TABELA} (criado)")
+        con.close()
+
+    def _conectar(self):
+        # autocommit (isolation_level=None): cada INSERT já é visível para os outros
+        con = sqlite3.connect(self.caminho, timeout=30, isolation_level=None, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute("PRAGMA synchronous=NORMAL;")
+        con.execute("PRAGMA busy_timeout=30000;")
+        return con
+
+    def _publish(self, data):
+        dados = json.dumps(data)
+        with self._lock:
+            if self._con_publicar is None:
+                self._con_publicar = self._conectar()
+            self._con_publicar.execute(
+                f"INSERT INTO {TABELA} (canal, dados, criado) VALUES (?, ?, ?)",
+                (self.channel, dados, time.time())
+            )
+
+    def _listen(self):
+        con = self._conectar()
+        ultimo = con.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABELA}").fetchone()[0]
+        limpo_em = time.monotonic()
+
+        while True:
+            linhas = con.execute(
+                f"SELECT id, dados FROM {TABELA} WHERE id > ? AND canal = ? ORDER BY id",
+                (ultimo, self.channel)
+            ).fetchall()
+
+            for id_, dados in linhas:
+                ultimo = id_
+                yield dados
+
+            if time.monotonic() - limpo_em > self.retencao:
+                con.execute(f"DELETE FROM {TABELA} WHERE criado < ?", (time.time() - self.retencao,))
+                limpo_em = time.monotonic()
+
+            if not linhas:
+                self.server.sleep(self.intervalo)
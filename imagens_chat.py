@@ -0,0 +1,94 @@
+import io
+import os
+
+from PIL import Image, ImageOps
+
+# ==================================================
+# IMAGENS DO CHAT (REDUÇÃO + MINIATURAS)
+# ==================================================
+# Módulo "puro" (sem Flask/banco). Foto de celular chega com 3-6 MB,
+# 4000 px e EXIF (GPS, modelo do aparelho...). Na gravação:
+# - aplica a rotação do EXIF e joga fora todos os metadados
+# - reduz para no máximo `max_lado` px no lado maior
+# - regrava em JPEG progressivo (ou WebP quando tem transparência)
+# A miniatura (tela da conversa) é gerada sob demanda a partir da imagem
+# já reduzida; o original (reduzido) só é baixado no clique.
+
+EXTENSOES = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+
+# ~40 MP: acima disso não é foto de celular, é arquivo suspeito (bomba de descompressão)
+MAX_PIXELS = 40_000_000
+
+
+def eh_imagem(nome: str) -> bool:
+    return os.path.splitext(nome or "")[1].lower() in EXTENSOES
+
+
+def _abrir(origem, reduzir_para=None):
+    img = Image.open(origem)
+    if img.width * img.height > MAX_PIXELS:
+        raise ValueError(f"imagem grande demais ({img.width}x{img.height})")
+    if getattr(img, "n_frames", 1) > 1:
+        raise ValueError("imagem animada")  # GIF/WebP animado fica como anexo comum
+    if reduzir_para:
+        img.draft("RGB", reduzir_para)  # JPEG: decodifica já em 1/2, 1/4 ou 1/8 (bem mais rápido)
+    img.load()
+    return img
+
+
+def _tem_transparencia(img) -> bool:
+    if img.mode in ("RGBA", "LA"):
+        return img.getchannel("A").getextrema()[0] < 255
+    return img.mode == "P" and "transparency" in img.info
+
+
+def _codificar(img, qualidade: int):
+    """(bytes, extensão). Sem exif/xmp: o save do Pillow só grava o que for passado."""
+    saida = io.BytesIO()
+    icc = img.info.get("icc_profile")  # perfil de cor não identifica ninguém e evita foto "desbotada"
+
+    if _tem_transparencia(img):
+        img = img.convert("RGBA")
+        img.save(saida, "WEBP", quality=qualidade, method=4, icc_profile=icc)
+        return saida.getvalue(), ".webp"
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.save(saida, "JPEG", quality=qualidade, optimize=True, progressive=True, icc_profile=icc)
+    return saida.getvalue(), ".jpg"
+
+
+def reduzir_imagem(origem, max_lado: int = 1600, qualidade: int = 80):
+    """
+    Lê a imagem (caminho ou arquivo) e devolve (bytes, extensão) já
+    rotacionada, sem metadados e com no máximo max_lado px.
+    ValueError / OSError se não for uma imagem que dá para processar.
+    """
+    img = _abrir(origem, reduzir_para=(max_lado, max_lado))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("I;16", "I", "F"):
+        img = img.convert("RGB")
+    img.thumbnail((max_lado, max_lado), Image.LANCZOS)
+    return _codificar(img, qualidade)
+
+
+def gerar_miniatura(caminho_origem: str, caminho_destino: str, lado: int = 320, qualidade: int = 70):
+    """
+    Grava a miniatura WebP (lado maior = `lado` px) em caminho_destino,
+    trocando o arquivo de uma vez. Sempre WebP: guarda transparência e o
+    nome do cache não depende do conteúdo. Retorna o tamanho em bytes.
+    """
+    img = _abrir(caminho_origem, reduzir_para=(lado * 2, lado * 2))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((lado, lado), Image.BICUBIC)
+    img = img.convert("RGBA" if _tem_transparencia(img) else "RGB")
+
+    saida = io.BytesIO()
+    img.save(saida, "WEBP", quality=qualidade, method=4)
+    conteudo = saida.getvalue()
+
+    tmp = f"{caminho_destino}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(conteudo)
+    os.replace(tmp, caminho_destino)
+    return len(conteudo)
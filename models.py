@@ -47,6 +47,9 @@ class Funcionario(db.Model):
     # Base do ciclo 24x96 (YYYY-MM-DD): data do PRIMEIRO PLANTÃO.
     plantao_base = db.Column(db.String(10), nullable=True)
 
+    # ✅ último comunicado visto (não vistos = comunicados com id maior)
+    comunicado_visto_id = db.Column(db.Integer, nullable=False, default=0)
+
     # Relacionamentos úteis
     escalas_itens = db.relationship(
         "EscalaItem",
@@ -55,6 +58,13 @@ class Funcionario(db.Model):
         cascade="all, delete-orphan"
     )
 
+    escalas_regras = db.relationship(
+        "EscalaRegra",
+        backref="funcionario",
+        lazy=True,
+        cascade="all, delete-orphan"
+    )
+
     # Relacionamentos do chat (evita ambiguidade por ter 2 FKs na Mensagem)
     mensagens_enviadas = db.relationship(
         "Mensagem",
@@ -125,6 +135,86 @@ class Mensagem(db.Model):
     )
 
 
+# ==================================================
+# RESUMO DAS CONVERSAS (SIDEBAR DO CHAT)
+# ==================================================
+class ConversaResumo(db.Model):
+    """
+    1 linha por (usuário, contato): última mensagem e não lidas.
+    Atualizada a cada mensagem gravada e pela limpeza das vencidas,
+    para a lista de conversas ser 1 leitura no índice (usuario_id, ultimo_envio).
+    """
+    __tablename__ = "conversa_resumo"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    usuario_id = db.Column(
+        db.Integer,
+        db.ForeignKey("funcionario.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    contato_id = db.Column(
+        db.Integer,
+        db.ForeignKey("funcionario.id", ondelete="CASCADE"),
+        nullable=False
+    )
+
+    ultima_mensagem_id = db.Column(db.Integer, nullable=True)
+    ultimo_texto = db.Column(db.String(120), nullable=True)
+    ultimo_envio = db.Column(db.DateTime, nullable=False)
+    ultimo_expira = db.Column(db.DateTime, nullable=False)  # quando a última mensagem vence
+    ultimo_remetente_id = db.Column(db.Integer, nullable=True)
+
+    nao_lidas = db.Column(db.Integer, nullable=False, default=0)
+    lido_em = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint("usuario_id", "contato_id", name="uq_conversa_resumo_par"),
+        db.Index("ix_conversa_resumo_usuario_envio", "usuario_id", "ultimo_envio"),
+    )
+
+
+# ==================================================
+# PRESENÇA (SOCKETS CONECTADOS)
+# ==================================================
+class PresencaSocket(db.Model):
+    """
+    1 linha por conexão Socket.IO autenticada, em qualquer worker.
+    Online = tem linha com visto_em recente (cada worker renova as suas;
+    as de um worker que caiu vencem sozinhas).
+    """
+    __tablename__ = "presenca_socket"
+
+    sid = db.Column(db.String(64), primary_key=True)
+
+    usuario_id = db.Column(
+        db.Integer,
+        db.ForeignKey("funcionario.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+
+    sala = db.Column(db.String(50), nullable=True, index=True)  # sala do chat aberta ("1_2")
+    worker = db.Column(db.String(32), nullable=False, index=True)
+
+    conectado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    visto_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+# ==================================================
+# VERSÃO DE CACHES EM MEMÓRIA (ENTRE WORKERS)
+# ==================================================
+class VersaoCache(db.Model):
+    """
+    Contador por cache ("diretorio", ...): quem altera os dados sobe a
+    versão na mesma transação; cada worker compara com a que montou.
+    """
+    __tablename__ = "versao_cache"
+
+    nome = db.Column(db.String(40), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+
 # ==================================================
 # ESCALA DO MÊS
 # ==================================================
@@ -139,6 +229,13 @@ class EscalaMes(db.Model):
     setor = db.Column(db.String(80), nullable=True)
     criado_em = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    # ✅ sobe a cada alteração de itens/equipes (chave do cache do PDF)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+    # ✅ "itens": 1 EscalaItem por pessoa/dia (formato antigo)
+    #    "regras": 1 EscalaRegra por pessoa + EscalaItem só nas exceções
+    armazenamento = db.Column(db.String(10), nullable=False, default="itens")
+
     criado_por_id = db.Column(
         db.Integer,
         db.ForeignKey("funcionario.id", ondelete="SET NULL"),
@@ -151,6 +248,12 @@ class EscalaMes(db.Model):
         cascade="all, delete-orphan"
     )
 
+    regras = db.relationship(
+        "EscalaRegra",
+        backref="escala_mes",
+        cascade="all, delete-orphan"
+    )
+
     # ✅ Trocas associadas a esta escala (se tiver)
     trocas = db.relationship(
         "TrocaPlantao",
@@ -191,12 +294,50 @@ class EscalaItem(db.Model):
 
     observacao = db.Column(db.String(200), nullable=True)
 
+    # ✅ célula "travada": editada à mão ou alterada por troca aprovada
+    # (a regeneração incremental não mexe nela)
+    fixado = db.Column(db.Boolean, nullable=False, default=False)
+
     __table_args__ = (
         db.Index("ix_escala_item_mes_func", "escala_mes_id", "funcionario_id"),
         db.Index("ix_escala_item_mes_tipo", "escala_mes_id", "tipo"),
     )
 
 
+# ==================================================
+# REGRAS DA ESCALA (ARMAZENAMENTO "regras")
+# ==================================================
+class EscalaRegra(db.Model):
+    """
+    Regra de rodízio de 1 funcionário em 1 escala (cópia de escala_tipo /
+    plantao_base no momento da geração). As células do mês saem da regra
+    (escala_grid.calcular_grade); EscalaItem guarda só as exceções
+    (edições manuais, trocas aprovadas, férias).
+    """
+    __tablename__ = "escala_regra"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    escala_mes_id = db.Column(
+        db.Integer,
+        db.ForeignKey("escala_mes.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    funcionario_id = db.Column(
+        db.Integer,
+        db.ForeignKey("funcionario.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+
+    escala_tipo = db.Column(db.String(30), nullable=True)
+    plantao_base = db.Column(db.String(10), nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint("escala_mes_id", "funcionario_id", name="uq_escala_regra_mes_func"),
+    )
+
+
 # ==================================================
 # ✅ TROCA DE PLANTÃO (NOVO)
 # ==================================================
@@ -250,4 +391,87 @@ class TrocaPlantao(db.Model):
 
     __table_args__ = (
         db.Index("ix_troca_data_status", "data", "status"),
-    )
\ No newline at end of file
+    )
+
+# ==================================================
+# COMUNICADOS / CURSOS / SETORES / PEDIDOS
+# ==================================================
+# Antes eram listas em memória no app.py: cada worker do gunicorn tinha a sua
+# e tudo sumia a cada deploy. No banco, todos os processos enxergam o mesmo.
+class Comunicado(db.Model):
+    __tablename__ = "comunicado"
+
+    id = db.Column(db.Integer, primary_key=True)
+    titulo = db.Column(db.String(200), nullable=False)
+    conteudo_html = db.Column(db.Text, nullable=True)
+    pdf = db.Column(db.String(255), nullable=True)
+
+    # "dd/mm/aaaa HH:MM" (como era exibido na lista em memória)
+    data = db.Column(db.String(20), nullable=False)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class Curso(db.Model):
+    __tablename__ = "curso"
+
+    id = db.Column(db.Integer, primary_key=True)
+    titulo = db.Column(db.String(200), nullable=False)
+    descricao = db.Column(db.Text, nullable=True)
+    video = db.Column(db.String(500), nullable=True)
+    pdf = db.Column(db.String(255), nullable=True)
+    carga = db.Column(db.String(20), nullable=False, default="0")
+    data = db.Column(db.String(10), nullable=False)  # dd/mm/aaaa
+
+    conclusoes = db.relationship(
+        "ConclusaoCurso",
+        backref="curso",
+        lazy=True,
+        cascade="all, delete-orphan"
+    )
+
+
+class ConclusaoCurso(db.Model):
+    __tablename__ = "conclusao_curso"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    funcionario_id = db.Column(
+        db.Integer,
+        db.ForeignKey("funcionario.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+    curso_id = db.Column(
+        db.Integer,
+        db.ForeignKey("curso.id", ondelete="CASCADE"),
+        nullable=False
+    )
+
+    data = db.Column(db.String(10), nullable=False)  # dd/mm/aaaa (vai no código do certificado)
+
+    funcionario = db.relationship("Funcionario")
+
+    __table_args__ = (
+        db.UniqueConstraint("funcionario_id", "curso_id", name="uq_conclusao_func_curso"),
+    )
+
+
+class Setor(db.Model):
+    __tablename__ = "setor"
+
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(80), unique=True, nullable=False)
+
+
+class PedidoMaterial(db.Model):
+    __tablename__ = "pedido_material"
+
+    id = db.Column(db.Integer, primary_key=True)
+    funcionario = db.Column(db.String(120), nullable=False)  # nome de quem pediu
+    setor = db.Column(db.String(80), nullable=True)
+    material = db.Column(db.String(200), nullable=False)
+    quantidade = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.String(10), nullable=False)  # dd/mm/aaaa
+
+    # Pendente / Aprovado / Rejeitado
+    status = db.Column(db.String(20), nullable=False, default="Pendente")
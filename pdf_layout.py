@@ -0,0 +1,430 @@
+import io
+import os
+from datetime import date
+from functools import lru_cache
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+
+# ==================================================
+# CAMADA DE PDF DOS RELATÓRIOS (GRADE)
+# ==================================================
+# - logos lidos/decodificados 1 vez por processo
+# - "moldura" da página (logos, títulos, cabeçalho da tabela, fins de
+#   semana) desenhada 1 vez por documento como form XObject e só
+#   carimbada em cada página (PDF menor e mais rápido)
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+IMG_DIR = os.path.join(BASE_DIR, "static", "img")
+
+CABECALHO_PADRAO = (
+    ("Helvetica-Bold", 12, "SECRETARIA MUNICIPAL DE SAÚDE DE CABO FRIO"),
+    ("Helvetica-Bold", 14, "HOSPITAL MUNICIPAL DA MULHER"),
+)
+
+
+def achar_logo(nome: str):
+    # aceita .png/.jpg/.jpeg
+    for ext in (".png", ".jpg", ".jpeg"):
+        p = os.path.join(IMG_DIR, nome + ext)
+        if os.path.exists(p):
+            return p
+    return None
+
+
+@lru_cache(maxsize=16)
+def imagem(caminho: str | None):
+    """ImageReader decodificado uma vez por processo (None se falhar)."""
+    if not caminho:
+        return None
+    try:
+        img = ImageReader(caminho)
+        img.getRGBData()  # força a decodificação agora (fica guardada no objeto)
+        return img
+    except Exception as e:
+        print("⚠️ Erro ao ler imagem:", caminho, e)
+        return None
+
+
+def logos():
+    return imagem(achar_logo("logo_prefeitura")), imagem(achar_logo("logo_hospital"))
+
+
+class RelatorioGrade:
+    """
+    Relatório em grade (paisagem): colunas fixas + colunas de dias.
+
+    - colunas: [(titulo, largura, alinhamento "l"/"c", max_chars)]
+    - n_dias / destacar: quantidade de colunas de dia e índices (1..n) sombreados
+    - linhas (render): ("faixa", texto), ("linha", [valores fixos], [rótulos dos dias])
+      ou ("espaco",) para um respiro entre blocos
+    """
+
+    margin = 20
+    header_h = 60
+    row_h = 16
+    header_row_h = 18
+    faixa_gap = 4
+
+    def __init__(self, titulo_linhas, colunas, n_dias, destacar=(), pagesize=None):
+        self.pagesize = pagesize or landscape(A4)
+        self.W, self.H = self.pagesize
+        self.titulo_linhas = list(CABECALHO_PADRAO) + list(titulo_linhas)
+        self.colunas = colunas
+        self.n_dias = n_dias
+        self.destacar = set(destacar)
+
+        self.grid_x = self.margin
+        self.grid_w = self.W - self.margin * 2
+        fixas_w = sum(c[1] for c in colunas)
+        self.cell_w = round(max(12, (self.grid_w - fixas_w) / max(n_dias, 1)), 2)
+        self.dias_x = self.grid_x + fixas_w
+
+        # x de cada divisória vertical (colunas fixas + dias)
+        xs = [self.grid_x]
+        for c in colunas:
+            xs.append(xs[-1] + c[1])
+        for _ in range(n_dias):
+            xs.append(xs[-1] + self.cell_w)
+        self.xs = xs
+
+        self.tabela_top = self.H - self.margin - self.header_h - 10
+        self.min_y = self.margin + 30
+
+    # ---------- moldura (form XObject) ----------
+    def _desenhar_moldura(self, c):
+        W, H, m = self.W, self.H, self.margin
+        top = H - m
+
+        logo_pref, logo_hosp = logos()
+        if logo_pref:
+            c.drawImage(logo_pref, m, top - 50, 45, 45, preserveAspectRatio=True, mask="auto")
+        if logo_hosp:
+            c.drawImage(logo_hosp, W - m - 45, top - 50, 45, 45, preserveAspectRatio=True, mask="auto")
+
+        y = top - 18
+        for fonte, tam, texto in self.titulo_linhas:
+            c.setFont(fonte, tam)
+            c.drawCentredString(W / 2, y, texto)
+            y -= 17
+
+        # cabeçalho da tabela
+        y0 = self.tabela_top
+        hh = self.header_row_h
+        c.setLineWidth(1)
+        c.setFillGray(0.95)
+        c.rect(self.grid_x, y0 - hh, self.grid_w, hh, fill=1, stroke=1)
+
+        c.setFillGray(0.85)
+        for d in self.destacar:
+            c.rect(self.dias_x + (d - 1) * self.cell_w, y0 - hh, self.cell_w, hh, fill=1, stroke=0)
+        c.setFillGray(0)
+
+        c.setFont("Helvetica-Bold", 8)
+        x = self.grid_x
+        for titulo, largura, _, _ in self.colunas:
+            c.drawString(x + 4, y0 - 13, titulo)
+            x += largura
+        for d in range(1, self.n_dias + 1):
+            c.drawCentredString(self.dias_x + (d - 0.5) * self.cell_w, y0 - 13, f"{d:02d}")
+
+        for x in self.xs[1:-1]:
+            c.line(x, y0, x, y0 - hh)
+
+    # ---------- paginação ----------
+    def _paginar(self, linhas):
+        # [[(y, linha), ...], ...] (y = topo da linha)
+        paginas = [[]]
+        y = self.tabela_top - self.header_row_h
+        for linha in linhas:
+            if linha[0] == "espaco":
+                y -= self.faixa_gap
+                continue
+            precisa = 2 if linha[0] == "faixa" else 1
+            if y - precisa * self.row_h < self.min_y:
+                paginas.append([])
+                y = self.tabela_top - self.header_row_h
+            paginas[-1].append((y, linha))
+            y -= self.row_h
+        return paginas
+
+    def _blocos(self, pagina):
+        # trechos contínuos de linhas de funcionário: [(y_top, y_bottom, [(y, linha)])]
+        blocos = []
+        atual = []
+        for y, linha in pagina:
+            if linha[0] == "linha":
+                if atual and abs(atual[-1][0] - self.row_h - y) > 0.01:
+                    blocos.append(atual)
+                    atual = []
+                atual.append((y, linha))
+            else:
+                if atual:
+                    blocos.append(atual)
+                    atual = []
+        if atual:
+            blocos.append(atual)
+        return [(b[0][0], b[-1][0] - self.row_h, b) for b in blocos]
+
+    def _desenhar_pagina(self, c, pagina):
+        c.doForm("moldura")
+        rh = self.row_h
+
+        blocos = self._blocos(pagina)
+
+        # 1) fundo dos fins de semana: 1 retângulo por coluna por bloco
+        c.setFillGray(0.96)
+        for y_top, y_bot, _ in blocos:
+            for d in self.destacar:
+                c.rect(self.dias_x + (d - 1) * self.cell_w, y_bot, self.cell_w, y_top - y_bot, fill=1, stroke=0)
+        c.setFillGray(0)
+
+        # 2) faixas de equipe
+        for y, linha in pagina:
+            if linha[0] == "faixa":
+                c.setFillGray(0.85)
+                c.rect(self.grid_x, y - rh, self.grid_w, rh, fill=1, stroke=1)
+                c.setFillGray(0)
+                c.setFont("Helvetica-Bold", 9)
+                c.drawString(self.grid_x + 6, y - 12, linha[1])
+
+        # 3) textos das linhas: 1 objeto de texto por fonte por página
+        t = c.beginText()
+        t.setFont("Helvetica", 8)
+        for _, _, bloco in blocos:
+            for y, (_, fixos, _) in bloco:
+                x = self.grid_x
+                for (titulo, largura, alinhamento, max_chars), valor in zip(self.colunas, fixos):
+                    valor = (valor or "")[:max_chars]
+                    if alinhamento == "c":
+                        t.setTextOrigin(x + largura / 2 - c.stringWidth(valor, "Helvetica", 8) / 2, y - 12)
+                    else:
+                        t.setTextOrigin(x + 4, y - 12)
+                    t.textOut(valor)
+                    x += largura
+        c.drawText(t)
+
+        t = c.beginText()
+        t.setFont("Helvetica-Bold", 7)
+        meia_largura = {}
+        for _, _, bloco in blocos:
+            for y, (_, _, dias) in bloco:
+                x_ant = None
+                for d, lab in enumerate(dias):
+                    if not lab:
+                        continue
+                    if lab not in meia_largura:
+                        meia_largura[lab] = c.stringWidth(lab, "Helvetica-Bold", 7) / 2
+                    x = self.dias_x + (d + 0.5) * self.cell_w - meia_largura[lab]
+                    # deslocamento relativo (Td): valores se repetem e comprimem bem
+                    if x_ant is None:
+                        t.setTextOrigin(x, y - 12)
+                    else:
+                        t.moveCursor(x - x_ant, 0)
+                    t.textOut(lab)
+                    x_ant = x
+        c.drawText(t)
+
+        # 4) linhas da grade: 1 path por bloco
+        for y_top, y_bot, bloco in blocos:
+            p = c.beginPath()
+            for y, _ in bloco:
+                p.moveTo(self.grid_x, y)
+                p.lineTo(self.grid_x + self.grid_w, y)
+            p.moveTo(self.grid_x, y_bot)
+            p.lineTo(self.grid_x + self.grid_w, y_bot)
+            for x in self.xs:
+                p.moveTo(x, y_top)
+                p.lineTo(x, y_bot)
+            c.drawPath(p, stroke=1, fill=0)
+
+    def render(self, linhas) -> bytes:
+        buffer = io.BytesIO()
+        c = canvas.Canvas(buffer, pagesize=self.pagesize)
+
+        c.beginForm("moldura")
+        self._desenhar_moldura(c)
+        c.endForm()
+
+        paginas = self._paginar(linhas)
+        for i, pagina in enumerate(paginas):
+            if i:
+                c.showPage()
+            self._desenhar_pagina(c, pagina)
+
+        c.save()
+        return buffer.getvalue()
+
+
+# ==================================================
+# ESCALA DO MÊS
+# ==================================================
+
+# rótulo de cada código da grade no PDF (igual à planilha)
+ROTULO_PDF = ("", "X", "F", "24H", "FÉR")
+
+
+def gerar_pdf_escala(grade) -> bytes:
+    """PDF (grade paisagem) de uma escala a partir da grade decodificada (ver app.obter_grade)."""
+    esc = grade["escala"]
+    setor_txt = (esc["setor"] or "TODOS").upper()
+
+    relatorio = RelatorioGrade(
+        titulo_linhas=[("Helvetica", 10, f"ESCALA — {esc['mes']:02d}/{esc['ano']} — SETOR: {setor_txt}")],
+        colunas=[
+            ("NOME DO FUNCIONÁRIO(A)", 220, "l", 42),
+            ("CH", 45, "c", 6),
+            ("VÍNCULO", 80, "l", 12),
+        ],
+        n_dias=len(grade["dias"]),
+        destacar=[d for d in grade["dias"] if date(esc["ano"], esc["mes"], d).weekday() >= 5],
+    )
+
+    matriz = grade["matriz"]
+    func_map = grade["funcionarios"]
+
+    def linhas():
+        for equipe, ids in grade["equipes"]:
+            yield ("faixa", f"{equipe} — SETOR: {setor_txt}")
+            for fid in ids:
+                f = func_map.get(fid)
+                yield (
+                    "linha",
+                    [
+                        (f["nome"] if f else "FUNCIONÁRIO").upper(),
+                        (f["carga_horaria"] or "").upper() if f else "",
+                        (f["tipo_vinculo"] or "").upper() if f else "",
+                    ],
+                    [ROTULO_PDF[cod] for cod in matriz[grade["linha"][fid]].tolist()],
+                )
+            yield ("espaco",)
+
+    return relatorio.render(linhas())
+
+
+def gerar_pdf_escala_tarefa(tarefa):
+    """Versão "picklável" para processos: (escala_mes_id, grade) -> (escala_mes_id, bytes)."""
+    escala_mes_id, grade = tarefa
+    return escala_mes_id, gerar_pdf_escala(grade)
+
+
+# ==================================================
+# RELATÓRIO EM TABELA (LISTAGENS LONGAS)
+# ==================================================
+# Table do platypus com altura de linha fixa, já fatiada por página:
+# custo linear no número de linhas (milhares de linhas ok) e
+# cabeçalho da tabela repetido em toda página.
+
+_largura_char = {}
+
+
+def _cortar(valor, largura, fonte="Helvetica", tam=8):
+    """Texto cortado com "..." para caber em `largura` pontos."""
+    valor = "" if valor is None else str(valor)
+    # largura de cada caractere medida 1 vez (stringWidth por célula é caro)
+    w = 0.0
+    for i, ch in enumerate(valor):
+        cw = _largura_char.get((fonte, tam, ch))
+        if cw is None:
+            cw = _largura_char[(fonte, tam, ch)] = stringWidth(ch, fonte, tam)
+        w += cw
+        if w > largura:
+            reticencias = stringWidth("...", fonte, tam)
+            while i and stringWidth(valor[:i], fonte, tam) + reticencias > largura:
+                i -= 1
+            return valor[:i] + "..."
+    return valor
+
+
+def gerar_pdf_tabela(titulo, subtitulo, colunas, linhas, pagesize=None) -> bytes:
+    """
+    PDF de listagem com cabeçalho padrão (logos + títulos).
+    - colunas: [(titulo, peso)] — largura proporcional ao peso
+    - linhas: iterável de listas de valores (mesma ordem das colunas)
+    - pagesize: padrão A4 retrato até 5 colunas, paisagem acima disso
+    """
+    pagesize = pagesize or (landscape(A4) if len(colunas) > 5 else A4)
+    W, H = pagesize
+    margem = 28
+    topo = 78
+    fonte = 8
+
+    largura_util = W - margem * 2
+    soma_pesos = sum(p for _, p in colunas) or 1
+    larguras = [largura_util * p / soma_pesos for _, p in colunas]
+    # espaço útil de cada célula (descontando o padding da tabela)
+    max_w = [w - 8 for w in larguras]
+
+    estilo = TableStyle([
+        ("FONT", (0, 0), (-1, 0), "Helvetica-Bold", fonte),
+        ("FONT", (0, 1), (-1, -1), "Helvetica", fonte),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.Color(0.85, 0.85, 0.85)),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.Color(0.96, 0.96, 0.96)]),
+        ("LINEBELOW", (0, 0), (-1, 0), 0.8, colors.black),
+        ("BOX", (0, 0), (-1, -1), 0.5, colors.black),
+        ("TOPPADDING", (0, 0), (-1, -1), 2),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ])
+
+    # altura fixa por linha: nada é medido e cada página recebe uma
+    # tabela já do tamanho certo (o platypus nunca precisa quebrar)
+    row_h = fonte + 6
+    por_pagina = max(1, int((H - topo - margem) // row_h) - 1)
+    cabecalho_tabela = [t for t, _ in colunas]
+
+    tabelas = []
+    pagina = []
+    total = 0
+
+    def fechar():
+        tabela = Table([cabecalho_tabela] + pagina, colWidths=larguras, rowHeights=row_h)
+        tabela.setStyle(estilo)
+        tabelas.append(tabela)
+
+    for valores in linhas:
+        pagina.append([_cortar(v, w, tam=fonte) for v, w in zip(valores, max_w)])
+        total += 1
+        if len(pagina) == por_pagina:
+            fechar()
+            pagina = []
+    if pagina or not tabelas:
+        fechar()
+
+    logo_pref, logo_hosp = logos()
+
+    def cabecalho(c, doc):
+        c.saveState()
+        top = H - margem
+        if logo_pref:
+            c.drawImage(logo_pref, margem, top - 45, 40, 40, preserveAspectRatio=True, mask="auto")
+        if logo_hosp:
+            c.drawImage(logo_hosp, W - margem - 40, top - 45, 40, 40, preserveAspectRatio=True, mask="auto")
+
+        y = top - 14
+        for f, tam, texto in list(CABECALHO_PADRAO) + [("Helvetica-Bold", 11, titulo)]:
+            c.setFont(f, tam)
+            c.drawCentredString(W / 2, y, texto)
+            y -= 15
+
+        c.setFont("Helvetica", 8)
+        c.drawString(margem, margem - 12, subtitulo)
+        c.drawRightString(W - margem, margem - 12, f"{total} registro(s) — página {doc.page}")
+        c.restoreState()
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=pagesize,
+        leftMargin=margem,
+        rightMargin=margem,
+        topMargin=topo,
+        bottomMargin=margem,
+        title=titulo,
+    )
+    doc.build(tabelas, onFirstPage=cabecalho, onLaterPages=cabecalho)
+    return buffer.getvalue()
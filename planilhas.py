@@ -0,0 +1,163 @@
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# ==================================================
+# EXPORTAÇÃO EM STREAMING (CSV / XLSX / ZIP)
+# ==================================================
+# Módulo "puro" (sem Flask/banco): recebe linhas (iterável) e devolve
+# um gerador de bytes. Nada é montado inteiro em memória, então a
+# resposta começa na hora e o consumo fica constante com 400 ou 40.000 linhas.
+
+LOTE_LINHAS = 500
+
+
+class SaidaStream:
+    # "arquivo" só de escrita: o zipfile escreve aqui e o gerador repassa os bytes
+    def __init__(self):
+        self._partes = []
+        self._pos = 0
+
+    def write(self, b):
+        self._partes.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def retirar(self):
+        dados = b"".join(self._partes)
+        self._partes = []
+        return dados
+
+
+def _texto(valor):
+    return "" if valor is None else str(valor)
+
+
+# ---------- CSV ----------
+def gerar_csv(cabecalho, linhas, delimitador=";"):
+    """CSV (UTF-8 com BOM, ";" — abre direto no Excel em pt-BR) em pedaços."""
+    buf = io.StringIO()
+    w = csv.writer(buf, delimiter=delimitador)
+
+    buf.write("\ufeff")
+    w.writerow(cabecalho)
+
+    n = 0
+    for valores in linhas:
+        w.writerow([_texto(v) for v in valores])
+        n += 1
+        if n % LOTE_LINHAS == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+
+    yield buf.getvalue().encode("utf-8")
+
+
+# ---------- XLSX ----------
+# Planilha mínima (1 aba, strings inline) escrita direto no ZIP em streaming.
+# Sem dependência extra: um .xlsx é só um ZIP com alguns XMLs.
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{aba}" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+# estilo 1 = negrito (cabeçalho)
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+# caracteres de controle não são permitidos em XML 1.0
+_INVALIDOS_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _linha_xml(valores, estilo=""):
+    celulas = "".join(
+        f'<c t="inlineStr"{estilo}><is><t xml:space="preserve">'
+        f'{escape(_INVALIDOS_XML.sub("", _texto(v)))}</t></is></c>'
+        for v in valores
+    )
+    return f"<row>{celulas}</row>"
+
+
+def gerar_xlsx(cabecalho, linhas, aba="Planilha1"):
+    """XLSX (1 aba) em pedaços: o XML da aba é comprimido e enviado a cada lote de linhas."""
+    saida = SaidaStream()
+    zf = zipfile.ZipFile(saida, mode="w", compression=zipfile.ZIP_DEFLATED)
+
+    zf.writestr("[Content_Types].xml", _CONTENT_TYPES)
+    zf.writestr("_rels/.rels", _RELS)
+    zf.writestr("xl/workbook.xml", _WORKBOOK.format(aba=escape(aba[:31])))
+    zf.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+    zf.writestr("xl/styles.xml", _STYLES)
+    yield saida.retirar()
+
+    with zf.open("xl/worksheets/sheet1.xml", mode="w", force_zip64=True) as aba_xml:
+        aba_xml.write(
+            b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            b'<sheetData>'
+        )
+        aba_xml.write(_linha_xml(cabecalho, ' s="1"').encode("utf-8"))
+
+        partes = []
+        for valores in linhas:
+            partes.append(_linha_xml(valores))
+            if len(partes) == LOTE_LINHAS:
+                aba_xml.write("".join(partes).encode("utf-8"))
+                partes = []
+                yield saida.retirar()
+
+        aba_xml.write("".join(partes).encode("utf-8"))
+        aba_xml.write(b"</sheetData></worksheet>")
+
+    zf.close()
+    yield saida.retirar()